@@ -10,34 +10,121 @@ Goal: Publish the akmods cache images consumed by later build steps.
 
 from __future__ import annotations
 
+import hashlib
 import json
 import os
 import re
+import shutil
 import subprocess
-from pathlib import Path
+import threading
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path, PurePosixPath
 from tempfile import TemporaryDirectory
 
 from ci_tools.common import (
     AKMODS_CACHE_KERNEL_RELEASES_LABEL,
     AKMODS_CACHE_METADATA_VERSION,
     AKMODS_CACHE_METADATA_VERSION_LABEL,
+    AKMODS_INSTALL_MANIFEST_PATH,
+    AKMODS_INSTALL_MANIFEST_VERSION,
+    AKMODS_KMOD_OVERLAY_DIR,
     CiToolError,
     kernel_releases_from_env,
     load_layer_files_from_oci_layout,
     normalize_owner,
     optional_env,
+    optional_registry_creds,
     require_env,
     run_cmd,
+    run_cmd_with_log_prefix,
+    run_concurrently,
+    skopeo_exists,
     skopeo_copy,
+    skopeo_inspect_digest,
     sort_kernel_releases,
     unpack_layer_tarballs,
 )
+from ci_tools.oci_assembly import (
+    OCI_LAYER_GZIP_MEDIA_TYPE,
+    ImageLayer,
+    image_config,
+    image_manifest,
+    push_assembled_image,
+    read_image_layers,
+    retag_image,
+    write_reproducible_image_layout,
+    write_reproducible_layer,
+)
+from ci_tools.registry_cache import registry_metadata_cache
+from ci_tools.registry_client import (
+    RegistryError,
+    parse_image_ref,
+    registry_client,
+    sha256_digest,
+)
+from ci_tools.rpm_header import RpmHeaderError, extract_rpm_payload, read_rpm_header
 
 
 AKMODS_WORKTREE = Path("/tmp/akmods")
+# Per-kernel `just build`/`just push` runs allowed at once; 1 keeps them serial.
+AKMODS_BUILD_CONCURRENCY_ENV = "AKMODS_BUILD_CONCURRENCY"
+# `true` reuses per-kernel images already pushed with the same build inputs.
+AKMODS_INCREMENTAL_ENV = "AKMODS_INCREMENTAL"
+AKMODS_INPUTS_FINGERPRINT_VERSION = 1
+# `rebuild` unpacks and rebuilds the shared cache image; `layers` reuses the
+# per-kernel layer blobs and uploads only a config and manifest.
+AKMODS_MERGE_MODE_ENV = "AKMODS_MERGE_MODE"
+AKMODS_MERGE_MODES = ("rebuild", "layers")
+
+
+class MixedZfsVersionsError(CiToolError):
+    """Raised when merged per-kernel images carry different ZFS versions."""
+
+
 ARCH_SUFFIX_RE = re.compile(r"\.(x86_64|aarch64)$")
 
 
+@dataclass
+class PublishUploadStats:
+    """
+    Bytes this process sent to the registry for the shared cache and its tags.
+
+    Per-kernel `just push` uploads happen inside upstream tooling and are not
+    counted. Blobs are only counted when the target repository lacked them.
+    """
+
+    blob_count: int = 0
+    blob_bytes: int = 0
+    manifest_count: int = 0
+    manifest_bytes: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record_blob(self, size: int) -> None:
+        with self._lock:
+            self.blob_count += 1
+            self.blob_bytes += size
+
+    def record_manifests(self, count: int, total_bytes: int) -> None:
+        with self._lock:
+            self.manifest_count += count
+            self.manifest_bytes += total_bytes
+
+
+PUBLISH_UPLOADS = PublishUploadStats()
+
+
+def report_publish_uploads(stats: PublishUploadStats = PUBLISH_UPLOADS) -> None:
+    """Print the upload volume so regressions in publish size show up in logs."""
+
+    print(
+        f"Akmods publish uploads: {stats.blob_bytes + stats.manifest_bytes} bytes "
+        f"({stats.blob_count} blobs, {stats.blob_bytes} bytes; "
+        f"{stats.manifest_count} manifests, {stats.manifest_bytes} bytes), "
+        "not counting per-kernel `just push`."
+    )
+
+
 def kernel_name_for_flavor(kernel_flavor: str) -> str:
     """
     Map a kernel flavor name to the package base name expected by akmods tooling.
@@ -100,7 +187,13 @@ def build_kernel_cache_document(
     return payload, cache_json_path, upstream_build_root
 
 
-def write_kernel_cache_file(*, kernel_release: str, shared_cache_path: bool) -> None:
+def write_kernel_cache_file(*, kernel_release: str, shared_cache_path: bool) -> dict[str, str]:
+    """
+    Seed one kernel's `cache.json` and return the env overrides for its build.
+
+    The overrides are passed to that kernel's `just` commands instead of being
+    written into `os.environ`, so several kernels can build at the same time.
+    """
     # When kernel pinning is enabled, these values must also be set.
     kernel_flavor = require_env("AKMODS_KERNEL")
     akmods_version = require_env("AKMODS_VERSION")
@@ -126,13 +219,11 @@ def write_kernel_cache_file(*, kernel_release: str, shared_cache_path: bool) ->
     )
 
     # Upstream Justfile computes `KCWD`/`KCPATH` from `AKMODS_BUILDDIR`.
-    # Export the per-kernel build root so the later `just build`/`just push`
-    # commands really use the isolated path we just calculated.
-    os.environ["AKMODS_BUILDDIR"] = str(upstream_build_root)
+    # Hand the per-kernel build root to the later `just build`/`just push`
+    # commands so they really use the isolated path we just calculated.
+    build_env = {"AKMODS_BUILDDIR": str(upstream_build_root)}
     if kcpath_override:
-        os.environ["KCPATH"] = kcpath_override
-    else:
-        os.environ.pop("KCPATH", None)
+        build_env["KCPATH"] = kcpath_override
 
     cache_json_path.parent.mkdir(parents=True, exist_ok=True)
     cache_json_path.write_text(json.dumps(payload, indent=2) + "\n", encoding="utf-8")
@@ -140,9 +231,24 @@ def write_kernel_cache_file(*, kernel_release: str, shared_cache_path: bool) ->
     print(f"Pinned akmods kernel release to {kernel_release}")
     print(f"Using upstream akmods build root {upstream_build_root}")
     print(f"Seeded {cache_json_path}")
+    return build_env
+
 
+def akmods_build_concurrency() -> int:
+    value = optional_env(AKMODS_BUILD_CONCURRENCY_ENV, "1")
+    try:
+        concurrency = int(value)
+    except ValueError as exc:
+        raise CiToolError(f"{AKMODS_BUILD_CONCURRENCY_ENV} must be an integer, got {value!r}") from exc
+    return max(1, concurrency)
 
-def build_and_push_kernel_release(kernel_release: str, *, shared_cache_path: bool) -> None:
+
+def build_and_push_kernel_release(
+    kernel_release: str,
+    *,
+    shared_cache_path: bool,
+    prefix_logs: bool = False,
+) -> None:
     """
     Build and push one kernel-specific akmods payload.
 
@@ -151,7 +257,7 @@ def build_and_push_kernel_release(kernel_release: str, *, shared_cache_path: boo
     path causes package collisions during the later build.
     """
     print(f"Building akmods for kernel release: {kernel_release}")
-    write_kernel_cache_file(
+    build_env = write_kernel_cache_file(
         kernel_release=kernel_release,
         shared_cache_path=shared_cache_path,
     )
@@ -160,8 +266,187 @@ def build_and_push_kernel_release(kernel_release: str, *, shared_cache_path: boo
     # kernel-specific tag plus an architecture tag. In the multi-kernel path we
     # later assemble the shared Fedora-wide tag ourselves from those per-kernel
     # images, because upstream's shared-cache flow assumes one kernel per build.
-    run_cmd(["just", "build"], cwd=str(AKMODS_WORKTREE), capture_output=False)
-    run_cmd(["just", "push"], cwd=str(AKMODS_WORKTREE), capture_output=False)
+    for command in (["just", "build"], ["just", "push"]):
+        if prefix_logs:
+            # Concurrent builds: every output line names its kernel.
+            run_cmd_with_log_prefix(command, prefix=kernel_release, cwd=str(AKMODS_WORKTREE), env=build_env)
+        else:
+            run_cmd(command, cwd=str(AKMODS_WORKTREE), capture_output=False, env=build_env)
+
+
+def akmods_incremental_enabled() -> bool:
+    return optional_env(AKMODS_INCREMENTAL_ENV, "false").lower() == "true"
+
+
+def akmods_inputs_fingerprint(kernel_release: str) -> str:
+    """
+    Hash the build inputs that decide what one kernel's akmods image contains.
+
+    The inputs are the pinned akmods checkout (commit plus local edits such as
+    the `images.yaml` target written by `akmods-configure-zfs-target`), the
+    kernel flavor, Fedora version, akmods target, ZFS minor version, and the
+    kernel release. The ZFS patch release is chosen by upstream at build time,
+    so `merge_and_push_shared_cache_image` still checks that reused and fresh
+    images agree on it.
+    """
+
+    checkout = str(AKMODS_WORKTREE)
+    checkout_commit = run_cmd(["git", "-C", checkout, "rev-parse", "HEAD"]).strip()
+    checkout_changes = run_cmd(["git", "-C", checkout, "diff", "HEAD"])
+    document = {
+        "version": AKMODS_INPUTS_FINGERPRINT_VERSION,
+        "akmods_commit": checkout_commit,
+        "akmods_changes_sha256": hashlib.sha256(checkout_changes.encode("utf-8")).hexdigest(),
+        "akmods_kernel": require_env("AKMODS_KERNEL"),
+        "akmods_version": require_env("AKMODS_VERSION"),
+        "akmods_target": optional_env("AKMODS_TARGET"),
+        "zfs_minor_version": optional_env("ZFS_MINOR_VERSION"),
+        "kernel_release": kernel_release,
+    }
+    encoded = json.dumps(document, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def kernel_image_ref(kernel_release: str, *, inputs_fingerprint: str | None = None) -> str:
+    """
+    Return the registry ref `just push` publishes for one kernel.
+
+    With `inputs_fingerprint`, return the sibling tag that records which build
+    inputs produced that image.
+    """
+
+    image_org = normalize_owner(require_env("GITHUB_REPOSITORY_OWNER"))
+    tag = f"{require_env('AKMODS_KERNEL')}-{require_env('AKMODS_VERSION')}-{kernel_release}"
+    if inputs_fingerprint:
+        tag = f"{tag}-inputs-{inputs_fingerprint}"
+    return f"docker://ghcr.io/{image_org}/{require_env('AKMODS_REPO')}:{tag}"
+
+
+def retag_published_image(source_ref: str, dest_refs: list[str]) -> None:
+    """
+    Point `dest_refs` (tags in the source repository) at `source_ref`'s manifest.
+
+    A manifest PUT per tag is enough because every blob is already in the
+    repository. If the registry API cannot be used, `skopeo copy` does the
+    same job: it finds every blob present and uploads only the manifest.
+    """
+
+    creds = optional_registry_creds()
+    try:
+        sent = retag_image(
+            source_ref,
+            [dest_ref.rsplit(":", 1)[1] for dest_ref in dest_refs],
+            creds=creds,
+        )
+    except RegistryError as exc:
+        print(f"Warning: manifest-only retag of {source_ref} failed ({exc}); using skopeo copy.")
+        for dest_ref in dest_refs:
+            skopeo_copy(source_ref, dest_ref, creds=creds)
+        return
+    PUBLISH_UPLOADS.record_manifests(len(dest_refs), sent)
+    for dest_ref in dest_refs:
+        # Later steps in this job must see the new tag target.
+        registry_metadata_cache().invalidate(dest_ref)
+
+
+def record_kernel_image_inputs(kernel_release: str, inputs_fingerprint: str) -> None:
+    """
+    Tag a freshly pushed per-kernel image with its inputs fingerprint.
+
+    Only a manifest is written (see `retag_published_image`). A retried job
+    finds this tag and skips the kernel instead of rebuilding it.
+    """
+
+    retag_published_image(
+        kernel_image_ref(kernel_release),
+        [kernel_image_ref(kernel_release, inputs_fingerprint=inputs_fingerprint)],
+    )
+
+
+def reusable_kernel_images(kernel_releases: list[str], fingerprints: dict[str, str]) -> dict[str, str]:
+    """Return `{kernel_release: image_ref}` for kernels already pushed with the same inputs."""
+
+    creds = optional_registry_creds()
+    reusable: dict[str, str] = {}
+    for kernel_release in kernel_releases:
+        image_ref = kernel_image_ref(kernel_release, inputs_fingerprint=fingerprints[kernel_release])
+        if skopeo_exists(image_ref, creds=creds):
+            reusable[kernel_release] = image_ref
+    return reusable
+
+
+def build_kernel_releases(kernel_releases: list[str], *, fingerprints: dict[str, str]) -> None:
+    """
+    Build and push each kernel, then record its inputs fingerprint if known.
+
+    By default kernels run one at a time; `AKMODS_BUILD_CONCURRENCY` above 1
+    runs that many at once. Each kernel already has its own build root and env
+    overrides.
+    """
+
+    def build_one(kernel_release: str, *, prefix_logs: bool) -> None:
+        build_and_push_kernel_release(
+            kernel_release,
+            shared_cache_path=False,
+            prefix_logs=prefix_logs,
+        )
+        if kernel_release in fingerprints:
+            record_kernel_image_inputs(kernel_release, fingerprints[kernel_release])
+
+    concurrency = akmods_build_concurrency()
+    if concurrency == 1 or len(kernel_releases) <= 1:
+        for kernel_release in kernel_releases:
+            build_one(kernel_release, prefix_logs=False)
+        return
+    print(f"Building {len(kernel_releases)} kernels with up to {concurrency} at once.")
+    run_concurrently(
+        {
+            kernel_release: partial(build_one, kernel_release, prefix_logs=True)
+            for kernel_release in kernel_releases
+        },
+        max_workers=concurrency,
+        title="akmods kernel build timings",
+    )
+
+
+def build_missing_kernels_and_merge(kernel_releases: list[str]) -> None:
+    """
+    Build the kernels that need it, then publish the merged shared cache tag.
+
+    Why the incremental mode (`AKMODS_INCREMENTAL=true`) exists:
+    1. A new base-image kernel usually leaves the older kernels' per-kernel
+       images valid; rebuilding them doubles or triples the job.
+    2. Each pushed per-kernel image is also tagged with a fingerprint of its
+       build inputs, so only images from identical inputs are reused.
+    3. Retried jobs find the kernels an earlier attempt already pushed.
+    4. If the reused images turn out to carry a different ZFS patch release
+       than the fresh builds, the reused kernels are rebuilt and merged again.
+    """
+
+    fingerprints: dict[str, str] = {}
+    reused: dict[str, str] = {}
+    if akmods_incremental_enabled():
+        fingerprints = {kernel_release: akmods_inputs_fingerprint(kernel_release) for kernel_release in kernel_releases}
+        reused = reusable_kernel_images(kernel_releases, fingerprints)
+        print(
+            "Incremental akmods rebuild: reusing "
+            f"{' '.join(reused) or 'no kernels'}; building "
+            f"{' '.join(k for k in kernel_releases if k not in reused) or 'no kernels'}."
+        )
+
+    build_kernel_releases(
+        [kernel_release for kernel_release in kernel_releases if kernel_release not in reused],
+        fingerprints=fingerprints,
+    )
+    try:
+        merge_and_push_shared_cache_image(kernel_releases=kernel_releases, reused_image_refs=reused)
+    except MixedZfsVersionsError as exc:
+        if not reused:
+            raise
+        print(f"{exc}\nRebuilding the reused kernels so every kernel uses the same ZFS build.")
+        build_kernel_releases(list(reused), fingerprints=fingerprints)
+        merge_and_push_shared_cache_image(kernel_releases=kernel_releases, reused_image_refs={})
+    report_publish_uploads()
 
 
 def manifest_tag_for_kernel_release(
@@ -227,53 +512,404 @@ def merged_cache_missing_kernel_releases(
     """
     Return kernel releases whose `kmod-zfs` RPM is missing from the merged root.
 
-    The merged shared cache image must carry a `kmod-zfs-<kernel_release>-...`
-    RPM for every kernel shipped in the base image. This check keeps the custom
-    merge step fail-closed before we publish a broken shared cache tag.
+    The merged shared cache image must carry a `kmod-zfs` RPM for every kernel
+    shipped in the base image. Coverage is read from each RPM header (package
+    name plus the `/lib/modules/<release>/extra/zfs/zfs.ko` payload path), not
+    from file names, so a misnamed RPM cannot make the cache look complete.
+    This check keeps the custom merge step fail-closed before we publish a
+    broken shared cache tag.
     """
     rpm_dir = merged_root / "rpms" / "kmods" / "zfs"
     if not rpm_dir.exists():
         return list(kernel_releases)
 
-    present_names = {path.name for path in rpm_dir.glob("kmod-zfs-*.rpm")}
-    missing: list[str] = []
-    for kernel_release in kernel_releases:
-        expected_prefix = f"kmod-zfs-{kernel_release}-"
-        if not any(name.startswith(expected_prefix) for name in present_names):
-            missing.append(kernel_release)
-    return missing
+    present_releases: set[str] = set()
+    for rpm_path in sorted(rpm_dir.glob("*.rpm")):
+        try:
+            header = read_rpm_header(rpm_path)
+        except RpmHeaderError as exc:
+            raise CiToolError(f"Merged shared akmods cache holds an unreadable RPM: {exc}") from exc
+        if header.name != "kmod-zfs":
+            continue
+        kernel_release = header.kernel_release_for_module()
+        if kernel_release:
+            present_releases.add(kernel_release)
+    return [release for release in kernel_releases if release not in present_releases]
+
+
+def merged_cache_zfs_versions(*, merged_root: Path) -> list[str]:
+    """Return the distinct `zfs` / `kmod-zfs` versions in the merged RPM directory."""
+
+    rpm_dir = merged_root / AKMODS_INSTALL_MANIFEST_PATH.rsplit("/", 1)[0]
+    versions: set[str] = set()
+    for rpm_path in sorted(rpm_dir.glob("*.rpm")):
+        try:
+            header = read_rpm_header(rpm_path)
+        except RpmHeaderError as exc:
+            raise CiToolError(f"Merged shared akmods cache holds an unreadable RPM: {exc}") from exc
+        if header.name in {"zfs", "kmod-zfs"}:
+            versions.add(header.version)
+    return sorted(versions)
+
+
+def build_install_manifest(*, merged_root: Path) -> dict:
+    """
+    Record the name, kmod kernel release, and sha256 of every cached ZFS RPM.
+
+    Why compute this at publish time:
+    1. Every compose otherwise re-reads the same RPM headers to learn which
+       file is `kmod-zfs` and which kernel each kmod targets.
+    2. The merge step already has every RPM on local disk, once per publish.
+    3. The checksums let the compose helper trust the document only for the
+       exact RPM bytes it describes; any mismatch falls back to discovery.
+    """
+
+    rpm_dir = merged_root / AKMODS_INSTALL_MANIFEST_PATH.rsplit("/", 1)[0]
+    rpms: list[dict[str, str]] = []
+    for rpm_path in sorted(rpm_dir.glob("*.rpm")):
+        try:
+            header = read_rpm_header(rpm_path)
+        except RpmHeaderError as exc:
+            raise CiToolError(f"Merged shared akmods cache holds an unreadable RPM: {exc}") from exc
+        with rpm_path.open("rb") as handle:
+            sha256 = hashlib.file_digest(handle, "sha256").hexdigest()
+        entry = {"file": rpm_path.name, "name": header.name, "sha256": sha256}
+        if header.name == "kmod-zfs":
+            entry["kernelRelease"] = header.kernel_release_for_module() or ""
+        rpms.append(entry)
+    return {"schemaVersion": AKMODS_INSTALL_MANIFEST_VERSION, "rpms": rpms}
+
+
+def kmod_overlay_enabled() -> bool:
+    return optional_env("AKMODS_KMOD_OVERLAY", "true").lower() == "true"
+
+
+def build_kmod_overlay(
+    *,
+    merged_root: Path,
+    install_manifest: dict,
+    kernel_releases: list[str],
+) -> list[str]:
+    """
+    Unpack the fallback kernels' module trees into `kmod-overlay/<release>/`.
+
+    Why ship unpacked module files next to the RPMs:
+    1. Compose installs the newest kernel's `kmod-zfs` through `rpm-ostree`
+       and then unpacks every other kernel's payload on every build.
+    2. Those payloads are identical for every build that uses this cache tag.
+    3. The helper copies `kmod-overlay/<release>/` straight into
+       `/lib/modules/<release>/` when the overlay's kernel set matches the
+       base image's fallback kernels, and unpacks the RPMs otherwise.
+
+    Returns the kernel releases written, oldest first; empty for one kernel.
+    """
+
+    fallback_kernels = sort_kernel_releases(kernel_releases)[:-1]
+    rpm_dir = merged_root / AKMODS_INSTALL_MANIFEST_PATH.rsplit("/", 1)[0]
+    kmod_file_by_kernel = {
+        entry["kernelRelease"]: entry["file"]
+        for entry in install_manifest["rpms"]
+        if entry["name"] == "kmod-zfs" and entry.get("kernelRelease")
+    }
+    overlay_root = merged_root / AKMODS_KMOD_OVERLAY_DIR
+    for kernel_release in fallback_kernels:
+        prefixes = (("lib", "modules", kernel_release), ("usr", "lib", "modules", kernel_release))
+
+        def select(name: str, prefixes=prefixes) -> PurePosixPath | None:
+            parts = PurePosixPath(name.removeprefix("./").lstrip("/")).parts
+            if ".." in parts:
+                raise CiToolError(f"Unsafe cpio path in kmod payload: {name}")
+            for prefix in prefixes:
+                if parts[: len(prefix)] == prefix:
+                    return PurePosixPath(*parts[len(prefix) - 1 :])
+            return None
+
+        rpm_path = rpm_dir / kmod_file_by_kernel[kernel_release]
+        try:
+            files_written = extract_rpm_payload(rpm_path, overlay_root, select)
+        except RpmHeaderError as exc:
+            raise CiToolError(f"Could not unpack {rpm_path.name} into the kmod overlay: {exc}") from exc
+        if files_written is None:
+            # Nothing here can decode this payload; compose keeps unpacking RPMs.
+            print(
+                f"Warning: skipping the kmod overlay: cannot decode the payload of {rpm_path.name} "
+                "(zstd needs Python 3.14+, the zstandard package, or the zstd command). "
+                "Composes will unpack fallback-kernel RPMs instead."
+            )
+            shutil.rmtree(overlay_root, ignore_errors=True)
+            return []
+    return fallback_kernels
 
 
-def render_shared_cache_containerfile(*, kernel_releases: list[str]) -> str:
+def prepare_shared_cache_metadata(*, merged_root: Path, kernel_releases: list[str]) -> list[str]:
     """
-    Render the shared-cache Containerfile with lightweight kernel metadata.
+    Check the merged RPMs, then write the install manifest and kmod overlay.
 
-    Shared cache consumers only need to know which kernel releases this image
-    covers. Recording that in labels lets cache checks avoid a full image copy
-    and layer unpack on newer images while older images continue to work via
-    the existing fallback scan path.
+    Both merge modes run this on the RPMs they are about to publish, so a
+    cache that misses a kernel or mixes ZFS versions is never pushed.
+    Returns the kernel releases written to the kmod overlay.
     """
 
-    label_values = {
+    missing = merged_cache_missing_kernel_releases(
+        merged_root=merged_root,
+        kernel_releases=kernel_releases,
+    )
+    if missing:
+        raise CiToolError(
+            "Merged shared akmods cache is missing kernel RPMs for: "
+            + ", ".join(missing)
+        )
+    zfs_versions = merged_cache_zfs_versions(merged_root=merged_root)
+    if len(zfs_versions) > 1:
+        raise MixedZfsVersionsError(
+            "Merged shared akmods cache mixes ZFS versions: " + ", ".join(zfs_versions)
+        )
+
+    install_manifest = build_install_manifest(merged_root=merged_root)
+    (merged_root / AKMODS_INSTALL_MANIFEST_PATH).write_text(
+        json.dumps(install_manifest, indent=2, sort_keys=True) + "\n",
+        encoding="utf-8",
+    )
+    overlay_kernels: list[str] = []
+    if kmod_overlay_enabled():
+        overlay_kernels = build_kmod_overlay(
+            merged_root=merged_root,
+            install_manifest=install_manifest,
+            kernel_releases=kernel_releases,
+        )
+        if overlay_kernels:
+            print(f"Built kmod overlay for fallback kernels: {' '.join(overlay_kernels)}")
+    return overlay_kernels
+
+
+def shared_cache_labels(kernel_releases: list[str]) -> dict[str, str]:
+    """Return the coverage labels every shared cache image carries."""
+
+    return {
         AKMODS_CACHE_METADATA_VERSION_LABEL: AKMODS_CACHE_METADATA_VERSION,
         AKMODS_CACHE_KERNEL_RELEASES_LABEL: " ".join(
             sort_kernel_releases(kernel_releases)
         ),
     }
-    lines = ["FROM scratch"]
-    for key, value in label_values.items():
-        lines.append(f"LABEL {key}={json.dumps(value)}")
-    lines.extend(
-        [
-            "COPY kernel-rpms /kernel-rpms",
-            "COPY rpms /rpms",
-            "",
-        ]
+
+
+def shared_cache_layer_paths(*, include_kmod_overlay: bool = False) -> list[tuple[str, ...]]:
+    """
+    Return the top-level paths of each shared cache layer, bottom first.
+
+    Layers are ordered by how often they change. `kernel-rpms/` only changes
+    when the kernel set does, while `rpms/` also changes with every ZFS
+    release, so a ZFS-only rebuild keeps the kernel layer's digest and
+    registries and pulls reuse it. The kmod overlay sits on top in a layer of
+    its own: it only exists when fallback kernels need it, so adding or
+    dropping it never changes the digests below, and composes that skip the
+    overlay can skip its bytes too.
+    """
+
+    layer_paths: list[tuple[str, ...]] = [("kernel-rpms",), ("rpms",)]
+    if include_kmod_overlay:
+        layer_paths.append((AKMODS_KMOD_OVERLAY_DIR,))
+    return layer_paths
+
+
+def stream_layer_rpms(image_ref: str, layer_digest: str, destination_root: Path, *, creds: str | None = None) -> None:
+    """
+    Stream one registry layer and save just its ZFS RPMs under `destination_root`.
+
+    The merge checks, install manifest, and kmod overlay only read
+    `rpms/kmods/zfs/*.rpm`, so every other member, including the large
+    `kernel-rpms/` bodies, is passed over in the stream without being written
+    or hashed.
+    """
+
+    rpm_dir = PurePosixPath(AKMODS_INSTALL_MANIFEST_PATH).parent
+    image = parse_image_ref(image_ref)
+    for member, reader in registry_client().iter_layer_files(image, layer_digest, creds=creds):
+        path = PurePosixPath(member.name.removeprefix("./").lstrip("/"))
+        if reader is None or path.parent != rpm_dir or path.suffix != ".rpm":
+            continue
+        target = destination_root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with target.open("wb") as handle:
+            shutil.copyfileobj(reader, handle, 1 << 20)
+
+
+def refs_not_at_digest(remote_refs: list[str], image_digest: str) -> list[str]:
+    """
+    Return the refs in `remote_refs` that do not already point at `image_digest`.
+
+    The merged cache is reproducible, so a rebuild from the same RPMs yields
+    the digest that is already published and the push can be skipped. A
+    lookup failure only means the ref gets pushed again.
+    """
+
+    stale: list[str] = []
+    for remote_ref in remote_refs:
+        # Never trust a cached answer here; skipping a needed push is not safe.
+        registry_metadata_cache().invalidate(remote_ref)
+        try:
+            current_digest = skopeo_inspect_digest(remote_ref, creds=optional_registry_creds())
+        except CiToolError:
+            current_digest = ""
+        if current_digest != image_digest:
+            stale.append(remote_ref)
+    return stale
+
+
+def record_layout_uploads(layout_dir: Path, remote_ref: str) -> None:
+    """
+    Count the `dir:` layout blobs that `remote_ref`'s repository still lacks.
+
+    `skopeo copy` skips blobs the registry already has, so only the missing
+    ones cost upload bandwidth. When the check itself fails the blob is
+    counted, which can only overstate the upload.
+    """
+
+    target = parse_image_ref(remote_ref)
+    manifest = json.loads((layout_dir / "manifest.json").read_bytes())
+    client = registry_client()
+    creds = optional_registry_creds()
+    for descriptor in [manifest["config"], *manifest.get("layers", [])]:
+        digest = str(descriptor["digest"])
+        try:
+            present = client.blob_exists(target, digest, creds=creds)
+        except RegistryError:
+            present = False
+        if not present:
+            PUBLISH_UPLOADS.record_blob((layout_dir / digest.removeprefix("sha256:")).stat().st_size)
+
+
+def akmods_merge_mode() -> str:
+    mode = optional_env(AKMODS_MERGE_MODE_ENV, "rebuild").lower()
+    if mode not in AKMODS_MERGE_MODES:
+        raise CiToolError(
+            f"{AKMODS_MERGE_MODE_ENV} must be one of {', '.join(AKMODS_MERGE_MODES)}, got {mode!r}"
+        )
+    return mode
+
+
+def merge_shared_cache_from_layers(
+    *,
+    kernel_releases: list[str],
+    reused_image_refs: dict[str, str] | None = None,
+) -> None:
+    """
+    Publish the shared cache image by stacking the per-kernel layer blobs.
+
+    Why this mode exists (`AKMODS_MERGE_MODE=layers`):
+    1. The rebuild mode unpacks every per-kernel image, repacks one image
+       from the merged tree, and pushes all of it again, so merge time and
+       upload size grow with the kernel and kmod RPMs.
+    2. Every per-kernel image `just push` published is already in the
+       registry; the shared image can list the same layer blobs.
+    3. Only a small metadata layer (install manifest and kmod overlay), the
+       config with the coverage labels, and the manifest are uploaded. Blobs
+       from another repository on the same registry are mounted.
+    4. Unchanged kernels keep their layer digests across runs, so composes
+       re-download only what really changed.
+
+    The layer blobs are referenced as-is: nothing is recompressed or
+    re-uploaded. Each distinct layer is still streamed once, because the
+    install manifest records every ZFS RPM's sha256 and the kmod overlay is
+    unpacked from the fallback kernels' kmod RPMs; upstream per-kernel images
+    carry no labels that could stand in for either. Only `rpms/kmods/zfs/*.rpm`
+    is written to disk (see `stream_layer_rpms`).
+    """
+
+    akmods_repo = require_env("AKMODS_REPO")
+    image_org = normalize_owner(require_env("GITHUB_REPOSITORY_OWNER"))
+    arch = run_cmd(["uname", "-m"]).strip()
+    shared_tag = f"{require_env('AKMODS_KERNEL')}-{require_env('AKMODS_VERSION')}"
+    target_ref = f"docker://ghcr.io/{image_org}/{akmods_repo}:{shared_tag}"
+    creds = optional_registry_creds()
+
+    layers: list[ImageLayer] = []
+    architecture = ""
+    with TemporaryDirectory(prefix="akmods-layer-merge-") as tempdir:
+        merged_root = Path(tempdir) / "merged"
+        for kernel_release in kernel_releases:
+            source_ref = (reused_image_refs or {}).get(kernel_release) or kernel_image_ref(kernel_release)
+            image_layers, source_config = read_image_layers(source_ref, creds=creds)
+            architecture = architecture or str(source_config.get("architecture") or "")
+            for layer in image_layers:
+                if any(existing.digest == layer.digest for existing in layers):
+                    continue
+                layers.append(layer)
+                stream_layer_rpms(source_ref, layer.digest, merged_root, creds=creds)
+
+        overlay_kernels = prepare_shared_cache_metadata(
+            merged_root=merged_root,
+            kernel_releases=kernel_releases,
+        )
+
+        # The install manifest and overlay go in one extra layer on top.
+        metadata_root = Path(tempdir) / "metadata"
+        manifest_target = metadata_root / AKMODS_INSTALL_MANIFEST_PATH
+        manifest_target.parent.mkdir(parents=True)
+        shutil.copy2(merged_root / AKMODS_INSTALL_MANIFEST_PATH, manifest_target)
+        if overlay_kernels:
+            shutil.move(merged_root / AKMODS_KMOD_OVERLAY_DIR, metadata_root / AKMODS_KMOD_OVERLAY_DIR)
+        metadata_layer_path = Path(tempdir) / "metadata-layer.tar.gz"
+        layer_digest, diff_id = write_reproducible_layer(metadata_root, metadata_layer_path)
+        target = parse_image_ref(target_ref)
+        layers.append(
+            ImageLayer(
+                media_type=OCI_LAYER_GZIP_MEDIA_TYPE,
+                digest=layer_digest,
+                size=metadata_layer_path.stat().st_size,
+                diff_id=diff_id,
+                source=target,
+            )
+        )
+        config = image_config(
+            labels=shared_cache_labels(kernel_releases),
+            diff_ids=[layer.diff_id for layer in layers],
+            architecture=architecture,
+        )
+        manifest_bytes = image_manifest(config=config, layers=[layer.descriptor() for layer in layers])
+        # Same tags as the rebuild mode: `main-<fedora>` is what the workflow
+        # consumes, `main-<fedora>-x86_64` mirrors upstream naming.
+        tags = [f"{shared_tag}-{arch}", shared_tag]
+        stale_refs = refs_not_at_digest(
+            [f"docker://{target.name}:{tag}" for tag in tags],
+            sha256_digest(manifest_bytes),
+        )
+        if stale_refs:
+            client = registry_client()
+            for blob in (metadata_layer_path.read_bytes(), config):
+                if not client.blob_exists(target, sha256_digest(blob), creds=creds):
+                    client.push_blob(target, blob, creds=creds)
+                    PUBLISH_UPLOADS.record_blob(len(blob))
+            manifest_bytes = push_assembled_image(
+                target_ref,
+                tags=[ref.rsplit(":", 1)[1] for ref in stale_refs],
+                layers=layers,
+                config=config,
+                client=client,
+                creds=creds,
+            )
+            PUBLISH_UPLOADS.record_manifests(len(stale_refs), len(manifest_bytes) * len(stale_refs))
+            for stale_ref in stale_refs:
+                # Later steps in this job must see the image we just published.
+                registry_metadata_cache().invalidate(stale_ref)
+            print(
+                f"Assembled shared akmods cache from {len(layers)} layers "
+                f"(uploaded only the metadata layer, config, and manifest)."
+            )
+        else:
+            print(f"Shared akmods cache is unchanged ({sha256_digest(manifest_bytes)}); skipping push.")
+
+    print(
+        "Published merged shared akmods cache: "
+        f"ghcr.io/{image_org}/{akmods_repo}:{shared_tag}"
     )
-    return "\n".join(lines)
 
 
-def merge_and_push_shared_cache_image(*, kernel_releases: list[str]) -> None:
+def merge_and_push_shared_cache_image(
+    *,
+    kernel_releases: list[str],
+    reused_image_refs: dict[str, str] | None = None,
+) -> None:
     """
     Build and push one shared cache image that contains RPMs for every kernel.
 
@@ -281,7 +917,27 @@ def merge_and_push_shared_cache_image(*, kernel_releases: list[str]) -> None:
     layout assumes one kernel per cache directory. We therefore merge the local
     per-kernel images into one scratch image ourselves and publish that as the
     Fedora-wide `main-<fedora>` tag consumed by later workflow steps.
+
+    Kernels listed in `reused_image_refs` are read from those registry refs
+    instead of local storage (see `build_missing_kernels_and_merge`).
+
+    An install manifest inside the image lets the compose helper skip RPM
+    header parsing.
+
+    With `AKMODS_MERGE_MODE=layers` the image is assembled from the pushed
+    per-kernel layers instead (see `merge_shared_cache_from_layers`); if the
+    registry cannot do that, this falls back to the rebuild below.
     """
+    if akmods_merge_mode() == "layers":
+        try:
+            merge_shared_cache_from_layers(
+                kernel_releases=kernel_releases,
+                reused_image_refs=reused_image_refs,
+            )
+            return
+        except RegistryError as exc:
+            print(f"Warning: layer-reuse merge failed ({exc}); rebuilding the shared cache image instead.")
+
     kernel_flavor = require_env("AKMODS_KERNEL")
     akmods_version = require_env("AKMODS_VERSION")
     akmods_repo = require_env("AKMODS_REPO")
@@ -289,75 +945,62 @@ def merge_and_push_shared_cache_image(*, kernel_releases: list[str]) -> None:
     arch = run_cmd(["uname", "-m"]).strip()
 
     shared_tag = f"{kernel_flavor}-{akmods_version}"
-    local_shared_ref = f"localhost/{akmods_repo}:{shared_tag}"
-    local_shared_arch_ref = f"{local_shared_ref}-{arch}"
 
     with TemporaryDirectory(prefix="akmods-merge-") as tempdir:
         build_context = Path(tempdir)
 
         for kernel_release in kernel_releases:
             image_dir = build_context / f"image-{kernel_release}"
-            source_ref = (
-                f"containers-storage:localhost/{akmods_repo}:"
-                f"{kernel_flavor}-{akmods_version}-{kernel_release}"
-            )
-            # `containers-storage:` reads the image we just built locally.
-            # We unpack those local images and then republish one merged result.
-            skopeo_copy(source_ref, f"dir:{image_dir}")
+            reused_ref = (reused_image_refs or {}).get(kernel_release)
+            if reused_ref:
+                # Incremental rebuilds read unchanged kernels from the registry.
+                skopeo_copy(reused_ref, f"dir:{image_dir}", creds=optional_registry_creds())
+            else:
+                source_ref = (
+                    f"containers-storage:localhost/{akmods_repo}:"
+                    f"{kernel_flavor}-{akmods_version}-{kernel_release}"
+                )
+                # `containers-storage:` reads the image we just built locally.
+                # We unpack those local images and then republish one merged result.
+                skopeo_copy(source_ref, f"dir:{image_dir}")
             layer_files = load_layer_files_from_oci_layout(image_dir)
             unpack_layer_tarballs(layer_files, build_context)
 
-        missing = merged_cache_missing_kernel_releases(
+        overlay_kernels = prepare_shared_cache_metadata(
             merged_root=build_context,
             kernel_releases=kernel_releases,
         )
-        if missing:
-            raise CiToolError(
-                "Merged shared akmods cache is missing kernel RPMs for: "
-                + ", ".join(missing)
-            )
 
-        containerfile = build_context / "Containerfile"
-        containerfile.write_text(
-            render_shared_cache_containerfile(kernel_releases=kernel_releases),
-            encoding="utf-8",
+        # Write the merged image as a reproducible `dir:` layout and push from
+        # it, so the same RPMs always give the same image digest.
+        layout_dir = build_context / "shared-layout"
+        manifest_bytes = write_reproducible_image_layout(
+            layout_dir,
+            source_root=build_context,
+            layer_paths=shared_cache_layer_paths(include_kmod_overlay=bool(overlay_kernels)),
+            labels=shared_cache_labels(kernel_releases),
         )
+        image_digest = sha256_digest(manifest_bytes)
 
         # Tag both the shared Fedora-wide ref and the architecture-specific ref.
         # The workflow consumes `main-<fedora>`, while `main-<fedora>-x86_64`
         # stays available for direct inspection and parity with upstream naming.
-        run_cmd(
-            [
-                "podman",
-                "build",
-                "-f",
-                str(containerfile),
-                "-t",
-                local_shared_ref,
-                "-t",
-                local_shared_arch_ref,
-                str(build_context),
-            ],
-            capture_output=False,
-        )
-        run_cmd(
-            [
-                "podman",
-                "push",
-                local_shared_arch_ref,
-                f"docker://ghcr.io/{image_org}/{akmods_repo}:{shared_tag}-{arch}",
-            ],
-            capture_output=False,
-        )
-        run_cmd(
-            [
-                "podman",
-                "push",
-                local_shared_ref,
-                f"docker://ghcr.io/{image_org}/{akmods_repo}:{shared_tag}",
-            ],
-            capture_output=False,
-        )
+        remote_refs = [
+            f"docker://ghcr.io/{image_org}/{akmods_repo}:{shared_tag}-{arch}",
+            f"docker://ghcr.io/{image_org}/{akmods_repo}:{shared_tag}",
+        ]
+        stale_refs = refs_not_at_digest(remote_refs, image_digest)
+        if not stale_refs:
+            print(f"Shared akmods cache is unchanged ({image_digest}); skipping push.")
+        else:
+            # Upload the image once; every other tag only needs its manifest.
+            # `skopeo_copy` also drops any cached pre-push answer for the tag so
+            # later steps in this job see the image we just published.
+            record_layout_uploads(layout_dir, stale_refs[0])
+            skopeo_copy(f"dir:{layout_dir}", stale_refs[0])
+            PUBLISH_UPLOADS.record_manifests(1, len(manifest_bytes))
+            if stale_refs[1:]:
+                retag_published_image(stale_refs[0], stale_refs[1:])
 
     print(
         "Published merged shared akmods cache: "
@@ -389,26 +1032,19 @@ def main() -> None:
         os.environ["BUILDAH_LAYERS"] = "false"
         print("Disabled Buildah layer cache for single-kernel akmods rebuild.")
         run_cmd(["just", "login"], cwd=str(AKMODS_WORKTREE), capture_output=False)
-        build_and_push_kernel_release(
-            kernel_releases[0],
-            # Persistent self-hosted runners can retain stale RPMs in the old
-            # shared build root. Keep single-kernel rebuilds isolated too, then
-            # publish the Fedora-wide shared tag from that fresh per-kernel
-            # payload below.
-            shared_cache_path=False,
-        )
-        # Build the shared Fedora-wide cache image from the freshly built local
-        # per-kernel payload instead of relying on upstream `just manifest`.
+        # Persistent self-hosted runners can retain stale RPMs in the old
+        # shared build root. Keep single-kernel rebuilds isolated too, then
+        # build the shared Fedora-wide cache image from that fresh per-kernel
+        # payload instead of relying on upstream `just manifest`.
         #
         # On a persistent self-hosted runner, upstream manifest assembly can
         # pick up stale local tag state from prior kernels. Rebuilding the
         # shared cache image from the current local payload keeps the result
         # deterministic and matches the multi-kernel path below.
-        merge_and_push_shared_cache_image(kernel_releases=kernel_releases)
+        build_missing_kernels_and_merge(kernel_releases)
         return
 
-    # Authenticate once, then publish one kernel-specific payload at a time.
-    # This keeps the loop readable in logs and avoids repeated login churn.
+    # Authenticate once, then publish the kernel-specific payloads.
     #
     # Disable Buildah layer caching for the multi-kernel loop. Each iteration
     # binds in a different host-side cache directory, and reusing image layers
@@ -416,13 +1052,7 @@ def main() -> None:
     os.environ["BUILDAH_LAYERS"] = "false"
     print("Disabled Buildah layer cache for multi-kernel akmods rebuild.")
     run_cmd(["just", "login"], cwd=str(AKMODS_WORKTREE), capture_output=False)
-    for kernel_release in kernel_releases:
-        build_and_push_kernel_release(
-            kernel_release,
-            shared_cache_path=False,
-        )
-
-    merge_and_push_shared_cache_image(kernel_releases=kernel_releases)
+    build_missing_kernels_and_merge(kernel_releases)
 
 
 if __name__ == "__main__":
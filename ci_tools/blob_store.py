@@ -0,0 +1,401 @@
+"""
+Script: ci_tools/blob_store.py
+What: Runner-wide, content-addressed store for image blobs used by `dir:` layouts.
+Doing: Keeps verified blobs under their sha256 digest, hardlinks them into requested `dir:` layouts, downloads only blobs the store does not already hold, and evicts least-recently-used blobs under a byte budget.
+Why: Smoke tests and cache checks copy the same large layers into fresh temp directories on every run.
+Goal: Download each layer once per runner and keep the store from growing without bound.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+import time
+from typing import BinaryIO
+
+from ci_tools.common import CiToolError, skopeo_copy
+from ci_tools.registry_client import (
+    BlobReader,
+    RegistryClient,
+    native_registry_client_enabled,
+    parse_image_ref,
+    registry_client,
+)
+
+
+BLOB_STORE_DIR_ENV = "BLOB_STORE_DIR"
+BLOB_STORE_ENABLED_ENV = "BLOB_STORE_ENABLED"
+BLOB_STORE_MAX_GIB_ENV = "BLOB_STORE_MAX_GIB"
+DEFAULT_MAX_GIB = 20
+BYTES_PER_GIB = 1024**3
+STATS_FILE_NAME = "stats.json"
+# Jobs on one runner share the store, so stats updates take this file lock.
+STATS_LOCK_FILE_NAME = ".stats.lock"
+# Written by skopeo into every `dir:` layout; consumers only read manifest.json
+# and the blobs, but keeping it makes our layouts valid skopeo sources too.
+DIR_LAYOUT_VERSION = "Directory Transport Version: 1.1\n"
+COPY_CHUNK_BYTES = 1 << 20
+
+
+@dataclass
+class BlobStoreStats:
+    """Hit/miss counters for one process."""
+
+    hits: int = 0
+    misses: int = 0
+    bytes_reused: int = 0
+    bytes_fetched: int = 0
+
+
+@dataclass(frozen=True)
+class BlobStoreUsage:
+    """On-disk size of the store plus its lifetime hit counters."""
+
+    blob_count: int
+    total_bytes: int
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+@dataclass(frozen=True)
+class BlobEvictionSummary:
+    """Result of one budget-enforcement pass."""
+
+    removed_blobs: int
+    reclaimed_bytes: int
+
+
+def default_blob_store_dir() -> Path:
+    """
+    Return the default store directory.
+
+    Same placement rule as the registry metadata cache: persistent runner tool
+    cache first, then the usual per-user cache directory.
+    """
+
+    tool_cache = os.environ.get("RUNNER_TOOL_CACHE", "").strip()
+    if tool_cache:
+        return Path(tool_cache) / "kinoite-zfs" / "blobs"
+    xdg_cache = os.environ.get("XDG_CACHE_HOME", "").strip()
+    base = Path(xdg_cache) if xdg_cache else Path.home() / ".cache"
+    return base / "kinoite-zfs" / "blobs"
+
+
+def _hex_from_digest(digest: str) -> str:
+    algorithm, _, hex_digest = digest.partition(":")
+    if algorithm != "sha256" or len(hex_digest) != 64:
+        raise CiToolError(f"Blob store only accepts sha256 digests, got {digest!r}")
+    return hex_digest
+
+
+def _link_or_copy(source: Path, target: Path) -> None:
+    """Hardlink when source and target share a filesystem, else copy."""
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        target.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, target)
+    except OSError:
+        # `copyfile` uses copy_file_range/reflinks where the kernel allows.
+        shutil.copyfile(source, target)
+
+
+class BlobStore:
+    """
+    Content-addressed blob directory shared by every job on the runner.
+
+    Blobs live at `<root>/sha256/<hex>` and are only ever added after their
+    digest has been verified, with an atomic rename so concurrent jobs never
+    see half-written blobs. A blob's mtime is refreshed on every use so budget
+    eviction can drop the least-recently-used blobs first. Layouts receive
+    hardlinks, so evicting a blob never breaks a layout that is still in use.
+    """
+
+    def __init__(self, root: Path | None, *, max_bytes: int = DEFAULT_MAX_GIB * BYTES_PER_GIB) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = BlobStoreStats()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    @property
+    def _blob_dir(self) -> Path:
+        assert self.root is not None
+        return self.root / "sha256"
+
+    def blob_path(self, digest: str) -> Path:
+        return self._blob_dir / _hex_from_digest(digest)
+
+    def contains(self, digest: str) -> bool:
+        return self.enabled and self.blob_path(digest).is_file()
+
+    def link_into(self, digest: str, target: Path) -> bool:
+        """
+        Place a stored blob at `target`; return False (a miss) when absent.
+        """
+
+        if not self.enabled:
+            return False
+        path = self.blob_path(digest)
+        try:
+            _link_or_copy(path, target)
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.stats.misses += 1
+            return False
+        with self._lock:
+            self.stats.hits += 1
+            self.stats.bytes_reused += target.stat().st_size
+        return True
+
+    def insert_stream(self, digest: str, reader: BinaryIO | BlobReader) -> Path:
+        """
+        Copy one blob stream into the store after verifying its digest.
+
+        Returns the stored path. A digest mismatch raises and stores nothing.
+        """
+
+        expected_hex = _hex_from_digest(digest)
+        self._blob_dir.mkdir(parents=True, exist_ok=True)
+        hasher = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self._blob_dir, prefix=".incoming-", delete=False) as handle:
+            try:
+                for chunk in iter(lambda: reader.read(COPY_CHUNK_BYTES), b""):
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    handle.write(chunk)
+            except BaseException:
+                Path(handle.name).unlink(missing_ok=True)
+                raise
+        if hasher.hexdigest() != expected_hex:
+            Path(handle.name).unlink(missing_ok=True)
+            raise CiToolError(f"Blob digest mismatch: expected {digest}, got sha256:{hasher.hexdigest()}")
+        path = self.blob_path(digest)
+        os.replace(handle.name, path)
+        with self._lock:
+            self.stats.bytes_fetched += size
+        return path
+
+    def _blob_entries(self) -> list[tuple[Path, os.stat_result]]:
+        if not self.enabled or not self._blob_dir.is_dir():
+            return []
+        entries = []
+        for path in self._blob_dir.iterdir():
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _read_lifetime_stats(self) -> dict:
+        assert self.root is not None
+        try:
+            data = json.loads((self.root / STATS_FILE_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def flush_stats(self) -> None:
+        """
+        Add this process's hit/miss counters to the store's lifetime totals.
+
+        The read-modify-write of `stats.json` holds an exclusive `flock`, so
+        jobs flushing at the same time never drop each other's counts.
+        """
+
+        if not self.enabled or (self.stats.hits == 0 and self.stats.misses == 0):
+            return
+        assert self.root is not None
+        with self._lock:
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                with (self.root / STATS_LOCK_FILE_NAME).open("a") as lock_handle:
+                    fcntl.flock(lock_handle, fcntl.LOCK_EX)
+                    data = self._read_lifetime_stats()
+                    data["hits"] = int(data.get("hits") or 0) + self.stats.hits
+                    data["misses"] = int(data.get("misses") or 0) + self.stats.misses
+                    with tempfile.NamedTemporaryFile(
+                        "w",
+                        encoding="utf-8",
+                        dir=self.root,
+                        prefix=".stats-",
+                        delete=False,
+                    ) as handle:
+                        json.dump(data, handle)
+                    os.replace(handle.name, self.root / STATS_FILE_NAME)
+            except OSError as exc:
+                # Hit-rate reporting must never fail the job.
+                print(f"Warning: failed to write blob store stats: {exc}")
+                return
+            self.stats.hits = 0
+            self.stats.misses = 0
+
+    def usage(self) -> BlobStoreUsage:
+        """Return blob count, total size, and lifetime hit counters."""
+
+        entries = [
+            (path, stat)
+            for path, stat in self._blob_entries()
+            if not path.name.startswith(".")
+        ]
+        lifetime = self._read_lifetime_stats() if self.enabled else {}
+        return BlobStoreUsage(
+            blob_count=len(entries),
+            total_bytes=sum(stat.st_size for _path, stat in entries),
+            hits=int(lifetime.get("hits") or 0),
+            misses=int(lifetime.get("misses") or 0),
+        )
+
+    def evict_to_budget(
+        self,
+        *,
+        max_bytes: int | None = None,
+        incoming_grace_seconds: int = 3600,
+        now_timestamp: float | None = None,
+    ) -> BlobEvictionSummary:
+        """
+        Remove least-recently-used blobs until the store fits its byte budget.
+
+        Abandoned `.incoming-*` files from interrupted downloads are removed
+        once they are older than `incoming_grace_seconds`.
+        """
+
+        budget = self.max_bytes if max_bytes is None else max_bytes
+        now = time.time() if now_timestamp is None else now_timestamp
+        removed_blobs = 0
+        reclaimed_bytes = 0
+        blobs: list[tuple[Path, os.stat_result]] = []
+        for path, stat in self._blob_entries():
+            if path.name.startswith(".incoming-"):
+                if now - stat.st_mtime > incoming_grace_seconds:
+                    path.unlink(missing_ok=True)
+                    reclaimed_bytes += stat.st_size
+                continue
+            blobs.append((path, stat))
+
+        total_bytes = sum(stat.st_size for _path, stat in blobs)
+        for path, stat in sorted(blobs, key=lambda item: item[1].st_mtime):
+            if total_bytes <= budget:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= stat.st_size
+            reclaimed_bytes += stat.st_size
+            removed_blobs += 1
+        return BlobEvictionSummary(removed_blobs=removed_blobs, reclaimed_bytes=reclaimed_bytes)
+
+
+def copy_image_to_dir(
+    image_ref: str,
+    layout_dir: Path,
+    *,
+    creds: str | None = None,
+    store: BlobStore | None = None,
+    client: RegistryClient | None = None,
+) -> None:
+    """
+    Write a `skopeo copy ... dir:` compatible layout for one registry image.
+
+    The platform manifest is saved as `manifest.json` and each blob (config
+    plus layers) as `<hex digest>`. Blobs already in the store are hardlinked;
+    the rest are streamed from the registry into the store first.
+    """
+
+    blob_store = store or runner_blob_store()
+    registry = client or registry_client()
+    image = parse_image_ref(image_ref)
+    manifest = registry.resolve_platform_manifest(
+        image,
+        registry.get_manifest(image, creds=creds),
+        creds=creds,
+    )
+    manifest_json = manifest.json()
+    descriptors = [manifest_json.get("config") or {}, *(manifest_json.get("layers") or [])]
+
+    layout_dir.mkdir(parents=True, exist_ok=True)
+    for descriptor in descriptors:
+        digest = str(descriptor.get("digest") or "")
+        if not digest:
+            continue
+        target = layout_dir / _hex_from_digest(digest)
+        if blob_store.link_into(digest, target):
+            continue
+        with registry.open_blob(image, digest, creds=creds) as blob:
+            stored = blob_store.insert_stream(digest, blob)
+        _link_or_copy(stored, target)
+    (layout_dir / "manifest.json").write_bytes(manifest.body)
+    (layout_dir / "version").write_text(DIR_LAYOUT_VERSION, encoding="utf-8")
+
+
+def copy_image_to_dir_layout(source: str, destination: str, *, creds: str | None = None) -> None:
+    """
+    Drop-in for `skopeo_copy(source, "dir:<path>")` that goes through the store.
+
+    The store downloads through the native registry client, so this only
+    happens with `REGISTRY_CLIENT=native`. Otherwise, or when the store is
+    disabled or the source is not a registry reference, skopeo does the copy.
+    """
+
+    if not destination.startswith("dir:"):
+        raise CiToolError(f"Expected a dir: destination, got {destination}")
+    store = runner_blob_store()
+    if not native_registry_client_enabled() or not store.enabled or not source.startswith("docker://"):
+        skopeo_copy(source, destination, creds=creds)
+        return
+    copy_image_to_dir(source, Path(destination.removeprefix("dir:")), creds=creds, store=store)
+    store.flush_stats()
+    # Just-used blobs are the most recent, so this only trims older ones.
+    store.evict_to_budget()
+
+
+def _store_from_env() -> BlobStore:
+    enabled = os.environ.get(BLOB_STORE_ENABLED_ENV, "true").strip().lower()
+    if enabled in {"0", "false", "no", "off"}:
+        return BlobStore(None)
+
+    root_text = os.environ.get(BLOB_STORE_DIR_ENV, "").strip()
+    root = Path(root_text) if root_text else default_blob_store_dir()
+    max_gib_text = os.environ.get(BLOB_STORE_MAX_GIB_ENV, "").strip()
+    try:
+        max_gib = float(max_gib_text) if max_gib_text else DEFAULT_MAX_GIB
+    except ValueError:
+        max_gib = DEFAULT_MAX_GIB
+    return BlobStore(root, max_bytes=int(max(0.0, max_gib) * BYTES_PER_GIB))
+
+
+_BLOB_STORE: BlobStore | None = None
+
+
+def runner_blob_store() -> BlobStore:
+    """Return the process-wide blob store, configured from env on first use."""
+
+    global _BLOB_STORE
+    if _BLOB_STORE is None:
+        _BLOB_STORE = _store_from_env()
+    return _BLOB_STORE
+
+
+def set_runner_blob_store(store: BlobStore | None) -> None:
+    """Replace the process-wide blob store (tests use this to isolate state)."""
+
+    global _BLOB_STORE
+    _BLOB_STORE = store
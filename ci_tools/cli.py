@@ -13,6 +13,7 @@ import sys
 from collections.abc import Callable, Mapping
 
 from ci_tools.common import CiToolError
+from ci_tools.registry_cache import report_registry_cache_stats
 
 
 def command_map() -> dict[str, Callable[[], None]]:
@@ -91,6 +92,10 @@ def main(argv: list[str] | None = None) -> None:
         # Keep failures short and readable in workflow logs.
         print(str(exc), file=sys.stderr)
         raise SystemExit(1) from exc
+    finally:
+        # Registry lookups are the slowest part of the light commands, so show
+        # how much the shared metadata cache helped on every exit path.
+        report_registry_cache_stats()
 
 
 if __name__ == "__main__":
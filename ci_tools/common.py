@@ -8,24 +8,60 @@ Goal: Keep behavior consistent across all helper modules.
 
 from __future__ import annotations
 
+import bisect
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+import hashlib
 import json
 import os
+import posixpath
 import re
 import subprocess
 import tarfile
+import threading
+import time
 from pathlib import Path
-from typing import Callable, Literal, Mapping, Sequence
+from typing import Callable, Literal, Mapping, Sequence, TypeVar
+
+from ci_tools.registry_cache import registry_metadata_cache
+
+T = TypeVar("T")
 
 
 class CiToolError(RuntimeError):
     """Raised when a workflow helper script hits a known error condition."""
 
 
+class ImageNotFoundError(CiToolError):
+    """
+    Raised when a registry cleanly answers that an image reference does not exist.
+
+    Callers that treat "missing" as a normal outcome (cache probes, tag
+    candidates) catch only this type, so auth failures and network blips keep
+    surfacing as real errors instead of looking like a missing image.
+    """
+
+
 FEDORA_FROM_KERNEL_RE = re.compile(r".*fc([0-9]+).*")
 NATURAL_SORT_SPLIT_RE = re.compile(r"([0-9]+)")
 AKMODS_CACHE_METADATA_VERSION = "1"
 AKMODS_CACHE_METADATA_VERSION_LABEL = "io.github.danathar.kinoite-zfs.akmods.cache-format"
 AKMODS_CACHE_KERNEL_RELEASES_LABEL = "io.github.danathar.kinoite-zfs.akmods.kernel-releases"
+# Per-RPM name, kmod kernel release, and checksum, written into the shared cache
+# image by the merge step and read by the compose helper.
+AKMODS_INSTALL_MANIFEST_PATH = "rpms/kmods/zfs/install-manifest.json"
+AKMODS_INSTALL_MANIFEST_VERSION = 1
+# Ready-to-copy `<kernel_release>/...` module trees for the fallback kernels.
+AKMODS_KMOD_OVERLAY_DIR = "kmod-overlay"
+# Fragments skopeo prints when the registry answers 404 / MANIFEST_UNKNOWN /
+# NAME_UNKNOWN. Anything else (401, 5xx, DNS, TLS, a missing executable or
+# auth file) is not a clean "missing", so a bare "not found" is not a marker.
+IMAGE_NOT_FOUND_MARKERS = ("manifest unknown", "name unknown")
+HTTP_NOT_FOUND_RE = re.compile(r"\b404\b")
+TAG_LOOKUP_MODE_ENV = "TAG_LOOKUP_MODE"
+# OCI layer whiteouts: `.wh.<name>` deletes `<name>` from lower layers and
+# `.wh..wh..opq` hides every lower-layer entry in its directory.
+OCI_WHITEOUT_PREFIX = ".wh."
+OCI_OPAQUE_WHITEOUT = ".wh..wh..opq"
 
 
 def require_env(name: str) -> str:
@@ -118,6 +154,69 @@ def run_cmd(
     return result.stdout
 
 
+def run_cmd_bytes(args: Sequence[str]) -> bytes:
+    """
+    Run a command and return its raw stdout bytes.
+
+    Use this when the exact bytes matter (hashing a manifest, for example);
+    `run_cmd` decodes text and translates newlines.
+    """
+    try:
+        result = subprocess.run(list(args), check=True, capture_output=True)
+    except subprocess.CalledProcessError as exc:
+        stderr = (exc.stderr or b"").decode("utf-8", errors="replace").strip()
+        stdout = (exc.stdout or b"").decode("utf-8", errors="replace").strip()
+        details = stderr or stdout or str(exc)
+        raise CiToolError(f"Command failed: {' '.join(args)}\n{details}") from exc
+    return result.stdout
+
+
+# Serializes prefixed log lines from concurrently running commands.
+_PREFIXED_LOG_LOCK = threading.Lock()
+PREFIXED_LOG_TAIL_LINES = 40
+
+
+def run_cmd_with_log_prefix(
+    args: Sequence[str],
+    *,
+    prefix: str,
+    cwd: str | None = None,
+    env: Mapping[str, str] | None = None,
+) -> None:
+    """
+    Run a long command and stream its combined output as `[prefix] line`.
+
+    Several of these can run at once: every line is printed whole under one
+    lock, so logs interleave by line and each line names its command. On
+    failure the last output lines are repeated in the raised error.
+    """
+    command_env = None
+    if env is not None:
+        command_env = dict(os.environ)
+        command_env.update(env)
+    process = subprocess.Popen(
+        list(args),
+        cwd=cwd,
+        env=command_env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    assert process.stdout is not None
+    tail: list[str] = []
+    with process.stdout:
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            tail = [*tail[-(PREFIXED_LOG_TAIL_LINES - 1) :], line]
+            with _PREFIXED_LOG_LOCK:
+                print(f"[{prefix}] {line}", flush=True)
+    returncode = process.wait()
+    if returncode != 0:
+        details = "\n".join(tail) or f"exit {returncode}"
+        raise CiToolError(f"Command failed: {' '.join(args)}\n{details}")
+
+
 def run_json_cmd(args: Sequence[str]) -> dict:
     """Run a command that returns JSON and parse it."""
     output = run_cmd(args)
@@ -127,6 +226,71 @@ def run_json_cmd(args: Sequence[str]) -> dict:
         raise CiToolError(f"Expected JSON from command: {' '.join(args)}") from exc
 
 
+class _CancelledLookup(CiToolError):
+    """Internal marker for tasks skipped after another task failed."""
+
+
+def run_concurrently(
+    tasks: Mapping[str, Callable[[], T]],
+    *,
+    max_workers: int = 4,
+    title: str = "Lookup timings",
+) -> dict[str, T]:
+    """
+    Run independent lookups on a bounded thread pool and return results by name.
+
+    Fail-fast: the first task to raise cancels every task that has not started
+    yet, and that error is re-raised once running tasks finish. A one-line
+    timing breakdown is always printed, so slow lookups are easy to spot in
+    workflow logs. Tasks run threads, not processes, so they should spend their
+    time waiting on registries or subprocesses rather than on Python CPU work.
+    """
+
+    timings: dict[str, float] = {}
+    timings_lock = threading.Lock()
+    failed = threading.Event()
+
+    def _timed(name: str, task: Callable[[], T]) -> T:
+        # The failure flag is set from the failing worker itself, so a queued
+        # task can never slip past it between the failure and `cancel()`.
+        if failed.is_set():
+            raise _CancelledLookup(name)
+        started = time.monotonic()
+        try:
+            return task()
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            with timings_lock:
+                timings[name] = time.monotonic() - started
+
+    wall_started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks) or 1)))
+    futures: dict[str, Future[T]] = {
+        name: executor.submit(_timed, name, task) for name, task in tasks.items()
+    }
+    try:
+        wait(futures.values(), return_when=FIRST_EXCEPTION)
+        if failed.is_set():
+            for future in futures.values():
+                future.cancel()
+            for future in futures.values():
+                if future.cancelled() or not future.done():
+                    continue
+                error = future.exception()
+                if error is not None and not isinstance(error, _CancelledLookup):
+                    raise error
+        return {name: future.result() for name, future in futures.items()}
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        parts = [
+            f"{name}={timings[name]:.2f}s" if name in timings else f"{name}=cancelled"
+            for name in tasks
+        ]
+        print(f"{title}: {', '.join(parts)} (wall {time.monotonic() - wall_started:.2f}s)")
+
+
 def write_github_outputs(values: Mapping[str, str]) -> None:
     """
     Write step outputs for GitHub Actions.
@@ -158,40 +322,169 @@ def normalize_owner(owner: str) -> str:
     return owner.lower()
 
 
+def _native_registry_client(image_ref: str):
+    """
+    Return the pooled native registry client when it should serve `image_ref`.
+
+    `REGISTRY_CLIENT=native` opts in. Only `docker://` refs can be answered
+    natively; local transports always stay on skopeo. The import is deferred
+    because `registry_client` itself depends on this module.
+    """
+
+    if not image_ref.startswith("docker://"):
+        return None
+    from ci_tools.registry_client import native_registry_client_enabled, registry_client
+
+    if not native_registry_client_enabled():
+        return None
+    return registry_client()
+
+
+def _is_image_not_found_message(message: str) -> bool:
+    """True when command output says the registry has no such image."""
+
+    # Only inspect the error details, not the echoed command line, so a ref
+    # that happens to contain "404" is never misread as a 404 answer.
+    details = message.split("\n", 1)[1] if "\n" in message else message
+    lowered = details.lower()
+    if any(marker in lowered for marker in IMAGE_NOT_FOUND_MARKERS):
+        return True
+    return HTTP_NOT_FOUND_RE.search(lowered) is not None
+
+
+def _classify_registry_error(exc: CiToolError, image_ref: str) -> CiToolError:
+    """Turn a failed skopeo call into `ImageNotFoundError` when it was a clean 404."""
+
+    if isinstance(exc, ImageNotFoundError):
+        return exc
+    if _is_image_not_found_message(str(exc)):
+        return ImageNotFoundError(f"Image not found: {image_ref}\n{exc}")
+    return exc
+
+
 def skopeo_inspect_json(image_ref: str, *, creds: str | None = None) -> dict:
     """
     Return JSON metadata for one image reference.
 
     `skopeo` reads image metadata directly from the registry without pulling and
-    running a container image.
+    running a container image. When the native registry client is enabled it
+    answers instead, reusing pooled connections and cached tokens. Successful
+    answers go through the shared registry metadata cache, so repeated lookups
+    of the same ref within one job (or across jobs on the self-hosted runner)
+    skip the registry round-trip. A missing image raises `ImageNotFoundError`.
     """
-    command = ["skopeo", "inspect"]
-    if creds:
-        command.extend(["--creds", creds])
-    command.append(image_ref)
-    return run_json_cmd(command)
+
+    def _inspect() -> dict:
+        client = _native_registry_client(image_ref)
+        if client is not None:
+            return client.inspect(image_ref, creds=creds)
+        command = ["skopeo", "inspect"]
+        if creds:
+            command.extend(["--creds", creds])
+        command.append(image_ref)
+        try:
+            return run_json_cmd(command)
+        except CiToolError as exc:
+            raise _classify_registry_error(exc, image_ref) from exc
+
+    if not image_ref.startswith("docker://"):
+        return _inspect()
+    return registry_metadata_cache().lookup("inspect", image_ref, _inspect)
 
 
 def skopeo_inspect_digest(image_ref: str, *, creds: str | None = None) -> str:
-    """Return the image digest from `skopeo inspect` output."""
-    inspect_json = skopeo_inspect_json(image_ref, creds=creds)
-    digest = str(inspect_json.get("Digest") or "")
-    if not digest:
-        raise CiToolError(f"Missing digest in skopeo inspect output for {image_ref}")
-    return digest
+    """
+    Return the manifest digest for one image reference.
+
+    Only the top-level manifest is read: a `HEAD` request with the native
+    client, or `skopeo inspect --raw` plus a local sha256 otherwise. The config
+    blob is never downloaded. The digest matches what `skopeo inspect` reports
+    as `Digest` (the index digest for multi-arch images). A missing image
+    raises `ImageNotFoundError`; every other failure keeps its original error.
+    """
+
+    def _digest() -> str:
+        client = _native_registry_client(image_ref)
+        if client is not None:
+            return client.digest(image_ref, creds=creds)
+        command = ["skopeo", "inspect", "--raw"]
+        if creds:
+            command.extend(["--creds", creds])
+        command.append(image_ref)
+        try:
+            # Hash the exact bytes the registry served; decoding as text would
+            # translate newlines and change the digest.
+            raw_manifest = run_cmd_bytes(command)
+        except CiToolError as exc:
+            raise _classify_registry_error(exc, image_ref) from exc
+        if not raw_manifest.strip():
+            raise CiToolError(f"Empty manifest from skopeo inspect --raw for {image_ref}")
+        return "sha256:" + hashlib.sha256(raw_manifest).hexdigest()
+
+    if not image_ref.startswith("docker://"):
+        return _digest()
+
+    cache = registry_metadata_cache()
+    # A full inspect answer from earlier in this job already carries the digest.
+    cached_inspect = cache.get("inspect", image_ref)
+    if isinstance(cached_inspect, dict) and cached_inspect.get("Digest"):
+        return str(cached_inspect["Digest"])
+    return cache.lookup("digest", image_ref, _digest)
 
 
 def skopeo_exists(image_ref: str, *, creds: str | None = None) -> bool:
-    """True when the given image tag exists in the registry."""
-    command = ["skopeo", "inspect"]
-    if creds:
-        command.extend(["--creds", creds])
-    command.append(image_ref)
+    """
+    True when the given image reference exists in the registry.
+
+    Returns False only when the registry cleanly reports the image as missing.
+    Auth, network, and server errors are raised so a transient blip never looks
+    like a missing cache (which would trigger a needless rebuild).
+    """
     try:
-        run_cmd(command)
-        return True
-    except CiToolError:
+        skopeo_inspect_digest(image_ref, creds=creds)
+    except ImageNotFoundError:
         return False
+    return True
+
+
+def tag_list_lookup_enabled() -> bool:
+    """
+    True when `TAG_LOOKUP_MODE=list` asks tag selection to use tag lists.
+
+    The default (`probe`) resolves each candidate tag with its own digest
+    lookup; `list` fetches the repository tag list once and only resolves tags
+    that are known to exist.
+    """
+
+    return optional_env(TAG_LOOKUP_MODE_ENV, "probe").strip().lower() == "list"
+
+
+def skopeo_list_tags(repository_ref: str, *, creds: str | None = None) -> list[str]:
+    """
+    Return every tag in one repository (`docker://host/name`).
+
+    Pagination is handled by skopeo or the native client. Answers go through
+    the registry metadata cache under the same tag TTL as other tag answers,
+    so when that TTL is enabled one job fetches a large tag list at most once.
+    """
+
+    def _list_tags() -> list[str]:
+        client = _native_registry_client(repository_ref)
+        if client is not None:
+            return client.list_tags(repository_ref, creds=creds)
+        command = ["skopeo", "list-tags"]
+        if creds:
+            command.extend(["--creds", creds])
+        command.append(repository_ref)
+        try:
+            data = run_json_cmd(command)
+        except CiToolError as exc:
+            raise _classify_registry_error(exc, repository_ref) from exc
+        return [str(tag) for tag in data.get("Tags") or []]
+
+    if not repository_ref.startswith("docker://"):
+        return _list_tags()
+    return registry_metadata_cache().lookup("tags", repository_ref, _list_tags)
 
 
 def skopeo_copy(
@@ -200,13 +493,24 @@ def skopeo_copy(
     *,
     creds: str | None = None,
     retry_times: int = 3,
+    dest_compress: bool = False,
 ) -> None:
     """Copy an image between registry references using skopeo."""
     command = ["skopeo", "copy", "--retry-times", str(retry_times)]
+    if dest_compress:
+        # `dir:` destinations are written uncompressed by default; compress
+        # them so the saved layer blobs are byte-identical to what gets pushed.
+        command.append("--dest-compress")
     if creds:
         command.extend(["--src-creds", creds, "--dest-creds", creds])
     command.extend([source, destination])
-    run_cmd(command, capture_output=False)
+    try:
+        run_cmd(command, capture_output=False)
+    finally:
+        # The destination tag may now point somewhere new (or be half-written
+        # after a failure), so never answer later lookups from a stale entry.
+        if destination.startswith("docker://"):
+            registry_metadata_cache().invalidate(destination)
 
 
 def _inspection_tar_filter(
@@ -230,6 +534,96 @@ def _inspection_tar_filter(
         raise
 
 
+def _normalize_layer_path(name: str) -> str:
+    """Normalize one tar member name to a relative POSIX path (`./usr/` -> `usr`)."""
+
+    path = posixpath.normpath(name.lstrip("/"))
+    return "" if path == "." else path
+
+
+def _drop_subtree(
+    surviving: dict[str, tuple[int, int]],
+    ordered_paths: list[str],
+    path: str,
+) -> None:
+    """
+    Remove `path` and everything below it.
+
+    Layers do not have to list a directory before its contents, so any path
+    may turn out to be a directory; the `prefix/` scan always runs.
+    `ordered_paths` holds the keys of `surviving` in sorted order, which keeps
+    everything under one prefix contiguous and the scan a bisect.
+    """
+
+    if surviving.pop(path, None) is not None:
+        del ordered_paths[bisect.bisect_left(ordered_paths, path)]
+    prefix = f"{path}/" if path else ""
+    start = end = bisect.bisect_left(ordered_paths, prefix)
+    while end < len(ordered_paths) and ordered_paths[end].startswith(prefix):
+        end += 1
+    for candidate in ordered_paths[start:end]:
+        del surviving[candidate]
+    del ordered_paths[start:end]
+
+
+def _keep_member(
+    surviving: dict[str, tuple[int, int]],
+    ordered_paths: list[str],
+    path: str,
+    member: tuple[int, int],
+) -> None:
+    if path not in surviving:
+        bisect.insort(ordered_paths, path)
+    surviving[path] = member
+
+
+def surviving_layer_members(layer_files: list[Path]) -> dict[str, tuple[int, int]]:
+    """
+    Compute the final merged file set of an image from its layer headers.
+
+    Returns `path -> (layer_index, member_offset)` for the one tar member that
+    ends up visible at each path after applying every layer bottom-to-top with
+    OCI semantics: later entries replace earlier ones, a non-directory replaces
+    a whole lower directory tree, `.wh.<name>` deletes `<name>` (and anything
+    below it), and `.wh..wh..opq` hides all lower-layer entries in its
+    directory. Whiteouts only affect lower layers, never their own layer.
+    Only headers are read; no member data is written.
+    """
+
+    surviving: dict[str, tuple[int, int]] = {}
+    ordered_paths: list[str] = []
+    for layer_index, layer_file in enumerate(layer_files):
+        opaque_directories: list[str] = []
+        deletions: list[str] = []
+        additions: list[tuple[str, tarfile.TarInfo]] = []
+        with tarfile.open(layer_file, "r") as tar:
+            for member in tar:
+                path = _normalize_layer_path(member.name)
+                if not path:
+                    continue
+                parent, name = posixpath.split(path)
+                if name == OCI_OPAQUE_WHITEOUT:
+                    opaque_directories.append(parent)
+                elif name.startswith(OCI_WHITEOUT_PREFIX):
+                    deletions.append(posixpath.join(parent, name.removeprefix(OCI_WHITEOUT_PREFIX)))
+                else:
+                    additions.append((path, member))
+
+        for directory in opaque_directories:
+            # Keep the directory entry itself; hide only its lower contents.
+            kept = surviving.get(directory)
+            _drop_subtree(surviving, ordered_paths, directory)
+            if kept is not None:
+                _keep_member(surviving, ordered_paths, directory, kept)
+        for deleted in deletions:
+            _drop_subtree(surviving, ordered_paths, deleted)
+        for path, member in additions:
+            if not member.isdir():
+                _drop_subtree(surviving, ordered_paths, path)
+            _keep_member(surviving, ordered_paths, path, (layer_index, member.offset))
+    return surviving
+
+
 def unpack_layer_tarballs(
     layer_files: list[Path],
     destination: Path,
@@ -239,6 +633,11 @@ def unpack_layer_tarballs(
     """
     Extract image layer tar files into one filesystem tree.
 
+    The unpack runs in two phases. First every layer's headers are read to
+    compute the merged file set (see `surviving_layer_members`), honoring OCI
+    whiteouts. Then each layer extracts only its surviving entries, so every
+    path is written exactly once and files the image deleted never appear.
+
     We pass `filter="data"` so extraction is safer:
     - blocks absolute paths and parent-directory escapes
     - blocks unsafe link targets
@@ -249,12 +648,21 @@ def unpack_layer_tarballs(
     the files we validate, so inspection callers can skip those links while
     keeping the rest of the `data_filter` protections.
     """
-    for layer_file in layer_files:
+    surviving = surviving_layer_members(layer_files)
+    wanted_by_layer: dict[int, set[int]] = {}
+    for layer_index, member_offset in surviving.values():
+        wanted_by_layer.setdefault(layer_index, set()).add(member_offset)
+
+    for layer_index, layer_file in enumerate(layer_files):
+        wanted = wanted_by_layer.get(layer_index)
+        if not wanted:
+            continue
         with tarfile.open(layer_file, "r") as tar:
             extract_filter: Literal["data"] | Callable[[tarfile.TarInfo, str], tarfile.TarInfo | None] = "data"
             if allow_unsafe_links:
                 extract_filter = _inspection_tar_filter
-            tar.extractall(destination, filter=extract_filter)
+            members = [member for member in tar.getmembers() if member.offset in wanted]
+            tar.extractall(destination, members=members, filter=extract_filter)
 
 
 def load_layer_files_from_oci_layout(image_dir: Path) -> list[Path]:
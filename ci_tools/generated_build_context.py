@@ -21,6 +21,9 @@ CANONICAL_CONTAINERFILE = Path("containerfiles/zfs-akmods/Containerfile")
 CANONICAL_FILES_DIR = Path("files")
 CANONICAL_MODULES_DIR = Path("modules")
 CANONICAL_COSIGN_PUB = Path("cosign.pub")
+# Stdlib-only RPM header reader that the compose-time helper imports when it
+# sits next to it inside the image build.
+CANONICAL_RPM_HEADER_MODULE = Path("ci_tools/rpm_header.py")
 
 # Generated workspace used only inside one job workspace.
 # "Generated workspace" here means a transient directory created during CI that
@@ -94,6 +97,7 @@ def prepare_generated_build_context(config: BuildContextConfig) -> None:
     _require_path(CANONICAL_CONTAINERFILE, kind="containerfile")
     _require_path(CANONICAL_FILES_DIR, kind="files directory")
     _require_path(CANONICAL_COSIGN_PUB, kind="public signing key")
+    _require_path(CANONICAL_RPM_HEADER_MODULE, kind="RPM header module")
 
     if GENERATED_WORKSPACE_DIR.exists():
         shutil.rmtree(GENERATED_WORKSPACE_DIR)
@@ -106,6 +110,10 @@ def prepare_generated_build_context(config: BuildContextConfig) -> None:
     # Containerfile. That lets the snippet keep small companion helpers nearby
     # without forcing CI to mutate or synthesize them later.
     _copy_tree(CANONICAL_CONTAINERFILE.parent, GENERATED_CONTAINERFILE.parent)
+    shutil.copy2(
+        CANONICAL_RPM_HEADER_MODULE,
+        GENERATED_CONTAINERFILE.parent / CANONICAL_RPM_HEADER_MODULE.name,
+    )
     _copy_tree(CANONICAL_FILES_DIR, GENERATED_FILES_DIR)
     shutil.copy2(CANONICAL_COSIGN_PUB, GENERATED_COSIGN_PUB)
 
@@ -1,34 +1,49 @@
 """
 Script: ci_tools/main_check_candidate_akmods_cache.py
 What: Checks whether akmods cache can be reused for the current base-image kernels.
-Doing: Prefers lightweight metadata labels on the shared cache image and falls back to unpacking layers when older images do not expose that metadata.
+Doing: Prefers lightweight metadata labels on the shared cache image and falls back to reading cached kmod RPM headers from the image layers (streamed natively or copied with skopeo) when older images do not expose them.
 Why: Skip rebuild when safe, but rebuild when any required module set is stale.
 Goal: Control main-workflow rebuild decisions.
 """
 
 from __future__ import annotations
+from contextlib import closing
 from dataclasses import dataclass
+import posixpath
 import tempfile
 from pathlib import Path
+from typing import IO, Iterable, Iterator
 
 from ci_tools.common import (
     AKMODS_CACHE_KERNEL_RELEASES_LABEL,
     AKMODS_CACHE_METADATA_VERSION,
     AKMODS_CACHE_METADATA_VERSION_LABEL,
     CiToolError,
+    ImageNotFoundError,
     kernel_releases_from_env,
     load_layer_files_from_oci_layout,
     normalize_owner,
     optional_env,
     optional_registry_creds,
     require_env,
-    skopeo_copy,
-    skopeo_exists,
     skopeo_inspect_json,
     sort_kernel_releases,
     unpack_layer_tarballs,
     write_github_outputs,
 )
+from ci_tools.blob_store import copy_image_to_dir_layout
+from ci_tools.registry_client import (
+    ImageReference,
+    RegistryClient,
+    RegistryError,
+    native_registry_client_enabled,
+    parse_image_ref,
+    registry_client,
+)
+from ci_tools.rpm_header import RpmHeaderError, read_rpm_header_stream
+
+# Cached kmod RPMs live here inside the shared akmods cache image.
+KMOD_RPM_DIR = "rpms/kmods/zfs"
 
 
 @dataclass(frozen=True)
@@ -39,11 +54,15 @@ class AkmodsCacheStatus:
     `image_exists` tells us whether the source tag is present at all.
     `missing_releases` is the fail-closed list of kernels not covered by that
     image. A reusable cache must satisfy both conditions.
+    `digest` is the manifest digest the decision was made against (empty when
+    the image is missing), so later steps can pin the exact same content
+    without another registry lookup.
     """
 
     source_image: str
     image_exists: bool
     missing_releases: tuple[str, ...]
+    digest: str = ""
 
     @property
     def reusable(self) -> bool:
@@ -51,6 +70,22 @@ class AkmodsCacheStatus:
 
         return self.image_exists and not self.missing_releases
 
+    @property
+    def pinned_image(self) -> str:
+        """Digest-pinned form of `source_image`, or empty when no digest is known."""
+
+        if not self.digest:
+            return ""
+        return _pin_image_ref(self.source_image, self.digest)
+
+
+def _pin_image_ref(image_ref: str, digest: str) -> str:
+    """Swap the tag in `name:tag` for `@digest`; keep the ref unchanged without a digest."""
+
+    if not digest:
+        return image_ref
+    return f"{image_ref.rsplit(':', 1)[0]}@{digest}"
+
 
 def write_cache_status_outputs(status: AkmodsCacheStatus) -> None:
     """Write the cache result in both legacy and structured output forms."""
@@ -69,28 +104,147 @@ def write_cache_status_outputs(status: AkmodsCacheStatus) -> None:
             "status": status_name,
             "missing_releases": " ".join(status.missing_releases),
             "source_image": status.source_image,
+            "source_digest": status.digest,
         }
     )
 
 
-def _has_kernel_matching_rpm(root_dir: Path, kernel_release: str) -> bool:
-    # We only trust cache reuse when an RPM exists for this exact kernel string.
-    # If the cache only has RPMs for older kernels, that cache is "stale".
-    rpm_dir = root_dir / "rpms" / "kmods" / "zfs"
-    if not rpm_dir.exists():
-        return False
-    pattern = f"kmod-zfs-{kernel_release}-*.rpm"
-    return any(rpm_dir.glob(pattern))
+def _is_cached_kmod_rpm_path(path: str) -> bool:
+    """True for RPM files directly inside the cache image's kmod directory."""
+
+    directory, file_name = posixpath.split(posixpath.normpath(path.lstrip("/")))
+    return directory == KMOD_RPM_DIR and file_name.endswith(".rpm")
+
+
+def kernel_releases_in_layer_entries(
+    layers: Iterable[Iterable[str]],
+    kernel_releases: list[str],
+) -> tuple[set[str], int]:
+    """
+    Return `(found_releases, layers_scanned)` from per-layer kmod kernel releases.
+
+    Each layer yields the kernel releases its `kmod-zfs` RPMs were built for.
+    The scan stops as soon as every required kernel is covered, so the
+    remaining layers (and the rest of the current one) are never read.
+    """
+
+    wanted = set(kernel_releases)
+    found: set[str] = set()
+    layers_scanned = 0
+    if not wanted:
+        return found, layers_scanned
+    for entries in layers:
+        layers_scanned += 1
+        try:
+            for release in entries:
+                if release in wanted:
+                    found.add(release)
+                    if found == wanted:
+                        return found, layers_scanned
+        finally:
+            # Close streaming generators right away so an early stop drops the
+            # download instead of waiting for garbage collection.
+            close = getattr(entries, "close", None)
+            if close is not None:
+                close()
+    return found, layers_scanned
+
+
+def _kmod_kernel_release(name: str, stream: IO[bytes]) -> str | None:
+    """Return the kernel release a cached `kmod-zfs` RPM was built for, if any."""
+
+    try:
+        header = read_rpm_header_stream(stream)
+    except RpmHeaderError as exc:
+        # Fail closed: an unreadable RPM covers no kernel.
+        print(f"Ignoring unreadable cached RPM {name}: {exc}")
+        return None
+    return header.kernel_release_for_module() if header.name == "kmod-zfs" else None
+
+
+def _layer_kmod_kernel_releases(
+    client: RegistryClient,
+    image: ImageReference,
+    layer: dict,
+    *,
+    creds: str | None,
+) -> Iterator[str]:
+    """
+    Yield the kernel release of every `kmod-zfs` RPM in one cache layer blob.
+
+    Releases come from each RPM's own header (package name plus module path),
+    read straight off the layer stream; file names are never trusted and RPM
+    payloads are skipped without being written anywhere.
+    """
+
+    digest = str(layer.get("digest") or "")
+    with closing(client.iter_layer_files(image, digest, creds=creds)) as files:
+        for member, reader in files:
+            if reader is None or not _is_cached_kmod_rpm_path(member.name):
+                continue
+            release = _kmod_kernel_release(member.name, reader)
+            if release:
+                yield release
+
+
+def _scan_cache_layers_for_kernel_rpms(
+    image_ref: str,
+    kernel_releases: list[str],
+    *,
+    client: RegistryClient | None = None,
+    creds: str | None = None,
+) -> tuple[str, ...]:
+    """
+    Return required kernels without a cached RPM by streaming cache layers.
+
+    Only tar headers and the RPM headers of cached kmods are read; no RPM data
+    is written to disk.
+    """
+
+    registry = client or registry_client()
+    image = parse_image_ref(image_ref)
+    try:
+        layers = registry.image_layers(image, creds=creds)
+        found, layers_scanned = kernel_releases_in_layer_entries(
+            (_layer_kmod_kernel_releases(registry, image, layer, creds=creds) for layer in layers),
+            kernel_releases,
+        )
+    except RegistryError as exc:
+        raise CiToolError(f"Failed to scan akmods cache layers in {image_ref}: {exc}") from exc
+    print(f"Scanned {layers_scanned} of {len(layers)} cache layers for kmod RPM headers in {image_ref}.")
+    return tuple(release for release in kernel_releases if release not in found)
 
 
-def _missing_kernel_releases(root_dir: Path, kernel_releases: list[str]) -> list[str]:
+def _unpack_cache_layers_for_kernel_rpms(
+    image_ref: str,
+    kernel_releases: list[str],
+    *,
+    creds: str | None = None,
+) -> tuple[str, ...]:
     """
-    Return kernel releases that do not have a matching cached kmod RPM.
+    Return required kernels without a cached RPM by unpacking the cache image.
 
-    This keeps the main workflow fail-closed: one missing kernel means the cache
-    is not good enough for the current base image.
+    This is the path used unless `REGISTRY_CLIENT=native` is set: the image
+    is copied to a `dir:` layout, its layers are extracted, and the cached
+    kmod RPM headers are read from disk. The copy goes through the runner
+    blob store like every other `dir:` copy.
     """
-    return [release for release in kernel_releases if not _has_kernel_matching_rpm(root_dir, release)]
+
+    found: set[str] = set()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        akmods_dir = root / "akmods"
+        # A `dir:<path>` layout saves image layers so we can inspect files.
+        copy_image_to_dir_layout(image_ref, f"dir:{akmods_dir}", creds=creds)
+        unpack_layer_tarballs(load_layer_files_from_oci_layout(akmods_dir), root)
+        rpm_dir = root / KMOD_RPM_DIR
+        rpm_paths = sorted(rpm_dir.glob("*.rpm")) if rpm_dir.is_dir() else []
+        for rpm_path in rpm_paths:
+            with rpm_path.open("rb") as stream:
+                release = _kmod_kernel_release(rpm_path.name, stream)
+            if release:
+                found.add(release)
+    return tuple(release for release in kernel_releases if release not in found)
 
 
 def _kernel_releases_from_metadata_labels(inspect_json: dict) -> tuple[str, ...] | None:
@@ -147,21 +301,30 @@ def inspect_candidate_akmods_cache(
 
     This helper is shared by the main workflow and the read-only validation
     workflows so they all make the same cache-reuse decision.
+
+    Coverage comes from labels on the image when present, else from a
+    header-only scan of the image layers.
+
+    One metadata fetch answers existence, metadata version, and kernel
+    coverage together. A clean "not found" means the cache is missing; any
+    other registry error is raised so a network blip never forces a rebuild.
     """
 
     source_image = f"ghcr.io/{image_org}/{source_repo}:main-{fedora_version}"
     resolved_creds = creds if creds is not None else optional_registry_creds()
-    if not skopeo_exists(f"docker://{source_image}", creds=resolved_creds):
+    try:
+        inspect_json = skopeo_inspect_json(
+            f"docker://{source_image}",
+            creds=resolved_creds,
+        )
+    except ImageNotFoundError:
         return AkmodsCacheStatus(
             source_image=source_image,
             image_exists=False,
             missing_releases=tuple(kernel_releases),
         )
 
-    inspect_json = skopeo_inspect_json(
-        f"docker://{source_image}",
-        creds=resolved_creds,
-    )
+    digest = str(inspect_json.get("Digest") or "")
     metadata_kernel_releases = _kernel_releases_from_metadata_labels(inspect_json)
     if metadata_kernel_releases is not None:
         print(f"Using cache metadata labels from {source_image} for kernel coverage check.")
@@ -172,29 +335,28 @@ def inspect_candidate_akmods_cache(
                 kernel_releases,
                 metadata_kernel_releases,
             ),
+            digest=digest,
         )
 
     print(f"No cache metadata labels found on {source_image}; falling back to layer scan.")
-    with tempfile.TemporaryDirectory() as temp_dir:
-        root = Path(temp_dir)
-        akmods_dir = root / "akmods"
-        # `skopeo copy ... dir:<path>` saves image layers so we can inspect files.
-        skopeo_copy(
-            f"docker://{source_image}",
-            f"dir:{akmods_dir}",
+    # Scan by digest when known so the layers read are exactly the image that
+    # was inspected above, even if the tag moves in between. Streaming the
+    # layers needs the native registry client; otherwise skopeo copies them.
+    scan_layers = (
+        _scan_cache_layers_for_kernel_rpms
+        if native_registry_client_enabled()
+        else _unpack_cache_layers_for_kernel_rpms
+    )
+    return AkmodsCacheStatus(
+        source_image=source_image,
+        image_exists=True,
+        missing_releases=scan_layers(
+            f"docker://{_pin_image_ref(source_image, digest)}",
+            kernel_releases,
             creds=resolved_creds,
-        )
-
-        layer_files = load_layer_files_from_oci_layout(akmods_dir)
-        # Extract all filesystem layers into one temp tree for file checks.
-        unpack_layer_tarballs(layer_files, root)
-
-        missing_releases = _missing_kernel_releases(root, kernel_releases)
-        return AkmodsCacheStatus(
-            source_image=source_image,
-            image_exists=True,
-            missing_releases=tuple(missing_releases),
-        )
+        ),
+        digest=digest,
+    )
 
 
 def main() -> None:
@@ -234,8 +396,8 @@ def main() -> None:
         # `exists=true` means this cache can be safely reused.
         write_cache_status_outputs(status)
         print(
-            f"Found matching {status.source_image} kmods for kernels {' '.join(kernel_releases)}; "
-            "akmods rebuild can be skipped."
+            f"Found matching {status.pinned_image or status.source_image} kmods for kernels "
+            f"{' '.join(kernel_releases)}; akmods rebuild can be skipped."
         )
         return
 
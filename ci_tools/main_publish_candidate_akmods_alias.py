@@ -8,21 +8,43 @@ Goal: Keep candidate flow using the correct akmods content for this run.
 
 from __future__ import annotations
 
-from ci_tools.common import CiToolError, normalize_owner, require_env, skopeo_copy
+from collections.abc import Collection
 
+from ci_tools.common import (
+    CiToolError,
+    normalize_owner,
+    require_env,
+    skopeo_copy,
+    skopeo_exists,
+    skopeo_list_tags,
+    tag_list_lookup_enabled,
+)
+from ci_tools.registry_cache import registry_metadata_cache
 
-def kernel_source_tag_candidates(*, fedora_version: str, kernel_release: str) -> list[str]:
+
+def kernel_source_tag_candidates(
+    *,
+    fedora_version: str,
+    kernel_release: str,
+    available_tags: Collection[str] | None = None,
+) -> list[str]:
     """
     Build possible source tags for kernel-specific akmods content.
 
     We prefer the full kernel string (includes architecture suffix).
     Some upstream publish paths can also use a no-architecture variant, so we
     keep that as a fallback candidate.
+
+    When `available_tags` (the source repository tag list) is given, only
+    candidates present in that list are returned, in the same preference order.
     """
     candidates = [f"main-{fedora_version}-{kernel_release}"]
     if kernel_release.endswith(".x86_64") or kernel_release.endswith(".aarch64"):
         kernel_without_arch = kernel_release.rsplit(".", 1)[0]
         candidates.append(f"main-{fedora_version}-{kernel_without_arch}")
+    if available_tags is not None:
+        listed = set(available_tags)
+        candidates = [candidate for candidate in candidates if candidate in listed]
     return candidates
 
 
@@ -59,28 +81,45 @@ def main() -> None:
     destination_kernel_ref = (
         f"docker://ghcr.io/{image_org}/{dest_akmods_repo}:main-{fedora_version}-{kernel_release}"
     )
+    source_repo_ref = f"docker://ghcr.io/{image_org}/{source_akmods_repo}"
+    all_source_kernel_tags = kernel_source_tag_candidates(
+        fedora_version=fedora_version,
+        kernel_release=kernel_release,
+    )
+    # Tag-list mode: one tag-list request tells us which candidates exist, so
+    # no per-candidate probes are needed and a tag missing from the list is
+    # treated as absent. Probing is only used when the list cannot be fetched.
+    available_tags = None
+    if tag_list_lookup_enabled():
+        # The akmods push happened in an earlier step, so never reuse a tag
+        # list cached before it.
+        registry_metadata_cache().invalidate(source_repo_ref)
+        try:
+            available_tags = skopeo_list_tags(source_repo_ref, creds=creds)
+        except CiToolError as exc:
+            print(f"Warning: could not list {source_repo_ref} tags ({exc}); probing candidates instead.")
     source_kernel_tags = kernel_source_tag_candidates(
         fedora_version=fedora_version,
         kernel_release=kernel_release,
+        available_tags=available_tags,
     )
 
-    # Try candidates in order and stop on first success.
-    # Keep a readable list of failure messages so we can show exactly what was
-    # attempted if none of the possible source tags exist.
-    copy_errors: list[str] = []
+    # Probe candidates in order with a cheap digest lookup and copy only the
+    # first one that exists. A missing tag moves on to the next candidate; any
+    # other registry error (auth, network) stops here instead of being hidden
+    # behind a failed copy attempt.
     for source_kernel_tag in source_kernel_tags:
-        source_kernel_ref = f"docker://ghcr.io/{image_org}/{source_akmods_repo}:{source_kernel_tag}"
-        try:
-            skopeo_copy(source_kernel_ref, destination_kernel_ref, creds=creds)
-            print(f"Published candidate alias: {source_kernel_ref} -> {destination_kernel_ref}")
-            return
-        except CiToolError as exc:
-            copy_errors.append(f"{source_kernel_ref}: {exc}")
+        source_kernel_ref = f"{source_repo_ref}:{source_kernel_tag}"
+        if available_tags is None and not skopeo_exists(source_kernel_ref, creds=creds):
+            print(f"Candidate akmods source tag not found: {source_kernel_ref}")
+            continue
+        skopeo_copy(source_kernel_ref, destination_kernel_ref, creds=creds)
+        print(f"Published candidate alias: {source_kernel_ref} -> {destination_kernel_ref}")
+        return
 
-    joined_errors = "\n".join(copy_errors)
     raise CiToolError(
         "Failed to publish candidate kernel-matched akmods alias. "
-        f"Tried source tags: {', '.join(source_kernel_tags)}\n{joined_errors}"
+        f"None of these source tags exist: {', '.join(all_source_kernel_tags)}"
     )
 
 
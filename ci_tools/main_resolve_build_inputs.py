@@ -12,23 +12,40 @@ from dataclasses import dataclass
 import json
 import re
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Collection, Iterable, Iterator, cast
 
 from ci_tools.common import (
     CiToolError,
+    ImageNotFoundError,
     extract_fedora_version,
     optional_env,
     require_env,
     run_cmd,
+    run_concurrently,
     skopeo_inspect_digest,
     skopeo_inspect_json,
+    skopeo_list_tags,
     sort_kernel_releases,
+    tag_list_lookup_enabled,
     write_github_outputs,
 )
+from ci_tools.registry_client import (
+    ImageReference,
+    RegistryClient,
+    RegistryError,
+    parse_image_ref,
+    registry_client,
+)
 
 TAG_FROM_REF_RE = re.compile(r"^[^@]+:([^/@]+)$")
 DATE_STAMPED_TAG_RE = re.compile(r"-[0-9]{8}(\.[0-9]+)?$")
 VERSION_LABEL_RE = re.compile(r"^[0-9]+\.[0-9]{8}(\.[0-9]+)?$")
+KERNEL_DETECTION_ENV = "BASE_KERNEL_DETECTION"
+RESOLVE_MAX_WORKERS = 4
+MODULES_ROOTS = ("usr/lib/modules", "lib/modules")
+MODULES_ROOT_ANCESTORS = frozenset({"usr", "usr/lib", "usr/lib/modules"})
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
 
 
 @dataclass(frozen=True)
@@ -86,6 +103,7 @@ def choose_base_image_tag(
     fedora_version: str,
     expected_digest: str,
     digest_lookup: Callable[[str], str],
+    available_tags: Collection[str] | None = None,
 ) -> tuple[str, list[str]]:
     """
     Pick a stable base tag for this run.
@@ -94,6 +112,10 @@ def choose_base_image_tag(
     - If the source tag is already date-stamped, keep it.
     - Otherwise derive candidate tags from version label and choose the one
       that resolves to the expected digest.
+
+    When `available_tags` (the repository tag list) is given, only candidates
+    that are known to exist are resolved, plus any other tag ending in the same
+    date-stamped suffix. A tag missing from the list is treated as absent.
     """
     # If we already got a date-stamped tag, treat it as stable for this run.
     if source_tag and DATE_STAMPED_TAG_RE.search(source_tag):
@@ -114,6 +136,14 @@ def choose_base_image_tag(
     candidate_tags.extend([f"latest-{version_suffix}", f"{fedora_version}-{version_suffix}"])
     candidate_tags = list(dict.fromkeys(candidate_tags))
 
+    if available_tags is not None:
+        # Tag-list mode: filter locally so misses never cost a registry request.
+        listed = set(available_tags)
+        suffix_matches = sorted(tag for tag in listed if tag.endswith(f"-{version_suffix}"))
+        candidate_tags = [tag for tag in candidate_tags if tag in listed] + [
+            tag for tag in suffix_matches if tag not in candidate_tags
+        ]
+
     # Try each candidate tag and keep the first one that resolves to the same digest.
     # Digest match is the key safety check: tag text can move, digest does not.
     for candidate_tag in candidate_tags:
@@ -136,14 +166,152 @@ def _load_lock_file(lock_file_path: str) -> dict:
         return json.load(handle)
 
 
-def detect_base_image_kernel_releases(image_ref: str) -> list[str]:
+def _modules_relative_parts(path: str) -> tuple[str, ...] | None:
     """
-    Inspect the base image filesystem and return every installed kernel release.
+    Return path parts below the kernel modules root, or `None` outside it.
+
+    Fedora images store modules under `usr/lib/modules`; `/lib` is only a
+    symlink to `usr/lib`, but a few layers still write through `lib/modules`.
+    """
+
+    for root in MODULES_ROOTS:
+        if path == root:
+            return ()
+        if path.startswith(f"{root}/"):
+            return tuple(part for part in path[len(root) + 1 :].split("/") if part)
+    return None
+
+
+def kernel_releases_from_layer_entries(
+    layers: Iterable[Iterable[tuple[str, bool]]],
+) -> tuple[list[str], int]:
+    """
+    Compute the final `usr/lib/modules/<release>` directories from layer entries.
+
+    `layers` yields one iterable of `(path, is_dir)` tar entries per layer,
+    top-most layer first. Walking top-down lets the first layer that mentions a
+    release decide whether it survives, with OCI whiteout rules applied:
+    - `.wh.<release>` in `usr/lib/modules` deletes that release from lower layers
+    - an opaque marker or whiteout on `usr/lib/modules` (or `usr/lib`, `usr`)
+      hides every lower layer, so the scan stops right there
+
+    That masking layer is the only safe early stop: any lower layer may still
+    add another installonly kernel, so seeing the `ostree.linux` kernel proves
+    nothing about the rest. Rechunked Kinoite images never mask the modules
+    root, so in practice every layer is read.
 
-    We intentionally inspect `/lib/modules` from a real container view instead
-    of trusting a single metadata label, because installonly kernel packages
-    can leave more than one kernel in the final merged root filesystem.
+    Returns the sorted release list and how many layers were actually read.
     """
+
+    decided: dict[str, bool] = {}
+    layers_scanned = 0
+    for entries in layers:
+        layers_scanned += 1
+        layer_entries: dict[str, bool] = {}
+        layer_whiteouts: set[str] = set()
+        masks_lower_layers = False
+
+        for raw_path, is_dir in entries:
+            path = raw_path
+            while path.startswith("./"):
+                path = path[2:]
+            path = path.rstrip("/")
+            parent, _, name = path.rpartition("/")
+
+            if name == OPAQUE_WHITEOUT:
+                if parent in MODULES_ROOT_ANCESTORS:
+                    masks_lower_layers = True
+                else:
+                    parts = _modules_relative_parts(parent)
+                    if parts is not None and len(parts) == 1:
+                        # An opaque release dir still exists in this layer.
+                        layer_entries.setdefault(parts[0], True)
+                continue
+
+            if name.startswith(WHITEOUT_PREFIX):
+                hidden_name = name.removeprefix(WHITEOUT_PREFIX)
+                target = f"{parent}/{hidden_name}" if parent else hidden_name
+                if target in MODULES_ROOT_ANCESTORS:
+                    masks_lower_layers = True
+                    continue
+                parts = _modules_relative_parts(target)
+                if parts is not None and len(parts) == 1:
+                    layer_whiteouts.add(parts[0])
+                continue
+
+            parts = _modules_relative_parts(path)
+            if not parts:
+                continue
+            if len(parts) == 1:
+                layer_entries[parts[0]] = is_dir
+            else:
+                layer_entries.setdefault(parts[0], True)
+
+        # Entries in this layer win over its own whiteouts (whiteouts only
+        # hide lower layers), and upper layers win over this one.
+        for release, is_dir in layer_entries.items():
+            decided.setdefault(release, is_dir)
+        for release in layer_whiteouts:
+            decided.setdefault(release, False)
+        if masks_lower_layers:
+            break
+
+    releases = sort_kernel_releases([release for release, is_dir in decided.items() if is_dir])
+    return releases, layers_scanned
+
+
+def _stream_layer_entries(
+    client: RegistryClient,
+    image: ImageReference,
+    layer: dict,
+    *,
+    creds: str | None,
+) -> Iterator[tuple[str, bool]]:
+    """Yield `(path, is_dir)` for one layer blob, streaming headers only."""
+
+    digest = str(layer.get("digest") or "")
+    try:
+        for member in client.iter_layer_members(image, digest, creds=creds):
+            yield member.name, member.isdir()
+    except RegistryError as exc:
+        raise CiToolError(
+            f"{exc} ({layer.get('mediaType', 'unknown media type')}). "
+            f"Set {KERNEL_DETECTION_ENV}=podman to use the container-based path."
+        ) from exc
+
+
+def detect_kernel_releases_from_layers(
+    image_ref: str,
+    *,
+    client: RegistryClient | None = None,
+    creds: str | None = None,
+) -> list[str]:
+    """
+    List installed kernels by streaming layer tar headers from the registry.
+
+    No container storage, no container start, and no file contents on disk.
+    Layers are read top-most first. The scan can only stop early at a layer
+    that hides everything below `usr/lib/modules`; real base images have none,
+    so every layer is still downloaded and decompressed (just never unpacked).
+    """
+
+    registry = client or registry_client()
+    image = parse_image_ref(image_ref)
+    layers = registry.image_layers(image, creds=creds)
+    kernel_releases, layers_scanned = kernel_releases_from_layer_entries(
+        _stream_layer_entries(registry, image, layer, creds=creds)
+        for layer in reversed(layers)
+    )
+    print(
+        f"Scanned {layers_scanned} of {len(layers)} base image layers "
+        f"for kernel directories in {image_ref}."
+    )
+    return kernel_releases
+
+
+def _detect_kernel_releases_with_podman(image_ref: str) -> list[str]:
+    """List `/lib/modules` release directories by running the image once."""
+
     output = run_cmd(
         [
             "podman",
@@ -156,7 +324,33 @@ def detect_base_image_kernel_releases(image_ref: str) -> list[str]:
             "find /lib/modules -mindepth 1 -maxdepth 1 -type d -printf '%f\\n'",
         ]
     )
-    kernel_releases = sort_kernel_releases(output.splitlines())
+    return sort_kernel_releases(output.splitlines())
+
+
+def detect_base_image_kernel_releases(image_ref: str) -> list[str]:
+    """
+    Inspect the base image filesystem and return every installed kernel release.
+
+    We intentionally inspect `/lib/modules` from the real merged filesystem
+    instead of trusting a single metadata label, because installonly kernel
+    packages can leave more than one kernel in the final merged root filesystem.
+
+    `BASE_KERNEL_DETECTION=layers` streams layer headers from the registry
+    instead of pulling and running the image with podman (the default). The
+    native client does not read the podman/skopeo auth files, so a private or
+    rate-limited base image that it cannot read falls back to podman.
+    """
+    mode = optional_env(KERNEL_DETECTION_ENV, "podman").strip().lower() or "podman"
+    if mode == "layers":
+        try:
+            kernel_releases = detect_kernel_releases_from_layers(image_ref)
+        except CiToolError as exc:
+            print(f"Warning: layer-based kernel detection failed ({exc}); falling back to podman.")
+            kernel_releases = _detect_kernel_releases_with_podman(image_ref)
+    elif mode == "podman":
+        kernel_releases = _detect_kernel_releases_with_podman(image_ref)
+    else:
+        raise CiToolError(f"Unsupported {KERNEL_DETECTION_ENV} value: {mode} (expected podman or layers)")
     if not kernel_releases:
         raise CiToolError(f"No installed kernel directories found in {image_ref}")
     return kernel_releases
@@ -256,37 +450,86 @@ def resolve_build_inputs() -> BuildInputResolution:
         raise CiToolError(f"Failed to read ostree.linux label from {base_image_ref}")
 
     base_image_pinned = f"{base_image_name}@{base_image_digest}"
-    kernel_releases = detect_base_image_kernel_releases(base_image_pinned)
-    kernel_release = kernel_releases[-1]
-    fedora_version = extract_fedora_version(kernel_release)
     source_tag = extract_source_tag(base_image_ref)
 
     # Helper function:
-    # input tag -> lookup digest in registry.
-    # Return empty string when lookup fails so tag selection can continue.
+    # input tag -> lookup digest in registry (manifest digest only, no config).
+    # Return empty string when the tag does not exist so tag selection can
+    # continue. Auth and network failures still stop the run with a real error.
     def lookup_digest(candidate_tag: str) -> str:
         candidate_ref = f"docker://{base_image_name}:{candidate_tag}"
         try:
             return skopeo_inspect_digest(candidate_ref)
-        except CiToolError:
+        except ImageNotFoundError:
             return ""
 
-    base_image_tag, candidate_tags = choose_base_image_tag(
-        source_tag=source_tag,
-        version_label=base_image_version_label,
-        fedora_version=fedora_version,
-        expected_digest=base_image_digest,
-        digest_lookup=lookup_digest,
-    )
-
-    # Final safety check: chosen tag must still match the expected digest.
-    selected_tag_digest = lookup_digest(base_image_tag)
-    if selected_tag_digest != base_image_digest:
-        raise CiToolError(
-            f"Resolved tag {base_image_name}:{base_image_tag} does not match digest {base_image_digest}"
+    def select_base_image_tag(fedora_version: str) -> tuple[str, list[str]]:
+        available_tags = None
+        if tag_list_lookup_enabled() and not DATE_STAMPED_TAG_RE.search(source_tag):
+            # Without a list, tag selection probes each candidate instead.
+            try:
+                available_tags = skopeo_list_tags(f"docker://{base_image_name}")
+            except CiToolError as exc:
+                print(f"Warning: could not list {base_image_name} tags ({exc}); probing candidates instead.")
+        base_image_tag, candidate_tags = choose_base_image_tag(
+            source_tag=source_tag,
+            version_label=base_image_version_label,
+            fedora_version=fedora_version,
+            expected_digest=base_image_digest,
+            digest_lookup=lookup_digest,
+            available_tags=available_tags,
         )
 
-    build_container_inspect = skopeo_inspect_json(f"docker://{build_container_ref}")
+        # Final safety check: chosen tag must still match the expected digest.
+        selected_tag_digest = lookup_digest(base_image_tag)
+        if selected_tag_digest != base_image_digest:
+            raise CiToolError(
+                f"Resolved tag {base_image_name}:{base_image_tag} does not match digest {base_image_digest}"
+            )
+        return base_image_tag, candidate_tags
+
+    # Kernel detection (slow), base tag probing, and the build container
+    # inspect do not depend on each other, so run them side by side. Tag
+    # probing needs the Fedora major version before kernel detection finishes;
+    # the `ostree.linux` label provides it and is cross-checked below.
+    try:
+        label_fedora_version = extract_fedora_version(label_kernel_release)
+    except CiToolError:
+        label_fedora_version = ""
+
+    lookups: dict[str, Callable[[], object]] = {
+        "base-kernels": lambda: detect_base_image_kernel_releases(base_image_pinned),
+        "build-container": lambda: skopeo_inspect_json(f"docker://{build_container_ref}"),
+    }
+
+    def select_tag_from_label() -> tuple[str, list[str]] | CiToolError:
+        # The label's Fedora version is only a guess until kernel detection
+        # confirms it, so a failure here is returned, not raised, and only
+        # counts if the guess turns out to be right.
+        try:
+            return select_base_image_tag(label_fedora_version)
+        except CiToolError as exc:
+            return exc
+
+    if label_fedora_version:
+        lookups["base-tag"] = select_tag_from_label
+    results = run_concurrently(lookups, max_workers=RESOLVE_MAX_WORKERS)
+
+    # The lookups return different types, so each result is cast once here.
+    kernel_releases = cast(list[str], results["base-kernels"])
+    kernel_release = kernel_releases[-1]
+    fedora_version = extract_fedora_version(kernel_release)
+    if label_fedora_version == fedora_version:
+        label_tag_result = cast(tuple[str, list[str]] | CiToolError, results["base-tag"])
+        if isinstance(label_tag_result, CiToolError):
+            raise label_tag_result
+        base_image_tag, candidate_tags = label_tag_result
+    else:
+        # Label and filesystem disagree (or the label had no Fedora suffix):
+        # redo tag selection with the version from the detected kernels.
+        base_image_tag, candidate_tags = select_base_image_tag(fedora_version)
+
+    build_container_inspect = cast(dict, results["build-container"])
     build_container_name = str(build_container_inspect.get("Name") or "")
     build_container_digest = str(build_container_inspect.get("Digest") or "")
 
@@ -16,6 +16,7 @@ from tempfile import TemporaryDirectory
 import re
 import tarfile
 
+from ci_tools.blob_store import copy_image_to_dir_layout
 from ci_tools.common import (
     CiToolError,
     kernel_releases_from_env,
@@ -24,7 +25,6 @@ from ci_tools.common import (
     optional_env,
     require_env,
     skopeo_inspect_digest,
-    skopeo_copy,
     sort_kernel_releases,
     write_github_outputs,
 )
@@ -207,7 +207,7 @@ def smoke_test_candidate_image(
     registry_token: str,
     expected_kernel_releases: list[str] | None = None,
     digest_lookup: Callable[..., str] = skopeo_inspect_digest,
-    image_copier: Callable[..., None] = skopeo_copy,
+    image_copier: Callable[..., None] = copy_image_to_dir_layout,
     layer_loader: Callable[[Path], list[Path]] = load_layer_files_from_oci_layout,
     layer_inspector: Callable[..., CandidateImageLayerScanResult] = inspect_candidate_image_layers,
 ) -> CandidateImageSmokeTestResult:
@@ -216,6 +216,9 @@ def smoke_test_candidate_image(
 
     This check intentionally stays lightweight:
     - resolve the exact candidate digest from the published tag
+    - copy layers with skopeo, or through the runner blob store when
+      `REGISTRY_CLIENT=native` is set, so base layers shared with earlier
+      candidates are not downloaded again
     - inspect only the layer paths needed for ZFS verification
     - verify ZFS userspace packages/commands exist
     - verify every expected kernel release has a ZFS module payload
@@ -0,0 +1,312 @@
+"""
+Script: ci_tools/oci_assembly.py
+What: Assembles single-platform OCI images directly in a registry from existing layer blobs.
+Doing: Reads layer descriptors and diff IDs from source images, writes small reproducible layers, builds the config and manifest JSON, mounts blobs that live in other repositories, and uploads only what is new.
+Why: Rebuilding an image with `podman build` just to stack layers that already exist in the registry re-tars, recompresses, and re-uploads every byte.
+Goal: Let image merges cost a few small uploads no matter how large the layers are.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import gzip
+import hashlib
+import io
+import json
+from pathlib import Path
+import tarfile
+from typing import Sequence
+
+from ci_tools.registry_client import (
+    OCI_MANIFEST_MEDIA_TYPE,
+    ImageReference,
+    RegistryClient,
+    RegistryError,
+    current_platform,
+    parse_image_ref,
+    registry_client,
+    sha256_digest,
+)
+
+
+OCI_CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER_GZIP_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+# Docker schema 2 layer types have byte-identical OCI equivalents, so a layer
+# pushed by `podman push --format v2s2` can be listed in an OCI manifest as-is.
+OCI_LAYER_MEDIA_TYPES = {
+    "application/vnd.docker.image.rootfs.diff.tar.gzip": OCI_LAYER_GZIP_MEDIA_TYPE,
+    "application/vnd.docker.image.rootfs.diff.tar": "application/vnd.oci.image.layer.v1.tar",
+    "application/vnd.docker.image.rootfs.diff.tar.zstd": "application/vnd.oci.image.layer.v1.tar+zstd",
+}
+# Fixed so identical files always produce identical layer digests.
+GZIP_COMPRESSION_LEVEL = 6
+# Marker file skopeo writes into (and expects in) every `dir:` layout.
+DIR_LAYOUT_VERSION = "Directory Transport Version: 1.1\n"
+
+
+@dataclass(frozen=True)
+class ImageLayer:
+    """One layer blob plus the repository it can be read or mounted from."""
+
+    media_type: str
+    digest: str
+    size: int
+    diff_id: str
+    source: ImageReference
+
+    def descriptor(self) -> dict:
+        return {"mediaType": self.media_type, "digest": self.digest, "size": self.size}
+
+
+def read_image_layers(
+    image_ref: str,
+    *,
+    client: RegistryClient | None = None,
+    creds: str | None = None,
+) -> tuple[list[ImageLayer], dict]:
+    """
+    Return one image's layers (bottom first) and its config document.
+
+    The config supplies each layer's uncompressed `diff_id`, which the merged
+    image's own config must list in the same order.
+    """
+
+    registry = client or registry_client()
+    image = parse_image_ref(image_ref)
+    manifest = registry.resolve_platform_manifest(image, registry.get_manifest(image, creds=creds), creds=creds)
+    manifest_json = manifest.json()
+    config_digest = str((manifest_json.get("config") or {}).get("digest") or "")
+    if not config_digest:
+        raise RegistryError(f"Image {image.name} has no config blob")
+    try:
+        config = json.loads(registry.get_blob(image, config_digest, creds=creds))
+    except ValueError as exc:
+        raise RegistryError(f"Image config for {image.name} is not valid JSON") from exc
+    descriptors = manifest_json.get("layers") or []
+    diff_ids = (config.get("rootfs") or {}).get("diff_ids") or []
+    if len(diff_ids) != len(descriptors):
+        raise RegistryError(
+            f"Image {image.name} lists {len(descriptors)} layers but {len(diff_ids)} diff IDs"
+        )
+    layers = [
+        ImageLayer(
+            media_type=OCI_LAYER_MEDIA_TYPES.get(str(layer.get("mediaType") or ""), str(layer.get("mediaType") or "")),
+            digest=str(layer.get("digest") or ""),
+            size=int(layer.get("size") or 0),
+            diff_id=str(diff_id),
+            source=image,
+        )
+        for layer, diff_id in zip(descriptors, diff_ids)
+    ]
+    return layers, config
+
+
+class _HashingWriter:
+    """File-like sink that hashes the uncompressed tar stream on its way to gzip."""
+
+    def __init__(self, target: io.BufferedIOBase) -> None:
+        self.target = target
+        self.sha256 = hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+        return self.target.write(data)
+
+    # tarfile's `w|` mode only writes, but its `fileobj` parameter is typed as
+    # a full file object, so the rest of that protocol is spelled out here.
+    def read(self, _size: int = -1) -> bytes:
+        raise io.UnsupportedOperation("layer writers are write-only")
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def seek(self, _offset: int, _whence: int = 0) -> int:
+        raise io.UnsupportedOperation("layer writers are forward-only")
+
+    def close(self) -> None:
+        # The gzip stream underneath is closed by its own `with` block.
+        pass
+
+
+def write_reproducible_layer(
+    source_root: Path,
+    destination: Path,
+    *,
+    include: Sequence[str] = (),
+) -> tuple[str, str]:
+    """
+    Write every file under `source_root` as a gzip layer tarball at `destination`.
+
+    `include` limits the layer to those top-level paths under `source_root`.
+    Entries are sorted and carry zero mtimes, root ownership, and fixed modes
+    (0755 for directories and executables, 0644 otherwise); gzip runs at a
+    fixed level without a file name or timestamp. The same files therefore
+    always give the same bytes. Returns `(layer_digest, diff_id)`.
+    """
+
+    if include:
+        found: list[Path] = []
+        for name in include:
+            root = source_root / name
+            if root.exists():
+                found.append(root)
+                found.extend(root.rglob("*"))
+    else:
+        found = list(source_root.rglob("*"))
+    paths = sorted(found, key=lambda path: path.relative_to(source_root).parts)
+    with destination.open("wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=GZIP_COMPRESSION_LEVEL, mtime=0) as compressed:
+            writer = _HashingWriter(compressed)
+            with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as layer_tar:
+                for path in paths:
+                    info = tarfile.TarInfo(path.relative_to(source_root).as_posix())
+                    info.mtime = 0
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    if path.is_symlink():
+                        info.type = tarfile.SYMTYPE
+                        info.linkname = str(path.readlink())
+                        info.mode = 0o777
+                        layer_tar.addfile(info)
+                    elif path.is_dir():
+                        info.type = tarfile.DIRTYPE
+                        info.mode = 0o755
+                        layer_tar.addfile(info)
+                    else:
+                        info.size = path.stat().st_size
+                        info.mode = 0o755 if path.stat().st_mode & 0o111 else 0o644
+                        with path.open("rb") as handle:
+                            layer_tar.addfile(info, handle)
+    with destination.open("rb") as handle:
+        layer_digest = "sha256:" + hashlib.file_digest(handle, "sha256").hexdigest()
+    return layer_digest, "sha256:" + writer.sha256.hexdigest()
+
+
+def image_config(*, labels: dict[str, str], diff_ids: list[str], architecture: str = "") -> bytes:
+    """
+    Return a minimal OCI image config for a `FROM scratch`-style data image.
+
+    No `created` time is recorded, so the config (and the manifest digest)
+    only changes when the labels or layers do.
+    """
+
+    config = {
+        "architecture": architecture or current_platform()[1],
+        "os": "linux",
+        "config": {"Labels": dict(sorted(labels.items()))},
+        "rootfs": {"type": "layers", "diff_ids": list(diff_ids)},
+    }
+    return json.dumps(config, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def image_manifest(*, config: bytes, layers: list[dict]) -> bytes:
+    """Return the OCI manifest bytes for `config` plus layer descriptors (bottom first)."""
+
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": OCI_MANIFEST_MEDIA_TYPE,
+        "config": {
+            "mediaType": OCI_CONFIG_MEDIA_TYPE,
+            "digest": sha256_digest(config),
+            "size": len(config),
+        },
+        "layers": list(layers),
+    }
+    return json.dumps(manifest, separators=(",", ":")).encode("utf-8")
+
+
+def write_reproducible_image_layout(
+    layout_dir: Path,
+    *,
+    source_root: Path,
+    layer_paths: Sequence[Sequence[str]],
+    labels: dict[str, str],
+    architecture: str = "",
+) -> bytes:
+    """
+    Write a `skopeo copy ... dir:` style layout for a `FROM scratch` image.
+
+    Each item of `layer_paths` names the top-level paths under `source_root`
+    that go into one layer, bottom first. Layers come from
+    `write_reproducible_layer` and the config records no creation time, so the
+    same files and labels always give the same manifest digest. Returns the
+    manifest bytes.
+    """
+
+    layout_dir.mkdir(parents=True)
+    descriptors: list[dict] = []
+    diff_ids: list[str] = []
+    for index, include in enumerate(layer_paths):
+        staging = layout_dir / f"layer-{index}.tmp"
+        layer_digest, diff_id = write_reproducible_layer(source_root, staging, include=include)
+        size = staging.stat().st_size
+        staging.rename(layout_dir / layer_digest.removeprefix("sha256:"))
+        descriptors.append({"mediaType": OCI_LAYER_GZIP_MEDIA_TYPE, "digest": layer_digest, "size": size})
+        diff_ids.append(diff_id)
+    config = image_config(labels=labels, diff_ids=diff_ids, architecture=architecture)
+    (layout_dir / sha256_digest(config).removeprefix("sha256:")).write_bytes(config)
+    manifest = image_manifest(config=config, layers=descriptors)
+    (layout_dir / "manifest.json").write_bytes(manifest)
+    (layout_dir / "version").write_text(DIR_LAYOUT_VERSION, encoding="utf-8")
+    return manifest
+
+
+def push_assembled_image(
+    image_ref: str,
+    *,
+    tags: list[str],
+    layers: list[ImageLayer],
+    config: bytes,
+    client: RegistryClient | None = None,
+    creds: str | None = None,
+) -> bytes:
+    """
+    Publish one image made of existing layer blobs under every tag in `tags`.
+
+    Layers whose source is another repository on the same registry are
+    mounted, never re-uploaded; layers already in the target repository need
+    nothing. Only the config blob and the manifest are sent. Returns the
+    manifest bytes, whose sha256 is the pushed image digest.
+    """
+
+    registry = client or registry_client()
+    target = parse_image_ref(image_ref)
+    for layer in layers:
+        if layer.source.repository == target.repository and layer.source.registry == target.registry:
+            continue
+        if layer.source.registry != target.registry:
+            raise RegistryError(
+                f"Cannot mount {layer.digest} from {layer.source.name} into {target.name}: different registries"
+            )
+        if not registry.mount_blob(target, layer.digest, from_repository=layer.source.repository, creds=creds):
+            raise RegistryError(f"Registry refused to mount {layer.digest} from {layer.source.name} into {target.name}")
+    registry.push_blob(target, config, creds=creds)
+    manifest = image_manifest(config=config, layers=[layer.descriptor() for layer in layers])
+    for tag in tags:
+        registry.put_manifest(target, tag, manifest, creds=creds)
+    return manifest
+
+
+def retag_image(
+    image_ref: str,
+    tags: list[str],
+    *,
+    client: RegistryClient | None = None,
+    creds: str | None = None,
+) -> int:
+    """
+    Point more tags in the same repository at `image_ref` with manifest PUTs only.
+
+    The manifest is fetched once and uploaded unchanged under each tag, so the
+    tags share the source digest and no blob is read or written. Returns the
+    number of bytes uploaded.
+    """
+
+    registry = client or registry_client()
+    source = parse_image_ref(image_ref)
+    manifest = registry.get_manifest(source, creds=creds)
+    for tag in tags:
+        registry.put_manifest(source, tag, manifest.body, media_type=manifest.media_type, creds=creds)
+    return len(manifest.body) * len(tags)
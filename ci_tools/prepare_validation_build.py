@@ -58,7 +58,7 @@ def main() -> None:
         )
 
     print(
-        f"Read-only validation will reuse {status.source_image} for kernels "
+        f"Read-only validation will reuse {status.pinned_image or status.source_image} for kernels "
         f"{' '.join(inputs.kernel_releases)}."
     )
 
@@ -0,0 +1,260 @@
+"""
+Script: ci_tools/registry_cache.py
+What: On-disk cache for registry metadata lookups (`skopeo inspect` results).
+Doing: Stores inspect answers per image ref and keeps digest-pinned answers forever; tag answers are only cached when a tag TTL is configured.
+Why: One workflow run resolves the same base, build-container, and akmods refs many times across commands and jobs.
+Goal: Cut repeated registry round-trips without ever trusting a moving tag for long.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Callable, TypeVar
+
+
+REGISTRY_CACHE_DIR_ENV = "REGISTRY_CACHE_DIR"
+REGISTRY_CACHE_ENABLED_ENV = "REGISTRY_CACHE_ENABLED"
+REGISTRY_CACHE_TAG_TTL_ENV = "REGISTRY_CACHE_TAG_TTL_SECONDS"
+# Tags are not cached by default: the cache outlives the job, and tags moved
+# by BlueBuild, cosign, or upstream pushes never invalidate it.
+DEFAULT_TAG_TTL_SECONDS = 0
+CACHE_ENTRY_VERSION = 1
+
+T = TypeVar("T")
+
+
+@dataclass
+class RegistryCacheStats:
+    """Hit/miss counters for one process."""
+
+    hits: int = 0
+    misses: int = 0
+
+
+def is_digest_pinned_ref(image_ref: str) -> bool:
+    """True when the ref names one immutable manifest (`name@sha256:...`)."""
+
+    return "@sha256:" in image_ref
+
+
+def repository_ref(image_ref: str) -> str:
+    """Drop the tag or digest: `docker://host/name:tag` -> `docker://host/name`."""
+
+    if "@" in image_ref:
+        return image_ref.split("@", 1)[0]
+    last_slash = image_ref.rfind("/")
+    last_colon = image_ref.rfind(":")
+    if last_colon > last_slash:
+        return image_ref[:last_colon]
+    return image_ref
+
+
+def _normalize_ref(image_ref: str) -> str:
+    """Drop the `docker://` transport so both spellings share one entry."""
+
+    return image_ref.removeprefix("docker://")
+
+
+def default_registry_cache_dir() -> Path:
+    """
+    Return the default cache directory.
+
+    GitHub Actions mounts `RUNNER_TOOL_CACHE` from persistent runner storage
+    into job containers, so a cache stored there survives across jobs on the
+    self-hosted runner. Hosted runners and local shells fall back to the usual
+    per-user cache directory.
+    """
+
+    tool_cache = os.environ.get("RUNNER_TOOL_CACHE", "").strip()
+    if tool_cache:
+        return Path(tool_cache) / "kinoite-zfs" / "registry-metadata"
+    xdg_cache = os.environ.get("XDG_CACHE_HOME", "").strip()
+    base = Path(xdg_cache) if xdg_cache else Path.home() / ".cache"
+    return base / "kinoite-zfs" / "registry-metadata"
+
+
+class RegistryMetadataCache:
+    """
+    File-backed metadata cache shared by every `ci_tools.cli` command.
+
+    Entries are stored as one small JSON file per image ref. Each file can hold
+    several kinds of answer (`inspect`, `digest`, ...) for that ref. Writes use
+    an atomic rename so concurrent jobs never read half-written files.
+
+    Rules:
+    - digest-pinned refs never expire because their content cannot change
+    - tag refs expire after `tag_ttl_seconds` (0 disables tag caching)
+    - failed lookups are never cached
+    """
+
+    def __init__(
+        self,
+        root: Path | None,
+        *,
+        tag_ttl_seconds: int = DEFAULT_TAG_TTL_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.root = root
+        self.tag_ttl_seconds = tag_ttl_seconds
+        self.stats = RegistryCacheStats()
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    def _entry_path(self, image_ref: str) -> Path:
+        assert self.root is not None
+        key = hashlib.sha256(_normalize_ref(image_ref).encode("utf-8")).hexdigest()
+        return self.root / f"{key}.json"
+
+    def _is_cacheable(self, image_ref: str) -> bool:
+        if not self.enabled:
+            return False
+        if is_digest_pinned_ref(image_ref):
+            return True
+        return self.tag_ttl_seconds > 0
+
+    def _read_entry(self, image_ref: str) -> dict:
+        try:
+            data = json.loads(self._entry_path(image_ref).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != CACHE_ENTRY_VERSION:
+            return {}
+        if data.get("image_ref") != _normalize_ref(image_ref):
+            return {}
+        return data
+
+    def get(self, kind: str, image_ref: str) -> object | None:
+        """Return one cached answer, or `None` when missing or expired."""
+
+        if not self._is_cacheable(image_ref):
+            return None
+        record = self._read_entry(image_ref).get("kinds", {}).get(kind)
+        if not isinstance(record, dict) or "value" not in record:
+            return None
+        if not is_digest_pinned_ref(image_ref):
+            age = self._clock() - float(record.get("stored_at") or 0)
+            if age < 0 or age > self.tag_ttl_seconds:
+                return None
+        return record["value"]
+
+    def put(self, kind: str, image_ref: str, value: object) -> None:
+        """Store one successful answer."""
+
+        if not self._is_cacheable(image_ref):
+            return
+        assert self.root is not None
+        with self._lock:
+            data = self._read_entry(image_ref) or {
+                "version": CACHE_ENTRY_VERSION,
+                "image_ref": _normalize_ref(image_ref),
+                "kinds": {},
+            }
+            data["kinds"][kind] = {"stored_at": self._clock(), "value": value}
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    "w",
+                    encoding="utf-8",
+                    dir=self.root,
+                    prefix=".entry-",
+                    delete=False,
+                ) as handle:
+                    json.dump(data, handle)
+                os.replace(handle.name, self._entry_path(image_ref))
+            except OSError as exc:
+                # A read-only or full cache directory must never fail the job.
+                print(f"Warning: failed to write registry metadata cache: {exc}")
+
+    def invalidate(self, image_ref: str) -> None:
+        """
+        Forget every cached answer for one ref (used after pushes/copies).
+
+        The repository's cached tag list is dropped too, because a push may
+        have added the tag.
+        """
+
+        if not self.enabled:
+            return
+        for ref in dict.fromkeys((image_ref, repository_ref(image_ref))):
+            try:
+                self._entry_path(ref).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                print(f"Warning: failed to invalidate registry metadata cache: {exc}")
+
+    def lookup(self, kind: str, image_ref: str, loader: Callable[[], T]) -> T:
+        """Return a cached answer or call `loader` and cache its result."""
+
+        if not self._is_cacheable(image_ref):
+            return loader()
+        cached = self.get(kind, image_ref)
+        if cached is not None:
+            with self._lock:
+                self.stats.hits += 1
+            return cached  # type: ignore[return-value]
+        with self._lock:
+            self.stats.misses += 1
+        value = loader()
+        self.put(kind, image_ref, value)
+        return value
+
+
+def _cache_from_env() -> RegistryMetadataCache:
+    enabled = os.environ.get(REGISTRY_CACHE_ENABLED_ENV, "true").strip().lower()
+    if enabled in {"0", "false", "no", "off"}:
+        return RegistryMetadataCache(None)
+
+    root_text = os.environ.get(REGISTRY_CACHE_DIR_ENV, "").strip()
+    root = Path(root_text) if root_text else default_registry_cache_dir()
+    ttl_text = os.environ.get(REGISTRY_CACHE_TAG_TTL_ENV, "").strip()
+    try:
+        tag_ttl_seconds = int(ttl_text) if ttl_text else DEFAULT_TAG_TTL_SECONDS
+    except ValueError:
+        tag_ttl_seconds = DEFAULT_TAG_TTL_SECONDS
+    return RegistryMetadataCache(root, tag_ttl_seconds=max(0, tag_ttl_seconds))
+
+
+_REGISTRY_CACHE: RegistryMetadataCache | None = None
+
+
+def registry_metadata_cache() -> RegistryMetadataCache:
+    """Return the process-wide cache, configured from env on first use."""
+
+    global _REGISTRY_CACHE
+    if _REGISTRY_CACHE is None:
+        _REGISTRY_CACHE = _cache_from_env()
+    return _REGISTRY_CACHE
+
+
+def set_registry_metadata_cache(cache: RegistryMetadataCache | None) -> None:
+    """Replace the process-wide cache (tests use this to isolate state)."""
+
+    global _REGISTRY_CACHE
+    _REGISTRY_CACHE = cache
+
+
+def report_registry_cache_stats() -> None:
+    """Print hit/miss counters when this process used the cache at all."""
+
+    cache = _REGISTRY_CACHE
+    if cache is None or not cache.enabled:
+        return
+    stats = cache.stats
+    if stats.hits == 0 and stats.misses == 0:
+        return
+    print(
+        f"Registry metadata cache: {stats.hits} hits, {stats.misses} misses "
+        f"({cache.root})"
+    )
@@ -0,0 +1,881 @@
+"""
+Script: ci_tools/registry_client.py
+What: Small pure-Python client for the OCI distribution (registry v2) API.
+Doing: Keeps HTTP connections alive per registry host, caches bearer tokens per repository scope, and answers inspect/digest/exists/tag-list/manifest lookups.
+Why: Starting one `skopeo` process per metadata lookup pays process startup, a TLS handshake, and a token exchange every time.
+Goal: Let the `skopeo_*` helpers in `common.py` answer metadata questions from one pooled client per command.
+"""
+
+from __future__ import annotations
+
+import base64
+from contextlib import closing
+from dataclasses import dataclass
+import hashlib
+import http.client
+import io
+import json
+import os
+import platform
+import re
+import tarfile
+import threading
+import time
+from typing import IO, Generator, Mapping
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from ci_tools.common import CiToolError, ImageNotFoundError
+
+
+REGISTRY_CLIENT_ENV = "REGISTRY_CLIENT"
+DOCKER_HUB_REGISTRY = "docker.io"
+DOCKER_HUB_API_HOST = "registry-1.docker.io"
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+DOCKER_MANIFEST_LIST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.list.v2+json"
+DOCKER_MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+INDEX_MEDIA_TYPES = (OCI_INDEX_MEDIA_TYPE, DOCKER_MANIFEST_LIST_MEDIA_TYPE)
+MANIFEST_ACCEPT = ", ".join(
+    (
+        OCI_MANIFEST_MEDIA_TYPE,
+        DOCKER_MANIFEST_MEDIA_TYPE,
+        OCI_INDEX_MEDIA_TYPE,
+        DOCKER_MANIFEST_LIST_MEDIA_TYPE,
+    )
+)
+LOCAL_TRANSPORTS = frozenset({"dir", "oci", "containers-storage", "docker-archive", "oci-archive"})
+MAX_REDIRECTS = 5
+# Only these are retried after a dropped connection; uploads are not replayed.
+IDEMPOTENT_RETRY_METHODS = ("GET", "HEAD")
+DEFAULT_TOKEN_LIFETIME_SECONDS = 60
+AUTH_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+LINK_NEXT_RE = re.compile(r'<([^>]+)>\s*;\s*rel="?next"?')
+GO_ARCH_BY_MACHINE = {
+    "x86_64": "amd64",
+    "amd64": "amd64",
+    "aarch64": "arm64",
+    "arm64": "arm64",
+}
+
+
+class RegistryError(CiToolError):
+    """Raised when a registry request fails for a reason other than "not found"."""
+
+    def __init__(self, message: str, *, status: int | None = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class RegistryNotFoundError(RegistryError, ImageNotFoundError):
+    """Raised when the registry answers that a manifest, blob, or repo is unknown."""
+
+
+@dataclass(frozen=True)
+class ImageReference:
+    """
+    One parsed image reference.
+
+    `registry` is the user-facing host (`docker.io`, `ghcr.io`, `localhost:5000`);
+    `api_host` is where v2 API requests really go.
+    """
+
+    registry: str
+    repository: str
+    tag: str = ""
+    digest: str = ""
+
+    @property
+    def api_host(self) -> str:
+        return DOCKER_HUB_API_HOST if self.registry == DOCKER_HUB_REGISTRY else self.registry
+
+    @property
+    def reference(self) -> str:
+        """Manifest reference used in API paths: digest when pinned, else tag."""
+
+        return self.digest or self.tag or "latest"
+
+    @property
+    def name(self) -> str:
+        """Repository name including registry, like `skopeo inspect` prints it."""
+
+        return f"{self.registry}/{self.repository}"
+
+    def with_digest(self, digest: str) -> "ImageReference":
+        return ImageReference(self.registry, self.repository, tag="", digest=digest)
+
+    def with_tag(self, tag: str) -> "ImageReference":
+        return ImageReference(self.registry, self.repository, tag=tag, digest="")
+
+
+@dataclass(frozen=True)
+class ManifestResponse:
+    """Raw manifest bytes plus the metadata needed to trust them."""
+
+    media_type: str
+    digest: str
+    body: bytes
+
+    def json(self) -> dict:
+        try:
+            data = json.loads(self.body)
+        except ValueError as exc:
+            raise RegistryError(f"Registry returned an invalid manifest ({self.digest})") from exc
+        if not isinstance(data, dict):
+            raise RegistryError(f"Registry returned an invalid manifest ({self.digest})")
+        return data
+
+
+def parse_image_ref(image_ref: str) -> ImageReference:
+    """
+    Parse `docker://host/repo:tag`, `host/repo@sha256:...`, or Docker Hub shorthands.
+
+    Only the `docker://` transport (or no transport) is a registry reference;
+    anything else (`dir:`, `containers-storage:`) is rejected.
+    """
+
+    text = image_ref
+    if "://" in text:
+        transport, text = text.split("://", 1)
+        if transport != "docker":
+            raise CiToolError(f"Not a registry image reference: {image_ref}")
+    elif text.split(":", 1)[0] in LOCAL_TRANSPORTS:
+        raise CiToolError(f"Not a registry image reference: {image_ref}")
+
+    digest = ""
+    if "@" in text:
+        text, digest = text.split("@", 1)
+        if not digest.startswith("sha256:"):
+            raise CiToolError(f"Unsupported digest in image reference: {image_ref}")
+
+    tag = ""
+    last_slash = text.rfind("/")
+    last_colon = text.rfind(":")
+    if last_colon > last_slash:
+        text, tag = text[:last_colon], text[last_colon + 1 :]
+
+    first, _, rest = text.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+    else:
+        registry, repository = DOCKER_HUB_REGISTRY, text
+        if "/" not in repository:
+            repository = f"library/{repository}"
+
+    if not repository:
+        raise CiToolError(f"Invalid image reference: {image_ref}")
+    if not tag and not digest:
+        tag = "latest"
+    return ImageReference(registry=registry, repository=repository, tag=tag, digest=digest)
+
+
+def native_registry_client_enabled() -> bool:
+    """True when `REGISTRY_CLIENT=native` asks the helpers to skip skopeo."""
+
+    return os.environ.get(REGISTRY_CLIENT_ENV, "").strip().lower() == "native"
+
+
+def sha256_digest(data: bytes) -> str:
+    """Return the OCI digest string for one byte payload."""
+
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def current_platform() -> tuple[str, str]:
+    """Return the (`os`, `architecture`) pair used to pick from image indexes."""
+
+    machine = platform.machine().lower()
+    return "linux", GO_ARCH_BY_MACHINE.get(machine, machine)
+
+
+def _uses_plain_http(host: str) -> bool:
+    """
+    Match Docker's convention: loopback registries speak plain HTTP.
+
+    Tests run an in-process registry stand-in on `127.0.0.1`, and local
+    development registries on `localhost:5000` behave the same way.
+    """
+
+    hostname = host.rsplit(":", 1)[0] if host.count(":") == 1 else host
+    return hostname in {"localhost", "127.0.0.1", "::1", "[::1]"}
+
+
+def _creds_key(creds: str | None) -> str:
+    if not creds:
+        return ""
+    return hashlib.sha256(creds.encode("utf-8")).hexdigest()
+
+
+def _basic_auth_header(creds: str) -> str:
+    return "Basic " + base64.b64encode(creds.encode("utf-8")).decode("ascii")
+
+
+@dataclass
+class _Response:
+    status: int
+    headers: Mapping[str, str]
+    body: bytes
+    stream: "BlobReader | None" = None
+
+
+class BlobReader:
+    """
+    Streaming, digest-checking reader over one blob download.
+
+    The underlying pooled connection is returned to the pool only when the
+    whole body was read; a reader closed early simply drops its connection.
+    When the body was fully read, `close()` also verifies the sha256 digest.
+    """
+
+    def __init__(
+        self,
+        client: "RegistryClient",
+        scheme: str,
+        host: str,
+        connection: http.client.HTTPConnection,
+        response: http.client.HTTPResponse,
+        expected_digest: str = "",
+    ) -> None:
+        self.expected_digest = expected_digest
+        self.bytes_read = 0
+        self._client = client
+        self._scheme = scheme
+        self._host = host
+        self._connection = connection
+        self._response = response
+        self._hash = hashlib.sha256()
+        self._closed = False
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._response.read() if size is None or size < 0 else self._response.read(size)
+        self._hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    # tarfile's stream modes only read, but its `fileobj` parameter is typed
+    # as a full file object, so the rest of that protocol is spelled out here.
+    def tell(self) -> int:
+        return self.bytes_read
+
+    def seek(self, _offset: int, _whence: int = 0) -> int:
+        raise io.UnsupportedOperation("blob downloads are forward-only")
+
+    def write(self, _data: bytes) -> int:
+        raise io.UnsupportedOperation("blob downloads are read-only")
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        complete = self._response.isclosed()
+        if complete and not self._response.will_close:
+            self._client._checkin(self._scheme, self._host, self._connection)
+        else:
+            self._connection.close()
+        if complete and self.expected_digest:
+            actual = "sha256:" + self._hash.hexdigest()
+            if actual != self.expected_digest:
+                raise RegistryError(f"Blob digest mismatch: expected {self.expected_digest}, got {actual}")
+
+    def __enter__(self) -> "BlobReader":
+        return self
+
+    def __exit__(self, *_exc: object) -> None:
+        self.close()
+
+
+class RegistryClient:
+    """
+    Pooled registry v2 client.
+
+    One instance keeps idle HTTP connections per registry host and bearer
+    tokens per `(host, scope, credentials)` triple. It is safe to share across
+    threads: every request checks a connection out of the pool for its whole
+    round-trip and returns it only after the response body is fully read.
+    """
+
+    def __init__(self, *, timeout: float = 60.0) -> None:
+        self.timeout = timeout
+        self.requests_made = 0
+        self.connections_opened = 0
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self._tokens: dict[tuple[str, str, str], tuple[str, float]] = {}
+        self._basic_hosts: set[str] = set()
+
+    # Connection pool ---------------------------------------------------
+
+    def _checkout(self, scheme: str, host: str) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop()
+            self.connections_opened += 1
+        if scheme == "http":
+            return http.client.HTTPConnection(host, timeout=self.timeout)
+        return http.client.HTTPSConnection(host, timeout=self.timeout)
+
+    def _checkin(self, scheme: str, host: str, connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.setdefault((scheme, host), []).append(connection)
+
+    def close(self) -> None:
+        """Close every idle pooled connection."""
+
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle.clear()
+        for pool in pools:
+            for connection in pool:
+                connection.close()
+
+    def _send(
+        self,
+        method: str,
+        url: str,
+        headers: Mapping[str, str],
+        body: bytes | None = None,
+        *,
+        stream: bool = False,
+    ) -> _Response:
+        """
+        Send one request on a pooled connection and read the whole answer.
+
+        With `stream=True`, a `200` body is left unread and handed back as a
+        `BlobReader` that owns the connection until it is closed.
+        """
+
+        parts = urlsplit(url)
+        scheme, host = parts.scheme, parts.netloc
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        for attempt in range(2):
+            connection = self._checkout(scheme, host)
+            try:
+                connection.request(method, path, body=body, headers=dict(headers))
+                response = connection.getresponse()
+                if stream and response.status == 200:
+                    with self._lock:
+                        self.requests_made += 1
+                    return _Response(
+                        status=response.status,
+                        headers={key.lower(): value for key, value in response.getheaders()},
+                        body=b"",
+                        stream=BlobReader(self, scheme, host, connection, response),
+                    )
+                payload = response.read()
+            except (http.client.HTTPException, OSError) as exc:
+                connection.close()
+                # A pooled keep-alive connection may have been closed by the
+                # server while idle; retry exactly once on a fresh connection.
+                # Uploads are never replayed blindly: the first attempt may
+                # already have reached the registry.
+                if attempt == 0 and method in IDEMPOTENT_RETRY_METHODS:
+                    continue
+                raise RegistryError(f"Registry request failed: {method} {url}: {exc}") from exc
+            with self._lock:
+                self.requests_made += 1
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(scheme, host, connection)
+            return _Response(
+                status=response.status,
+                headers={key.lower(): value for key, value in response.getheaders()},
+                body=payload,
+            )
+        raise AssertionError("unreachable")
+
+    # Authentication ----------------------------------------------------
+
+    def _cached_token(self, host: str, scope: str, creds: str | None) -> str:
+        key = (host, scope, _creds_key(creds))
+        with self._lock:
+            token, expires_at = self._tokens.get(key, ("", 0.0))
+        if token and time.monotonic() < expires_at:
+            return token
+        return ""
+
+    def _fetch_token(self, host: str, scope: str, creds: str | None, challenge: str) -> str:
+        params = dict(AUTH_PARAM_RE.findall(challenge))
+        realm = params.get("realm", "")
+        if not realm:
+            raise RegistryError(f"Registry {host} sent a bearer challenge without a realm")
+        # Space-separated scopes (a push plus a cross-repository mount source)
+        # become repeated `scope` parameters, as the token spec expects.
+        query = [("scope", item) for item in scope.split()]
+        if params.get("service"):
+            query.append(("service", params["service"]))
+        headers = {}
+        if creds:
+            headers["Authorization"] = _basic_auth_header(creds)
+        separator = "&" if "?" in realm else "?"
+        response = self._send("GET", f"{realm}{separator}{urlencode(query)}", headers)
+        if response.status != 200:
+            raise RegistryError(
+                f"Registry token request failed for {host} ({scope}): HTTP {response.status}",
+                status=response.status,
+            )
+        try:
+            data = json.loads(response.body)
+        except ValueError as exc:
+            raise RegistryError(f"Registry token response from {host} is not JSON") from exc
+        token = str(data.get("token") or data.get("access_token") or "")
+        if not token:
+            raise RegistryError(f"Registry token response from {host} did not include a token")
+        lifetime = int(data.get("expires_in") or DEFAULT_TOKEN_LIFETIME_SECONDS)
+        with self._lock:
+            self._tokens[(host, scope, _creds_key(creds))] = (
+                token,
+                time.monotonic() + max(1, lifetime - 10),
+            )
+        return token
+
+    def _auth_header(self, host: str, scope: str, creds: str | None) -> dict[str, str]:
+        token = self._cached_token(host, scope, creds)
+        if token:
+            return {"Authorization": f"Bearer {token}"}
+        with self._lock:
+            basic = host in self._basic_hosts
+        if creds and basic:
+            return {"Authorization": _basic_auth_header(creds)}
+        return {}
+
+    def request(
+        self,
+        method: str,
+        image: ImageReference,
+        path: str,
+        *,
+        creds: str | None = None,
+        headers: Mapping[str, str] | None = None,
+        body: bytes | None = None,
+        push: bool = False,
+        stream: bool = False,
+        extra_scopes: tuple[str, ...] = (),
+    ) -> _Response:
+        """
+        Send one authenticated v2 API request for `image`'s repository.
+
+        Handles the 401 -> token -> retry dance once per scope and follows
+        redirects (blob downloads usually land on a CDN host). 307 and 308 keep
+        the method and body; 301, 302, and 303 continue as GET (HEAD stays
+        HEAD). Authorization is only sent to the registry host itself, never
+        to redirect targets.
+        `extra_scopes` widens the token, e.g. to pull from a mount source.
+        """
+
+        host = image.api_host
+        scheme = "http" if _uses_plain_http(host) else "https"
+        scope = " ".join((f"repository:{image.repository}:{'pull,push' if push else 'pull'}", *extra_scopes))
+        url = path if path.startswith(("http://", "https://")) else f"{scheme}://{host}{path}"
+        request_headers = dict(headers or {})
+
+        response = self._send(
+            method,
+            url,
+            {**request_headers, **self._auth_header(host, scope, creds)},
+            body,
+            stream=stream,
+        )
+        if response.status == 401:
+            challenge = response.headers.get("www-authenticate", "")
+            if challenge.lower().startswith("bearer"):
+                token = self._fetch_token(host, scope, creds, challenge)
+                auth = {"Authorization": f"Bearer {token}"}
+            elif challenge.lower().startswith("basic") and creds:
+                with self._lock:
+                    self._basic_hosts.add(host)
+                auth = {"Authorization": _basic_auth_header(creds)}
+            else:
+                auth = {}
+            if auth:
+                response = self._send(method, url, {**request_headers, **auth}, body, stream=stream)
+
+        for _ in range(MAX_REDIRECTS):
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            location = response.headers.get("location", "")
+            if not location:
+                break
+            target = urljoin(url, location)
+            same_host = urlsplit(target).netloc == host
+            redirect_headers = dict(request_headers)
+            if same_host:
+                redirect_headers.update(self._auth_header(host, scope, creds))
+            url = target
+            if response.status not in (307, 308) and method != "HEAD":
+                method, body = "GET", None
+            response = self._send(method, url, redirect_headers, body, stream=stream)
+        return response
+
+    # Registry operations -----------------------------------------------
+
+    @staticmethod
+    def _raise_for_status(response: _Response, what: str) -> None:
+        if 200 <= response.status < 300:
+            return
+        detail = response.body[:300].decode("utf-8", errors="replace").strip()
+        message = f"Registry request for {what} failed: HTTP {response.status}"
+        if detail:
+            message = f"{message}: {detail}"
+        if response.status == 404:
+            raise RegistryNotFoundError(message, status=404)
+        raise RegistryError(message, status=response.status)
+
+    def get_manifest(self, image_ref: str | ImageReference, *, creds: str | None = None) -> ManifestResponse:
+        """Fetch the raw manifest (or index) named by one image reference."""
+
+        image = image_ref if isinstance(image_ref, ImageReference) else parse_image_ref(image_ref)
+        response = self.request(
+            "GET",
+            image,
+            f"/v2/{image.repository}/manifests/{image.reference}",
+            creds=creds,
+            headers={"Accept": MANIFEST_ACCEPT},
+        )
+        self._raise_for_status(response, f"{image.name}:{image.reference}")
+        digest = sha256_digest(response.body)
+        if image.digest and digest != image.digest:
+            raise RegistryError(
+                f"Manifest digest mismatch for {image.name}: expected {image.digest}, got {digest}"
+            )
+        media_type = response.headers.get("content-type", "").split(";", 1)[0].strip()
+        if not media_type or media_type == "application/json":
+            try:
+                media_type = str(json.loads(response.body).get("mediaType") or media_type)
+            except (ValueError, AttributeError):
+                pass
+        return ManifestResponse(media_type=media_type, digest=digest, body=response.body)
+
+    def digest(self, image_ref: str | ImageReference, *, creds: str | None = None) -> str:
+        """
+        Return the manifest digest for one reference using a `HEAD` request.
+
+        Registries report the digest in `Docker-Content-Digest`, so no manifest
+        or config body is transferred. When a registry omits that header, fall
+        back to fetching the manifest and hashing it locally.
+        """
+
+        image = image_ref if isinstance(image_ref, ImageReference) else parse_image_ref(image_ref)
+        response = self.request(
+            "HEAD",
+            image,
+            f"/v2/{image.repository}/manifests/{image.reference}",
+            creds=creds,
+            headers={"Accept": MANIFEST_ACCEPT},
+        )
+        self._raise_for_status(response, f"{image.name}:{image.reference}")
+        digest = response.headers.get("docker-content-digest", "").strip()
+        if not digest.startswith("sha256:"):
+            return self.get_manifest(image, creds=creds).digest
+        if image.digest and digest != image.digest:
+            raise RegistryError(
+                f"Manifest digest mismatch for {image.name}: expected {image.digest}, got {digest}"
+            )
+        return digest
+
+    def exists(self, image_ref: str | ImageReference, *, creds: str | None = None) -> bool:
+        """True when the reference resolves; False only on a clean "not found"."""
+
+        try:
+            self.digest(image_ref, creds=creds)
+        except RegistryNotFoundError:
+            return False
+        return True
+
+    def get_blob(self, image: ImageReference, digest: str, *, creds: str | None = None) -> bytes:
+        """Download one (small) blob, such as an image config, and verify it."""
+
+        response = self.request(
+            "GET",
+            image,
+            f"/v2/{image.repository}/blobs/{digest}",
+            creds=creds,
+        )
+        self._raise_for_status(response, f"{image.name}@{digest}")
+        if sha256_digest(response.body) != digest:
+            raise RegistryError(f"Blob digest mismatch for {image.name}@{digest}")
+        return response.body
+
+    def open_blob(self, image: ImageReference, digest: str, *, creds: str | None = None) -> BlobReader:
+        """
+        Open one blob for streaming reads (used for large layer tarballs).
+
+        Callers must close the reader; use it as a context manager.
+        """
+
+        response = self.request(
+            "GET",
+            image,
+            f"/v2/{image.repository}/blobs/{digest}",
+            creds=creds,
+            stream=True,
+        )
+        if response.stream is None:
+            self._raise_for_status(response, f"{image.name}@{digest}")
+            raise RegistryError(f"Registry returned no body for {image.name}@{digest}")
+        response.stream.expected_digest = digest
+        return response.stream
+
+    def iter_layer_members(
+        self,
+        image: ImageReference,
+        digest: str,
+        *,
+        creds: str | None = None,
+    ) -> Generator[tarfile.TarInfo, None, None]:
+        """
+        Yield tar headers from one layer blob without writing member data anywhere.
+
+        `r|*` is tarfile's forward-only stream mode with transparent
+        decompression: member data is skipped in memory as the stream advances.
+        Closing the generator early drops the connection instead of downloading
+        the rest of the layer.
+        """
+
+        with closing(self.iter_layer_files(image, digest, creds=creds)) as files:
+            for member, _reader in files:
+                yield member
+
+    def iter_layer_files(
+        self,
+        image: ImageReference,
+        digest: str,
+        *,
+        creds: str | None = None,
+    ) -> Generator[tuple[tarfile.TarInfo, IO[bytes] | None], None, None]:
+        """
+        Like `iter_layer_members`, plus a reader for each regular-file member.
+
+        A reader is only valid until the next item is requested, because the
+        stream moves past whatever member data was not read. Callers that only
+        need a file's first bytes (an RPM header, say) read just those.
+        """
+
+        with self.open_blob(image, digest, creds=creds) as blob:
+            try:
+                with tarfile.open(fileobj=blob, mode="r|*") as layer_tar:
+                    for member in layer_tar:
+                        yield member, layer_tar.extractfile(member) if member.isfile() else None
+            except (tarfile.TarError, EOFError, OSError) as exc:
+                raise RegistryError(f"Failed to stream layer {image.name}@{digest}: {exc}") from exc
+            # Drain tar padding so the digest check and connection reuse both work.
+            while blob.read(1 << 16):
+                pass
+
+    def image_layers(self, image: ImageReference, *, creds: str | None = None) -> list[dict]:
+        """Return the layer descriptors (bottom-most first) of this host's platform manifest."""
+
+        manifest = self.resolve_platform_manifest(image, self.get_manifest(image, creds=creds), creds=creds)
+        return list(manifest.json().get("layers") or [])
+
+    def list_tags(self, image_ref: str | ImageReference, *, creds: str | None = None) -> list[str]:
+        """Return every tag in the repository, following `Link` pagination."""
+
+        image = image_ref if isinstance(image_ref, ImageReference) else parse_image_ref(image_ref)
+        path = f"/v2/{image.repository}/tags/list"
+        tags: list[str] = []
+        for _ in range(10_000):
+            response = self.request("GET", image, path, creds=creds)
+            self._raise_for_status(response, f"{image.name} tag list")
+            try:
+                data = json.loads(response.body)
+            except ValueError as exc:
+                raise RegistryError(f"Registry tag list for {image.name} is not JSON") from exc
+            tags.extend(str(tag) for tag in data.get("tags") or [])
+            match = LINK_NEXT_RE.search(response.headers.get("link", ""))
+            if not match:
+                return tags
+            path = match.group(1)
+        raise RegistryError(f"Registry tag list for {image.name} did not terminate")
+
+    def resolve_platform_manifest(
+        self,
+        image: ImageReference,
+        manifest: ManifestResponse,
+        *,
+        creds: str | None = None,
+    ) -> ManifestResponse:
+        """Return the single-platform manifest for this host from an index, if needed."""
+
+        if manifest.media_type not in INDEX_MEDIA_TYPES:
+            return manifest
+        wanted_os, wanted_arch = current_platform()
+        for entry in manifest.json().get("manifests") or []:
+            entry_platform = entry.get("platform") or {}
+            if entry_platform.get("os") == wanted_os and entry_platform.get("architecture") == wanted_arch:
+                return self.get_manifest(image.with_digest(str(entry["digest"])), creds=creds)
+        raise RegistryError(f"No {wanted_os}/{wanted_arch} manifest in index {image.name}@{manifest.digest}")
+
+    def inspect(self, image_ref: str | ImageReference, *, creds: str | None = None) -> dict:
+        """
+        Return a `skopeo inspect --no-tags`-compatible metadata document.
+
+        `Digest` is the digest of the top-level manifest the reference names
+        (the index digest for multi-arch images), matching skopeo's behavior.
+        """
+
+        image = image_ref if isinstance(image_ref, ImageReference) else parse_image_ref(image_ref)
+        top_manifest = self.get_manifest(image, creds=creds)
+        manifest = self.resolve_platform_manifest(image, top_manifest, creds=creds)
+        manifest_json = manifest.json()
+        config_digest = str((manifest_json.get("config") or {}).get("digest") or "")
+        config: dict = {}
+        if config_digest:
+            config = json.loads(self.get_blob(image, config_digest, creds=creds))
+        container_config = config.get("config") or {}
+        layers = manifest_json.get("layers") or []
+        return {
+            "Name": image.name,
+            "Digest": top_manifest.digest,
+            "RepoTags": [],
+            "Created": config.get("created"),
+            "DockerVersion": config.get("docker_version", ""),
+            "Labels": container_config.get("Labels"),
+            "Architecture": config.get("architecture", ""),
+            "Os": config.get("os", ""),
+            "Layers": [str(layer.get("digest") or "") for layer in layers],
+            "LayersData": [
+                {
+                    "MIMEType": layer.get("mediaType", ""),
+                    "Digest": layer.get("digest", ""),
+                    "Size": layer.get("size", 0),
+                    "Annotations": layer.get("annotations"),
+                }
+                for layer in layers
+            ],
+            "Env": container_config.get("Env"),
+        }
+
+    # Push operations ----------------------------------------------------
+
+    def blob_exists(self, image: ImageReference, digest: str, *, creds: str | None = None) -> bool:
+        """True when `image`'s repository already holds the blob (one `HEAD`)."""
+
+        response = self.request("HEAD", image, f"/v2/{image.repository}/blobs/{digest}", creds=creds)
+        if response.status == 404:
+            return False
+        self._raise_for_status(response, f"{image.name}@{digest}")
+        return True
+
+    def push_blob(self, image: ImageReference, data: bytes, *, creds: str | None = None) -> str:
+        """
+        Upload one small blob (monolithic POST + PUT) unless it already exists.
+
+        Layer tarballs still go through skopeo/podman; this is meant for small
+        artifacts such as JSON documents and the empty OCI config.
+        """
+
+        digest = sha256_digest(data)
+        blob_path = f"/v2/{image.repository}/blobs/{digest}"
+        response = self.request("HEAD", image, blob_path, creds=creds, push=True)
+        if response.status == 200:
+            return digest
+        response = self.request(
+            "POST",
+            image,
+            f"/v2/{image.repository}/blobs/uploads/",
+            creds=creds,
+            headers={"Content-Length": "0"},
+            body=b"",
+            push=True,
+        )
+        self._raise_for_status(response, f"{image.name} blob upload")
+        location = response.headers.get("location", "")
+        if not location:
+            raise RegistryError(f"Registry did not return an upload location for {image.name}")
+        separator = "&" if "?" in location else "?"
+        response = self.request(
+            "PUT",
+            image,
+            f"{location}{separator}{urlencode({'digest': digest})}",
+            creds=creds,
+            headers={"Content-Type": "application/octet-stream"},
+            body=data,
+            push=True,
+        )
+        self._raise_for_status(response, f"{image.name}@{digest} upload")
+        return digest
+
+    def mount_blob(
+        self,
+        image: ImageReference,
+        digest: str,
+        *,
+        from_repository: str,
+        creds: str | None = None,
+    ) -> bool:
+        """
+        Make one blob available in `image`'s repository without uploading it.
+
+        Returns True when the blob is already there or the registry mounted it
+        from `from_repository` on the same host. Returns False when the
+        registry answered with a regular upload session instead (mounts are
+        optional in the spec); the caller then has to push the bytes itself.
+        """
+
+        extra_scopes = () if from_repository == image.repository else (f"repository:{from_repository}:pull",)
+        blob_path = f"/v2/{image.repository}/blobs/{digest}"
+        response = self.request("HEAD", image, blob_path, creds=creds, push=True, extra_scopes=extra_scopes)
+        if response.status == 200:
+            return True
+        if not extra_scopes:
+            return False
+        response = self.request(
+            "POST",
+            image,
+            f"/v2/{image.repository}/blobs/uploads/?{urlencode({'mount': digest, 'from': from_repository})}",
+            creds=creds,
+            headers={"Content-Length": "0"},
+            body=b"",
+            push=True,
+            extra_scopes=extra_scopes,
+        )
+        if response.status == 201:
+            return True
+        self._raise_for_status(response, f"{image.name}@{digest} mount from {from_repository}")
+        return False
+
+    def put_manifest(
+        self,
+        image: ImageReference,
+        reference: str,
+        body: bytes,
+        *,
+        media_type: str = OCI_MANIFEST_MEDIA_TYPE,
+        creds: str | None = None,
+    ) -> str:
+        """Upload one manifest under a tag or digest and return its digest."""
+
+        response = self.request(
+            "PUT",
+            image,
+            f"/v2/{image.repository}/manifests/{reference}",
+            creds=creds,
+            headers={"Content-Type": media_type},
+            body=body,
+            push=True,
+        )
+        self._raise_for_status(response, f"{image.name}:{reference} manifest upload")
+        return sha256_digest(body)
+
+
+_REGISTRY_CLIENT: RegistryClient | None = None
+_REGISTRY_CLIENT_LOCK = threading.Lock()
+
+
+def registry_client() -> RegistryClient:
+    """Return the process-wide pooled client (one per CLI command)."""
+
+    global _REGISTRY_CLIENT
+    with _REGISTRY_CLIENT_LOCK:
+        if _REGISTRY_CLIENT is None:
+            _REGISTRY_CLIENT = RegistryClient()
+        return _REGISTRY_CLIENT
+
+
+def set_registry_client(client: RegistryClient | None) -> None:
+    """Replace the process-wide client (tests point it at a local stand-in)."""
+
+    global _REGISTRY_CLIENT
+    with _REGISTRY_CLIENT_LOCK:
+        _REGISTRY_CLIENT = client
@@ -0,0 +1,367 @@
+"""
+Script: ci_tools/rpm_header.py
+What: Minimal reader for RPM package headers and cpio payloads.
+Doing: Parses the RPM lead, signature header, and main header to return NAME, VERSION, RELEASE, ARCH, the file list, and the payload format without reading the payload; optionally streams the `newc` cpio payload and writes selected entries.
+Why: Planning kmod installs only needs header fields, and spawning `rpm -qp` per package dominated that step.
+Goal: Answer package identity and kernel-release questions in-process, from a path or a stream.
+
+This module uses only the standard library and imports nothing from
+`ci_tools`, because the compose-time helper also ships a copy of it inside the
+image build (see `containerfiles/zfs-akmods/Containerfile`).
+
+Fedora RPM payloads are zstd. Python 3.14+ decodes them with
+`compression.zstd`; older Pythons need the optional `zstandard` package or the
+`zstd` command. Without any of them `extract_rpm_payload` returns None for zstd
+payloads and callers fall back to slower paths.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import bz2
+import gzip
+import io
+import lzma
+import os
+from pathlib import Path, PurePosixPath
+import shutil
+import stat
+import struct
+import subprocess
+from typing import BinaryIO, Callable, Protocol
+
+try:
+    # Python 3.14+ (Fedora 43 and later); Fedora RPM payloads are zstd.
+    from compression import zstd  # type: ignore[import-not-found]
+except ImportError:
+    zstd = None  # type: ignore[assignment]
+
+try:
+    # Older Pythons: `python3-zstandard` on Fedora, `zstandard` on PyPI.
+    import zstandard  # type: ignore[import-not-found]
+except ImportError:
+    zstandard = None
+
+
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+# Header intro: magic (4), reserved (4), index entry count (4), data size (4).
+HEADER_INTRO = struct.Struct(">4s4xII")
+INDEX_ENTRY = struct.Struct(">iiii")
+# rpm itself refuses headers above 256 MiB; kmod headers are a few KiB.
+MAX_HEADER_BYTES = 256 * 1024 * 1024
+
+# Header tag numbers from rpm's `rpmtag.h`.
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_ARCH = 1022
+RPMTAG_OLDFILENAMES = 1027
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+
+# Header data types from rpm's `rpmtag.h`.
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+ZFS_MODULE_PATH = "extra/zfs/zfs.ko"
+
+# `newc` cpio: 6-byte magic plus 13 eight-digit hex fields, 4-byte aligned.
+CPIO_NEWC_MAGICS = (b"070701", b"070702")
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+COPY_CHUNK_BYTES = 1 << 20
+
+# Maps one cpio entry name to a path relative to the destination, or None to skip it.
+PayloadSelector = Callable[[str], "PurePosixPath | None"]
+
+
+class SupportsRead(Protocol):
+    """Anything RPM headers can be read from: files, tar members, blob streams."""
+
+    def read(self, size: int = -1, /) -> bytes: ...
+
+
+class RpmHeaderError(RuntimeError):
+    """Raised when a file is not a readable RPM package header."""
+
+
+@dataclass(frozen=True)
+class RpmHeader:
+    """The header fields this repo needs from one RPM package."""
+
+    name: str
+    version: str
+    release: str
+    arch: str
+    filenames: tuple[str, ...]
+    # rpm treats a missing compressor tag as gzip.
+    payload_format: str = "cpio"
+    payload_compressor: str = "gzip"
+
+    def kernel_release_for_module(self, module_path: str = ZFS_MODULE_PATH) -> str | None:
+        """
+        Return `<release>` when the package ships `/lib/modules/<release>/<module_path>`.
+
+        Both the `/lib` and merged `/usr/lib` spellings are accepted.
+        """
+
+        for filename in self.filenames:
+            parts = PurePosixPath(filename).parts
+            if parts[1:3] == ("usr", "lib"):
+                parts = ("/", *parts[2:])
+            if len(parts) < 5 or parts[1:3] != ("lib", "modules"):
+                continue
+            if "/".join(parts[4:]) == module_path:
+                return parts[3]
+        return None
+
+
+def _read_exact(stream: SupportsRead, size: int, what: str) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise RpmHeaderError(f"Truncated RPM {what}: wanted {size} bytes, got {len(data)}")
+        data += chunk
+    return bytes(data)
+
+
+def _read_header_section(stream: SupportsRead, what: str) -> tuple[list[tuple[int, int, int, int]], bytes]:
+    """Read one header structure and return `(index_entries, data_store)`."""
+
+    magic, index_count, data_size = HEADER_INTRO.unpack(
+        _read_exact(stream, HEADER_INTRO.size, f"{what} intro")
+    )
+    if magic != RPM_HEADER_MAGIC:
+        raise RpmHeaderError(f"Bad RPM {what} magic: {magic.hex()}")
+    if index_count * INDEX_ENTRY.size + data_size > MAX_HEADER_BYTES:
+        raise RpmHeaderError(f"RPM {what} is implausibly large ({index_count} tags, {data_size} bytes)")
+    index_bytes = _read_exact(stream, index_count * INDEX_ENTRY.size, f"{what} index")
+    entries = [
+        INDEX_ENTRY.unpack_from(index_bytes, offset)
+        for offset in range(0, len(index_bytes), INDEX_ENTRY.size)
+    ]
+    return entries, _read_exact(stream, data_size, f"{what} data")
+
+
+def _strings_at(store: bytes, offset: int, count: int) -> list[str]:
+    values: list[str] = []
+    for _ in range(count):
+        end = store.find(b"\0", offset)
+        if end < 0:
+            raise RpmHeaderError("Unterminated string in RPM header")
+        values.append(store[offset:end].decode("utf-8", errors="surrogateescape"))
+        offset = end + 1
+    return values
+
+
+def _tag_values(entries: list[tuple[int, int, int, int]], store: bytes) -> dict[int, list[str] | list[int]]:
+    """Decode the string and int32 tags; other types are not needed here."""
+
+    values: dict[int, list[str] | list[int]] = {}
+    for tag, data_type, offset, count in entries:
+        if offset < 0 or offset > len(store):
+            raise RpmHeaderError(f"RPM header tag {tag} points outside the data store")
+        if data_type == RPM_STRING_TYPE:
+            values[tag] = _strings_at(store, offset, 1)
+        elif data_type in (RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+            values[tag] = _strings_at(store, offset, count)
+        elif data_type == RPM_INT32_TYPE:
+            end = offset + 4 * count
+            if end > len(store):
+                raise RpmHeaderError(f"RPM header tag {tag} runs past the data store")
+            values[tag] = list(struct.unpack_from(f">{count}i", store, offset))
+    return values
+
+
+def _first_string(values: dict[int, list[str] | list[int]], tag: int) -> str:
+    found = values.get(tag) or [""]
+    return str(found[0])
+
+
+def _filenames(values: dict[int, list[str] | list[int]]) -> tuple[str, ...]:
+    basenames = [str(value) for value in values.get(RPMTAG_BASENAMES, [])]
+    if not basenames:
+        return tuple(str(value) for value in values.get(RPMTAG_OLDFILENAMES, []))
+    dirnames = [str(value) for value in values.get(RPMTAG_DIRNAMES, [])]
+    dirindexes = [int(value) for value in values.get(RPMTAG_DIRINDEXES, [])]
+    if len(dirindexes) != len(basenames) or any(
+        index < 0 or index >= len(dirnames) for index in dirindexes
+    ):
+        raise RpmHeaderError("RPM header file list is inconsistent")
+    return tuple(dirnames[index] + basename for index, basename in zip(dirindexes, basenames))
+
+
+def read_rpm_header_stream(stream: SupportsRead) -> RpmHeader:
+    """
+    Read one RPM header from a binary stream positioned at the package start.
+
+    Only the lead, signature, and main header are consumed; the payload that
+    follows is never read, so this also works on forward-only tar streams and
+    leaves the stream positioned at the start of the compressed payload.
+    """
+
+    lead = _read_exact(stream, RPM_LEAD_SIZE, "lead")
+    if lead[:4] != RPM_LEAD_MAGIC:
+        raise RpmHeaderError("Not an RPM package (bad lead magic)")
+    signature_entries, signature_store = _read_header_section(stream, "signature header")
+    # The signature header is padded so the main header starts 8-byte aligned.
+    signature_size = HEADER_INTRO.size + len(signature_entries) * INDEX_ENTRY.size + len(signature_store)
+    _read_exact(stream, -signature_size % 8, "signature padding")
+    entries, store = _read_header_section(stream, "header")
+    values = _tag_values(entries, store)
+    name = _first_string(values, RPMTAG_NAME)
+    if not name:
+        raise RpmHeaderError("RPM header has no NAME tag")
+    return RpmHeader(
+        name=name,
+        version=_first_string(values, RPMTAG_VERSION),
+        release=_first_string(values, RPMTAG_RELEASE),
+        arch=_first_string(values, RPMTAG_ARCH),
+        filenames=_filenames(values),
+        payload_format=_first_string(values, RPMTAG_PAYLOADFORMAT) or "cpio",
+        payload_compressor=_first_string(values, RPMTAG_PAYLOADCOMPRESSOR) or "gzip",
+    )
+
+
+def read_rpm_header(path: Path) -> RpmHeader:
+    """Read one RPM header from a file on disk."""
+
+    try:
+        with path.open("rb") as handle:
+            return read_rpm_header_stream(handle)
+    except RpmHeaderError as exc:
+        raise RpmHeaderError(f"{path}: {exc}") from exc
+
+
+class _ZstdProcessReader(io.RawIOBase):
+    """
+    Decode a zstd stream with the `zstd` command, for Pythons without a zstd module.
+
+    The child reads the RPM file descriptor directly from where the header
+    ended, and its stdout is read as the payload stream.
+    """
+
+    def __init__(self, handle: BinaryIO) -> None:
+        super().__init__()
+        # Buffered header reads moved the descriptor past the payload start.
+        os.lseek(handle.fileno(), handle.tell(), os.SEEK_SET)
+        self._process = subprocess.Popen(
+            ["zstd", "--decompress", "--stdout", "--quiet"],
+            stdin=handle.fileno(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:  # type: ignore[override]
+        assert self._process.stdout is not None
+        data = os.read(self._process.stdout.fileno(), len(buffer))
+        count = len(data)
+        buffer[:count] = data
+        if not count and self._process.wait() != 0:
+            assert self._process.stderr is not None
+            detail = self._process.stderr.read().decode("utf-8", errors="replace").strip()
+            raise RpmHeaderError(f"zstd failed: {detail or f'exit {self._process.returncode}'}")
+        return count
+
+    def close(self) -> None:
+        if not self.closed:
+            # The cpio trailer can come before the end of the stream.
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.communicate()
+        super().close()
+
+
+def _payload_decompressor(compressor: str, handle: BinaryIO) -> io.BufferedIOBase | None:
+    """Wrap the raw payload stream, or return None when nothing here can decode it."""
+
+    if compressor == "gzip":
+        return gzip.GzipFile(fileobj=handle)
+    if compressor in {"xz", "lzma"}:
+        return lzma.LZMAFile(handle)
+    if compressor == "bzip2":
+        return bz2.BZ2File(handle)
+    if compressor == "zstd":
+        if zstd is not None:
+            return zstd.ZstdFile(handle)
+        if zstandard is not None:
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(handle, closefd=False))
+        if shutil.which("zstd") is not None:
+            return io.BufferedReader(_ZstdProcessReader(handle))
+    return None
+
+
+def extract_rpm_payload(rpm_path: Path, destination_root: Path, select: PayloadSelector) -> int | None:
+    """
+    Stream one RPM's cpio payload and write the entries `select` keeps.
+
+    Directories and regular files are written with their mode and mtime; any
+    other kept entry type is an error. Returns the number of files written, or
+    None when no decoder for the payload is available (zstd below Python 3.14
+    without `zstandard` or the `zstd` command) so callers can fall back to
+    `rpm2cpio | cpio`.
+    """
+
+    with rpm_path.open("rb") as handle:
+        header = read_rpm_header_stream(handle)
+        if header.payload_format != "cpio":
+            return None
+        payload = _payload_decompressor(header.payload_compressor, handle)
+        if payload is None:
+            return None
+
+        what = f"cpio payload in {rpm_path}"
+        files_written = 0
+        with payload:
+            while True:
+                entry = _read_exact(payload, CPIO_HEADER_SIZE, what)
+                if entry[:6] not in CPIO_NEWC_MAGICS:
+                    raise RpmHeaderError(f"Unsupported cpio header in {rpm_path}: {entry[:6]!r}")
+                fields = [int(entry[6 + 8 * index : 14 + 8 * index], 16) for index in range(13)]
+                mode, mtime, file_size, name_size = fields[1], fields[5], fields[6], fields[11]
+                name = _read_exact(payload, name_size, what)[:-1].decode("utf-8", errors="surrogateescape")
+                _read_exact(payload, -(CPIO_HEADER_SIZE + name_size) % 4, what)
+                if name == CPIO_TRAILER:
+                    break
+
+                relative = select(name)
+                target = destination_root / relative if relative is not None else None
+                unread = file_size
+                if target is not None and stat.S_ISDIR(mode):
+                    target.mkdir(parents=True, exist_ok=True)
+                    target.chmod(stat.S_IMODE(mode))
+                elif target is not None and stat.S_ISREG(mode):
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    if target.is_symlink() or target.exists():
+                        target.unlink()
+                    remaining = file_size
+                    with target.open("wb") as output:
+                        while remaining:
+                            chunk = _read_exact(payload, min(remaining, COPY_CHUNK_BYTES), what)
+                            output.write(chunk)
+                            remaining -= len(chunk)
+                    target.chmod(stat.S_IMODE(mode))
+                    os.utime(target, (mtime, mtime))
+                    files_written += 1
+                    unread = 0
+                elif target is not None:
+                    raise RpmHeaderError(
+                        f"Unsupported cpio entry type {stat.filemode(mode)} for {name} in {rpm_path}"
+                    )
+
+                # Skip unread entry data plus its 4-byte padding.
+                skip = unread + (-file_size % 4)
+                while skip:
+                    skip -= len(_read_exact(payload, min(skip, COPY_CHUNK_BYTES), what))
+    return files_written
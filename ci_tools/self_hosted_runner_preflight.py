@@ -1,7 +1,7 @@
 """
 Script: ci_tools/self_hosted_runner_preflight.py
 What: Performs lightweight hygiene and disk preflight checks on self-hosted runners.
-Doing: Removes stale repo-owned temp directories, prunes unused Podman images, prints storage context, and fails early when free workspace space is below a configured threshold.
+Doing: Removes stale repo-owned temp directories, prunes unused Podman images, trims the runner blob store to its budget, prints storage context, and fails early when free workspace space is below a configured threshold.
 Why: Persistent self-hosted runners accumulate state that can turn later builds flaky or slow.
 Goal: Catch disk-pressure issues before heavy jobs start and keep stale temp leftovers from piling up.
 """
@@ -14,6 +14,7 @@ import shutil
 import subprocess
 import time
 
+from ci_tools.blob_store import BlobEvictionSummary, BlobStore, BlobStoreUsage, runner_blob_store
 from ci_tools.common import CiToolError, optional_env, require_env, run_cmd
 
 
@@ -46,6 +47,16 @@ class PodmanPruneSummary:
     skipped_reason: str = ""
 
 
+@dataclass(frozen=True)
+class BlobStoreReport:
+    """Runner blob store state after budget enforcement."""
+
+    root: str
+    max_bytes: int
+    eviction: BlobEvictionSummary
+    usage: BlobStoreUsage
+
+
 @dataclass(frozen=True)
 class RunnerPreflightSummary:
     """Result of the self-hosted runner preflight check."""
@@ -56,6 +67,7 @@ class RunnerPreflightSummary:
     required_free_bytes: int
     cleanup: CleanupSummary
     podman_prunes: tuple[PodmanPruneSummary, ...]
+    blob_store: BlobStoreReport | None = None
 
 
 def format_bytes(value: int) -> str:
@@ -262,6 +274,29 @@ def prune_unused_podman_images(
     )
 
 
+def enforce_blob_store_budget(
+    store: BlobStore,
+    *,
+    now_timestamp: float | None = None,
+) -> BlobStoreReport | None:
+    """
+    Trim the shared blob store to its byte budget and report its state.
+
+    The store lives in persistent runner storage, so without this pass it would
+    only shrink when a job happened to copy an image through it.
+    """
+
+    if not store.enabled:
+        return None
+    eviction = store.evict_to_budget(now_timestamp=now_timestamp)
+    return BlobStoreReport(
+        root=str(store.root),
+        max_bytes=store.max_bytes,
+        eviction=eviction,
+        usage=store.usage(),
+    )
+
+
 def run_preflight(
     *,
     workspace: Path,
@@ -271,6 +306,7 @@ def run_preflight(
     prune_podman_images: bool = True,
     podman_image_retention_hours: int = 24,
     aggressive_podman_prune_on_low_space: bool = True,
+    blob_store: BlobStore | None = None,
     now_timestamp: float | None = None,
 ) -> RunnerPreflightSummary:
     """Run the cleanup-plus-free-space check and return a summary object."""
@@ -282,6 +318,12 @@ def run_preflight(
         now_timestamp=now_timestamp,
     )
 
+    blob_store_report = (
+        enforce_blob_store_budget(blob_store, now_timestamp=now_timestamp)
+        if blob_store is not None
+        else None
+    )
+
     required_free_bytes = min_free_gib * BYTES_PER_GIB
     podman_prunes: list[PodmanPruneSummary] = []
 
@@ -314,6 +356,7 @@ def run_preflight(
         required_free_bytes=required_free_bytes,
         cleanup=cleanup,
         podman_prunes=tuple(podman_prunes),
+        blob_store=blob_store_report,
     )
 
 
@@ -359,6 +402,7 @@ def main() -> None:
         prune_podman_images=prune_podman_images,
         podman_image_retention_hours=podman_image_retention_hours,
         aggressive_podman_prune_on_low_space=aggressive_podman_prune_on_low_space,
+        blob_store=runner_blob_store(),
     )
 
     print(f"Runner workspace path: {summary.workspace_path}")
@@ -392,6 +436,20 @@ def main() -> None:
             f"approximately {format_bytes(podman_prune.reclaimed_bytes)} reclaimed."
         )
 
+    if summary.blob_store is not None:
+        report = summary.blob_store
+        lookups = report.usage.hits + report.usage.misses
+        print(
+            f"Runner blob store {report.root}: {report.usage.blob_count} blobs, "
+            f"{format_bytes(report.usage.total_bytes)} of {format_bytes(report.max_bytes)} budget; "
+            f"hit rate {report.usage.hit_rate:.0%} over {lookups} lookups."
+        )
+        if report.eviction.removed_blobs:
+            print(
+                f"Evicted {report.eviction.removed_blobs} least-recently-used blobs, "
+                f"reclaimed {format_bytes(report.eviction.reclaimed_bytes)}."
+            )
+
     _print_runner_storage_context(workspace=workspace, host_root=host_root)
 
     if summary.free_bytes < summary.required_free_bytes:
@@ -9,23 +9,62 @@ Goal: Preserve the current fallback-kernel behavior while moving the hard-to-rea
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import hashlib
 import json
 import os
 from pathlib import Path, PurePosixPath
 import re
 import shutil
+import stat
 import subprocess
 import tarfile
-
-
-LAYOUT_DIR = Path("/tmp/akmods-zfs")
-EXTRACT_ROOT = Path("/tmp")
-RPM_SEARCH_ROOT = EXTRACT_ROOT / "rpms" / "kmods" / "zfs"
+import threading
+from typing import Callable
+
+try:
+    # The image build copies `ci_tools/rpm_header.py` next to this script.
+    import rpm_header  # type: ignore[import-not-found, no-redef]
+except ImportError:
+    try:
+        from ci_tools import rpm_header
+    except ImportError:
+        rpm_header = None  # type: ignore[assignment]
+
+
+# Everything the helper downloads or unpacks lives under one scratch root that
+# `main` removes on exit. The Containerfile also mounts a tmpfs over `/tmp`, so
+# none of it can land in the committed image layer.
+SCRATCH_ROOT_ENV = "ZFS_AKMODS_SCRATCH_DIR"
+SCRATCH_ROOT = Path(os.environ.get(SCRATCH_ROOT_ENV) or "/tmp/akmods-zfs")
+LAYOUT_DIR = SCRATCH_ROOT / "layout"
+EXTRACT_ROOT = SCRATCH_ROOT / "extract"
+CACHED_ZFS_RPM_DIR = PurePosixPath("rpms/kmods/zfs")
+RPM_SEARCH_ROOT = EXTRACT_ROOT / CACHED_ZFS_RPM_DIR
 MODULES_ROOT = Path("/lib/modules")
+ZFS_MODULE_PATH_RE = re.compile(r"^/lib/modules/([^/]+)/extra/zfs/zfs\.ko$")
+# One `rpm -qp` call prints `@@ <name>` and then every payload path per RPM.
+BATCHED_RPM_QUERYFORMAT = "@@ %{NAME}\n[%{FILENAMES}\n]"
+# Per-kernel payload and depmod work runs on a small thread pool.
+KERNEL_WORKERS_ENV = "ZFS_KERNEL_WORKERS"
+DEFAULT_KERNEL_WORKERS = 4
+# `rpm2cpio | cpio` writes the whole payload, including files shared by every
+# kernel's RPM, so fallback unpacks still run one at a time.
+_FALLBACK_UNPACK_LOCK = threading.Lock()
 DEFAULT_AKMODS_IMAGE_TEMPLATE = (
     "ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-{fedora}"
 )
+# Shared-cache labels built by `shared_cache_labels`. These
+# mirror the constants in `ci_tools/common.py`, which this helper cannot import.
+AKMODS_CACHE_METADATA_VERSION = "1"
+AKMODS_CACHE_METADATA_VERSION_LABEL = "io.github.danathar.kinoite-zfs.akmods.cache-format"
+AKMODS_CACHE_KERNEL_RELEASES_LABEL = "io.github.danathar.kinoite-zfs.akmods.kernel-releases"
+AKMODS_INSTALL_MANIFEST_PATH = "rpms/kmods/zfs/install-manifest.json"
+AKMODS_INSTALL_MANIFEST_VERSION = 1
+INSTALL_MANIFEST_FILE = EXTRACT_ROOT / AKMODS_INSTALL_MANIFEST_PATH
+AKMODS_KMOD_OVERLAY_DIR = "kmod-overlay"
+KMOD_OVERLAY_ROOT = EXTRACT_ROOT / AKMODS_KMOD_OVERLAY_DIR
 
 
 @dataclass(frozen=True)
@@ -131,6 +170,54 @@ def resolve_akmods_image(
     return image_template.format(fedora=fedora_major_version(run_cmd=run_cmd))
 
 
+def cache_kernel_releases_from_labels(image_ref: str, *, run_cmd=_run_cmd) -> list[str] | None:
+    """
+    Return the kernel releases the cache image advertises in its labels.
+
+    `skopeo inspect` reads only the manifest and config, not the layers.
+    Returns None for older cache images without the metadata labels.
+    """
+
+    inspect_json = json.loads(
+        run_cmd(["skopeo", "inspect", "--retry-times", "3", f"docker://{image_ref}"])
+    )
+    labels = inspect_json.get("Labels") or {}
+    if str(labels.get(AKMODS_CACHE_METADATA_VERSION_LABEL) or "") != AKMODS_CACHE_METADATA_VERSION:
+        return None
+    kernel_releases = str(labels.get(AKMODS_CACHE_KERNEL_RELEASES_LABEL) or "").split()
+    return kernel_releases or None
+
+
+def check_cache_labels_cover_kernels(
+    image_ref: str,
+    image_kernels: list[str],
+    *,
+    run_cmd=_run_cmd,
+) -> None:
+    """
+    Fail before any layer download when the cache labels miss a base kernel.
+
+    Why check here when `build_install_plan` checks again later:
+    1. The plan only runs after the whole cache image is copied and unpacked.
+    2. The labels answer the same coverage question from one small request.
+    3. Images without labels keep the old behavior and are checked by the plan.
+    """
+
+    cached_kernels = cache_kernel_releases_from_labels(image_ref, run_cmd=run_cmd)
+    if cached_kernels is None:
+        print(f"No kernel-release labels on {image_ref}; coverage is checked after download.")
+        return
+
+    missing = [kernel for kernel in image_kernels if kernel not in cached_kernels]
+    if missing:
+        raise RuntimeError(
+            f"Cached akmods image {image_ref} has no ZFS RPMs for base kernel(s) "
+            f"{', '.join(missing)} (it covers {', '.join(cached_kernels)}). "
+            "Cached akmods are stale; rebuild akmods."
+        )
+    print(f"Cache labels on {image_ref} cover base kernels: {', '.join(image_kernels)}")
+
+
 def copy_oci_layout_from_registry(image_ref: str, layout_dir: Path = LAYOUT_DIR) -> None:
     """Pull the akmods cache image into a local `dir:` OCI layout."""
 
@@ -168,7 +255,7 @@ def _is_safe_tar_member(name: str) -> bool:
     """
     Reject absolute or parent-directory entries before extraction.
 
-    Why: the cache image is expected to unpack under `/tmp`, not escape it.
+    Why: the cache image is expected to unpack under the scratch root, not escape it.
     Matching the old shell guard here keeps the helper fail-closed.
     """
 
@@ -176,17 +263,61 @@ def _is_safe_tar_member(name: str) -> bool:
     return not path.is_absolute() and ".." not in path.parts
 
 
-def unpack_layer_tarballs(layer_files: list[Path], destination: Path) -> None:
-    """Extract every layer tarball after validating member paths."""
+def _is_cached_zfs_rpm(name: str) -> bool:
+    """True for RPM files directly inside the cache image's ZFS RPM directory."""
+
+    path = PurePosixPath(name.removeprefix("./"))
+    return path.parent == CACHED_ZFS_RPM_DIR and path.suffix == ".rpm"
+
+
+def _is_install_manifest(name: str) -> bool:
+    return name.removeprefix("./") == AKMODS_INSTALL_MANIFEST_PATH
+
+
+def _is_kmod_overlay_file(name: str) -> bool:
+    return PurePosixPath(name.removeprefix("./")).parts[:1] == (AKMODS_KMOD_OVERLAY_DIR,)
+
+
+def unpack_layer_tarballs(layer_files: list[Path], destination: Path) -> int:
+    """
+    Extract only the cached ZFS RPMs from every layer tarball.
+
+    Each layer is read once as a forward-only stream (`r|*`), so the member
+    list is never held in memory. Every member is still path-checked, but only
+    `rpms/kmods/zfs/*.rpm` files, the install manifest, and the prebuilt
+    `kmod-overlay/` files are written; `kernel-rpms/` and anything else is
+    skipped. Returns the number of RPM files written.
+    """
 
+    extracted = 0
+    extracted_bytes = 0
+    overlay_files = 0
     for layer_path in layer_files:
-        with tarfile.open(layer_path) as layer_tar:
-            for member in layer_tar.getmembers():
+        with tarfile.open(layer_path, "r|*") as layer_tar:
+            for member in layer_tar:
                 if not _is_safe_tar_member(member.name):
                     raise RuntimeError(
                         f"Unsafe tar path found in layer {layer_path}: {member.name}"
                     )
-            layer_tar.extractall(destination)
+                if not member.isfile():
+                    continue
+                if _is_install_manifest(member.name):
+                    layer_tar.extract(member, destination, filter="data")
+                    continue
+                if _is_kmod_overlay_file(member.name):
+                    layer_tar.extract(member, destination, filter="data")
+                    overlay_files += 1
+                    continue
+                if not _is_cached_zfs_rpm(member.name):
+                    continue
+                layer_tar.extract(member, destination, filter="data")
+                extracted += 1
+                extracted_bytes += member.size
+    print(
+        f"Extracted {extracted} ZFS RPMs ({extracted_bytes} bytes) "
+        f"and {overlay_files} kmod overlay files from {len(layer_files)} cache layers."
+    )
+    return extracted
 
 
 def discover_zfs_rpms(rpm_root: Path = RPM_SEARCH_ROOT) -> list[Path]:
@@ -207,8 +338,15 @@ def discover_zfs_rpms(rpm_root: Path = RPM_SEARCH_ROOT) -> list[Path]:
 
 
 def rpm_name(rpm_path: Path) -> str:
-    """Read the RPM package name from one cached RPM file."""
+    """
+    Read the RPM package name from one cached RPM file.
+
+    The header is parsed in-process when `rpm_header` is available; `rpm -qp`
+    stays as the fallback so the helper still works on its own.
+    """
 
+    if rpm_header is not None:
+        return rpm_header.read_rpm_header(rpm_path).name
     return _run_cmd(
         ["rpm", "-qp", "--qf", "%{NAME}\n", str(rpm_path)]
     ).strip()
@@ -222,14 +360,143 @@ def kmod_kernel_release(rpm_path: Path) -> str:
     reliable signal. File names alone would be easier to parse incorrectly.
     """
 
+    if rpm_header is not None:
+        kernel_release = rpm_header.read_rpm_header(rpm_path).kernel_release_for_module()
+        if kernel_release:
+            return kernel_release
+        raise RuntimeError(f"Could not determine kernel release for {rpm_path}")
+
     payload_listing = _run_cmd(["rpm", "-qpl", str(rpm_path)])
     for line in payload_listing.splitlines():
-        match = re.match(r"^/lib/modules/([^/]+)/extra/zfs/zfs\.ko$", line)
+        match = ZFS_MODULE_PATH_RE.match(line)
         if match:
             return match.group(1)
     raise RuntimeError(f"Could not determine kernel release for {rpm_path}")
 
 
+@dataclass(frozen=True)
+class BatchedRpmQuery:
+    """
+    Names and kmod kernel releases for many RPMs from one `rpm -qp` call.
+
+    Why this exists:
+    1. Without `rpm_header`, `rpm_name` and `kmod_kernel_release` spawn one or
+       two `rpm` processes per cached RPM.
+    2. `rpm -qp` accepts many package files and a queryformat that prints the
+       name and the whole file list per package, in argument order.
+    3. The bound `rpm_name` / `kmod_kernel_release` methods plug straight into
+       the `build_install_plan` lookup arguments.
+    """
+
+    names: dict[Path, str]
+    kernel_releases: dict[Path, str]
+
+    @classmethod
+    def query(cls, rpm_paths: list[Path], *, run_cmd=_run_cmd) -> "BatchedRpmQuery":
+        names: dict[Path, str] = {}
+        kernel_releases: dict[Path, str] = {}
+        if not rpm_paths:
+            return cls(names=names, kernel_releases=kernel_releases)
+
+        output = run_cmd(
+            [
+                "rpm",
+                "-qp",
+                "--qf",
+                BATCHED_RPM_QUERYFORMAT,
+                *(str(rpm_path) for rpm_path in rpm_paths),
+            ]
+        )
+        packages: list[tuple[str, str]] = []
+        for line in output.splitlines():
+            if line.startswith("@@ "):
+                packages.append((line[3:].strip(), ""))
+                continue
+            match = ZFS_MODULE_PATH_RE.match(line)
+            if packages and match and not packages[-1][1]:
+                packages[-1] = (packages[-1][0], match.group(1))
+        if len(packages) != len(rpm_paths):
+            raise RuntimeError(
+                f"rpm -qp returned {len(packages)} packages for {len(rpm_paths)} RPM files"
+            )
+        for rpm_path, (name, kernel_release) in zip(rpm_paths, packages):
+            names[rpm_path] = name
+            if kernel_release:
+                kernel_releases[rpm_path] = kernel_release
+        return cls(names=names, kernel_releases=kernel_releases)
+
+    def rpm_name(self, rpm_path: Path) -> str:
+        return self.names[rpm_path]
+
+    def kmod_kernel_release(self, rpm_path: Path) -> str:
+        kernel_release = self.kernel_releases.get(rpm_path)
+        if not kernel_release:
+            raise RuntimeError(f"Could not determine kernel release for {rpm_path}")
+        return kernel_release
+
+
+@dataclass(frozen=True)
+class InstallManifest:
+    """
+    RPM names and kmod kernel releases precomputed when the cache was published.
+
+    Why trust a document instead of the RPM headers:
+    1. The merge step already read every header once, on the publishing runner.
+    2. Each entry carries the RPM's sha256, so the document is used only when
+       every discovered RPM matches it byte for byte.
+    3. Missing, older, or mismatched documents return None from `load`, and
+       the helper falls back to reading the RPMs themselves.
+    """
+
+    names: dict[Path, str]
+    kernel_releases: dict[Path, str]
+
+    @classmethod
+    def load(
+        cls,
+        rpm_paths: list[Path],
+        manifest_path: Path = INSTALL_MANIFEST_FILE,
+    ) -> "InstallManifest | None":
+        if not manifest_path.is_file():
+            print(f"No install manifest at {manifest_path}; reading RPM headers instead.")
+            return None
+        try:
+            document = json.loads(manifest_path.read_text(encoding="utf-8"))
+        except ValueError as exc:
+            print(f"Ignoring unreadable install manifest {manifest_path}: {exc}")
+            return None
+        if document.get("schemaVersion") != AKMODS_INSTALL_MANIFEST_VERSION:
+            print(f"Ignoring install manifest with schema {document.get('schemaVersion')!r}.")
+            return None
+
+        entries = {str(entry.get("file") or ""): entry for entry in document.get("rpms") or []}
+        names: dict[Path, str] = {}
+        kernel_releases: dict[Path, str] = {}
+        for rpm_path in rpm_paths:
+            entry = entries.get(rpm_path.name)
+            if entry is None:
+                print(f"Install manifest does not list {rpm_path.name}; reading RPM headers instead.")
+                return None
+            with rpm_path.open("rb") as handle:
+                sha256 = hashlib.file_digest(handle, "sha256").hexdigest()
+            if sha256 != entry.get("sha256"):
+                print(f"Install manifest checksum mismatch for {rpm_path.name}; reading RPM headers instead.")
+                return None
+            names[rpm_path] = str(entry.get("name") or "")
+            if entry.get("kernelRelease"):
+                kernel_releases[rpm_path] = str(entry["kernelRelease"])
+        return cls(names=names, kernel_releases=kernel_releases)
+
+    def rpm_name(self, rpm_path: Path) -> str:
+        return self.names[rpm_path]
+
+    def kmod_kernel_release(self, rpm_path: Path) -> str:
+        kernel_release = self.kernel_releases.get(rpm_path)
+        if not kernel_release:
+            raise RuntimeError(f"Could not determine kernel release for {rpm_path}")
+        return kernel_release
+
+
 def version_sort_key(value: str) -> list[tuple[int, object]]:
     """
     Natural-sort key for kernel release strings.
@@ -352,47 +619,276 @@ def unpack_rpm_payload(rpm_path: Path, destination_root: Path = Path("/")) -> No
         raise RuntimeError(f"cpio failed for {rpm_path}: {detail}")
 
 
-def apply_extra_kmod_payloads(plan: InstallPlan) -> None:
-    """Unpack all non-primary kernel-module RPM payloads into the image root."""
+def _module_tree_path(name: str, kernel_release: str) -> PurePosixPath | None:
+    """
+    Return the relative path for payload entries inside the kernel's module tree.
 
-    if len(plan.image_kernels) <= 1:
-        return
+    Only `/lib/modules/<kernel_release>/...` (or its `/usr/lib` spelling) is
+    kept; everything else in the payload is skipped without being written.
+    """
 
+    relative = name.removeprefix("./").lstrip("/")
+    if not _is_safe_tar_member(relative):
+        raise RuntimeError(f"Unsafe cpio path found in RPM payload: {name}")
+    path = PurePosixPath(relative)
+    for prefix in (("lib", "modules", kernel_release), ("usr", "lib", "modules", kernel_release)):
+        if path.parts[: len(prefix)] == prefix:
+            return path
+    return None
+
+
+def extract_kmod_payload(
+    rpm_path: Path,
+    kernel_release: str,
+    destination_root: Path = Path("/"),
+) -> int | None:
+    """
+    Stream one kmod RPM payload and write only its kernel module tree.
+
+    This replaces `rpm2cpio | cpio -idmu`: the RPM header is read in-process,
+    the payload is decompressed as a stream, and `newc` cpio entries under
+    `/lib/modules/<kernel_release>/` are written with their mode and mtime.
+    Fedora's zstd payloads need Python 3.14+, the `zstandard` package, or the
+    `zstd` command. Returns the number of files written, or None when none of
+    those can decode the payload so the caller can use the external tools
+    instead.
+    """
+
+    if rpm_header is None:
+        return None
+    return rpm_header.extract_rpm_payload(
+        rpm_path,
+        destination_root,
+        lambda name: _module_tree_path(name, kernel_release),
+    )
+
+
+def kernel_worker_count(environ: os._Environ[str] | dict[str, str] = os.environ) -> int:
+    """Return the per-kernel worker pool size (`ZFS_KERNEL_WORKERS`, default 4)."""
+
+    value = environ.get(KERNEL_WORKERS_ENV, "").strip()
+    if not value:
+        return DEFAULT_KERNEL_WORKERS
+    try:
+        return max(1, int(value))
+    except ValueError as exc:
+        raise RuntimeError(f"{KERNEL_WORKERS_ENV} must be an integer, got {value!r}") from exc
+
+
+class _SkippedKernel(RuntimeError):
+    """Internal marker for kernel tasks skipped after another task failed."""
+
+
+def run_per_kernel(
+    kernel_releases: list[str],
+    task: Callable[[str], list[str]],
+    *,
+    max_workers: int,
+    title: str,
+) -> None:
+    """
+    Run one independent task per kernel release on a bounded thread pool.
+
+    Why this shape:
+    1. Each kernel's work touches only its own `/lib/modules/<release>` tree.
+    2. Tasks return their log lines instead of printing, and the lines are
+       printed in `kernel_releases` order, so logs do not depend on scheduling.
+    3. The first task to fail stops queued tasks from starting, and that first
+       failure is the one raised once running tasks finish.
+    """
+
+    failures: list[BaseException] = []
+    failures_lock = threading.Lock()
+
+    def _guarded(kernel_release: str) -> list[str]:
+        with failures_lock:
+            if failures:
+                raise _SkippedKernel(kernel_release)
+        try:
+            return task(kernel_release)
+        except BaseException as exc:
+            with failures_lock:
+                failures.append(exc)
+            raise
+
+    workers = max(1, min(max_workers, len(kernel_releases)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_guarded, release) for release in kernel_releases]
+
+    print(f"{title} ({len(kernel_releases)} kernels, {workers} workers):")
+    for kernel_release, future in zip(kernel_releases, futures):
+        error = future.exception()
+        if error is None:
+            for line in future.result():
+                print(f"  {kernel_release}: {line}")
+        elif isinstance(error, _SkippedKernel):
+            print(f"  {kernel_release}: skipped after an earlier failure")
+        else:
+            print(f"  {kernel_release}: failed: {error}")
+    if failures:
+        raise failures[0]
+
+
+def _apply_one_kmod_payload(kmod_rpm: Path, kernel_release: str) -> list[str]:
+    files_written = extract_kmod_payload(kmod_rpm, kernel_release)
+    if files_written is not None:
+        return [f"extracted {files_written} module files from {kmod_rpm.name}"]
     _require_command("rpm2cpio")
     _require_command("cpio")
-
-    for kernel_release in plan.image_kernels:
-        kmod_rpm = plan.kmod_rpm_by_kernel[kernel_release]
-        if kmod_rpm == plan.primary_kmod_rpm:
-            continue
+    with _FALLBACK_UNPACK_LOCK:
         unpack_rpm_payload(kmod_rpm)
+    return [
+        f"Warning: cannot decode the payload of {kmod_rpm.name} in-process (zstd needs "
+        "Python 3.14+, the zstandard package, or the zstd command); fell back to "
+        "rpm2cpio | cpio, one kernel at a time",
+        f"unpacked {kmod_rpm.name} with rpm2cpio | cpio",
+    ]
+
+
+def fallback_kernels(plan: InstallPlan) -> list[str]:
+    """Base-image kernels whose modules do not come from the `rpm-ostree` install."""
+
+    return [
+        kernel_release
+        for kernel_release in plan.image_kernels
+        if plan.kmod_rpm_by_kernel[kernel_release] != plan.primary_kmod_rpm
+    ]
+
+
+def apply_kmod_overlay(
+    plan: InstallPlan,
+    *,
+    overlay_root: Path = KMOD_OVERLAY_ROOT,
+    modules_root: Path = MODULES_ROOT,
+) -> bool:
+    """
+    Copy the cache image's prebuilt fallback-kernel module trees into place.
+
+    The publish step unpacks `kmod-overlay/<kernel_release>/` from the same
+    RPMs this image carries. It is used only when its kernel set is exactly the
+    base image's fallback kernels; otherwise this returns False and the caller
+    unpacks the RPM payloads as before.
+    """
+
+    if not overlay_root.is_dir():
+        return False
+    overlay_kernels = sorted(path.name for path in overlay_root.iterdir() if path.is_dir())
+    expected_kernels = sorted(fallback_kernels(plan))
+    if overlay_kernels != expected_kernels:
+        print(
+            f"kmod overlay covers {' '.join(overlay_kernels) or 'no kernels'}, but the fallback "
+            f"kernels are {' '.join(expected_kernels) or 'none'}; unpacking RPM payloads instead."
+        )
+        return False
+
+    for kernel_release in overlay_kernels:
+        shutil.copytree(
+            overlay_root / kernel_release,
+            modules_root / kernel_release,
+            symlinks=True,
+            dirs_exist_ok=True,
+        )
+    print(f"Copied prebuilt kmod overlay for fallback kernels: {' '.join(overlay_kernels)}")
+    return True
+
+
+def apply_extra_kmod_payloads(plan: InstallPlan, *, max_workers: int = DEFAULT_KERNEL_WORKERS) -> None:
+    """
+    Unpack all non-primary kernel-module RPM payloads into the image root.
+
+    The in-process extractor handles the usual case; `rpm2cpio | cpio` is only
+    required when this Python cannot decode a payload. Kernels are handled in
+    parallel because each payload lands in its own module tree.
+    """
+
+    if len(plan.image_kernels) <= 1:
+        return
+
+    run_per_kernel(
+        fallback_kernels(plan),
+        lambda kernel_release: _apply_one_kmod_payload(
+            plan.kmod_rpm_by_kernel[kernel_release],
+            kernel_release,
+        ),
+        max_workers=max_workers,
+        title="Applying fallback-kernel ZFS payloads",
+    )
+
+
+def _validate_one_kernel(kernel_release: str, modules_root: Path) -> list[str]:
+    module_path = modules_root / kernel_release / "extra" / "zfs" / "zfs.ko"
+    if not module_path.is_file():
+        raise RuntimeError(
+            "No ZFS module for base kernel "
+            f"{kernel_release}. Cached akmods are stale; rebuild akmods."
+        )
+    output = _run_cmd(["depmod", "-a", kernel_release])
+    return ["depmod ok", *output.splitlines()]
 
 
 def validate_installed_modules(
     image_kernels: list[str],
     *,
     modules_root: Path = MODULES_ROOT,
+    max_workers: int = DEFAULT_KERNEL_WORKERS,
 ) -> None:
     """
     Verify ZFS modules exist for every base-image kernel and refresh depmod.
 
     During image builds `uname -r` usually points at the builder kernel, not the
     target image kernel, so we must run `depmod` manually for each release.
+    Each `depmod -a <release>` only rewrites that release's module indexes, so
+    the kernels run in parallel.
     """
 
-    for kernel_release in image_kernels:
-        module_path = modules_root / kernel_release / "extra" / "zfs" / "zfs.ko"
-        if not module_path.is_file():
-            raise RuntimeError(
-                "No ZFS module for base kernel "
-                f"{kernel_release}. Cached akmods are stale; rebuild akmods."
-            )
-        _run_cmd(["depmod", "-a", kernel_release], capture_output=False)
+    run_per_kernel(
+        image_kernels,
+        lambda kernel_release: _validate_one_kernel(kernel_release, modules_root),
+        max_workers=max_workers,
+        title="Validating ZFS modules and running depmod",
+    )
+
+
+def scratch_usage_bytes(scratch_root: Path) -> int:
+    """Return the apparent size of every regular file under `scratch_root`."""
+
+    total = 0
+    for directory, _subdirs, files in os.walk(scratch_root):
+        for name in files:
+            path_stat = os.lstat(os.path.join(directory, name))
+            if stat.S_ISREG(path_stat.st_mode):
+                total += path_stat.st_size
+    return total
+
+
+def remove_scratch_root(scratch_root: Path = SCRATCH_ROOT) -> None:
+    """
+    Report and delete the helper's scratch data, on success or failure.
+
+    The layout copy holds the whole compressed cache image, kernel RPMs
+    included. Anything left behind would be committed into this `RUN` layer and
+    shipped to every host on every update.
+    """
+
+    if not scratch_root.exists():
+        return
+    used = scratch_usage_bytes(scratch_root)
+    shutil.rmtree(scratch_root)
+    print(f"Removed akmods scratch data at {scratch_root} ({used / (1 << 20):.1f} MiB).")
 
 
 def main() -> None:
     """Apply the cached akmods image to the build root."""
 
+    try:
+        install_from_akmods_cache()
+    finally:
+        remove_scratch_root()
+
+
+def install_from_akmods_cache() -> None:
+    """Download the cache image into the scratch root and install from it."""
+
     _require_command("python3")
     _require_command("rpm")
     _require_command("rpm-ostree")
@@ -401,15 +897,35 @@ def main() -> None:
 
     image_ref = resolve_akmods_image()
     image_kernels = image_kernels_from_modules_root()
+    check_cache_labels_cover_kernels(image_ref, image_kernels)
     copy_oci_layout_from_registry(image_ref)
     layer_files = load_layer_files_from_oci_layout(LAYOUT_DIR)
     unpack_layer_tarballs(layer_files, EXTRACT_ROOT)
     zfs_rpms = discover_zfs_rpms()
-    install_plan = build_install_plan(image_kernels, zfs_rpms)
+    install_manifest = InstallManifest.load(zfs_rpms)
+    if install_manifest is not None:
+        install_plan = build_install_plan(
+            image_kernels,
+            zfs_rpms,
+            rpm_name_lookup=install_manifest.rpm_name,
+            kernel_release_lookup=install_manifest.kmod_kernel_release,
+        )
+    elif rpm_header is not None:
+        install_plan = build_install_plan(image_kernels, zfs_rpms)
+    else:
+        rpm_query = BatchedRpmQuery.query(zfs_rpms)
+        install_plan = build_install_plan(
+            image_kernels,
+            zfs_rpms,
+            rpm_name_lookup=rpm_query.rpm_name,
+            kernel_release_lookup=rpm_query.kmod_kernel_release,
+        )
 
     rpm_ostree_install([*install_plan.managed_rpms, install_plan.primary_kmod_rpm])
-    apply_extra_kmod_payloads(install_plan)
-    validate_installed_modules(install_plan.image_kernels)
+    max_workers = kernel_worker_count()
+    if not apply_kmod_overlay(install_plan):
+        apply_extra_kmod_payloads(install_plan, max_workers=max_workers)
+    validate_installed_modules(install_plan.image_kernels, max_workers=max_workers)
 
 
 if __name__ == "__main__":
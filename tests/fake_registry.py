@@ -0,0 +1,321 @@
+"""
+Script: tests/fake_registry.py
+What: In-process OCI registry stand-in used by registry-client tests.
+Doing: Serves the small slice of the distribution API the helpers use (manifests, blobs, uploads, tag lists, bearer tokens) from memory on `127.0.0.1`.
+Why: Registry-facing code should be tested against real HTTP round-trips without network access.
+Goal: Let tests count requests, connections, and token exchanges to prove pooling and caching.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER_GZIP = "application/vnd.oci.image.layer.v1.tar+gzip"
+UPLOAD_RE = re.compile(r"^/v2/(.+)/blobs/uploads/(.*)$")
+API_RE = re.compile(r"^/v2/(.+)/(manifests|blobs|tags)/(.*)$")
+
+
+def digest_of(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class FakeRepository:
+    manifests: dict[str, tuple[str, bytes]] = field(default_factory=dict)
+    tags: dict[str, str] = field(default_factory=dict)
+    blobs: dict[str, bytes] = field(default_factory=dict)
+
+
+class FakeRegistry:
+    """
+    Memory-backed registry served over plain HTTP/1.1 with keep-alive.
+
+    `require_auth=True` makes every `/v2/` request demand a bearer token that
+    the `/token` endpoint hands out, like GHCR and quay.io do.
+    """
+
+    def __init__(self, *, require_auth: bool = False, tag_page_size: int = 0) -> None:
+        self.require_auth = require_auth
+        self.tag_page_size = tag_page_size
+        self.repositories: dict[str, FakeRepository] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.token_requests: list[str] = []
+        self.connections: set[tuple[str, int]] = set()
+        self.fail_paths: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._uploads: dict[str, str] = {}
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self) -> "FakeRegistry":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_exc: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Content helpers -----------------------------------------------------
+
+    def repository(self, name: str) -> FakeRepository:
+        return self.repositories.setdefault(name, FakeRepository())
+
+    def add_blob(self, repo: str, data: bytes) -> str:
+        digest = digest_of(data)
+        self.repository(repo).blobs[digest] = data
+        return digest
+
+    def add_manifest(self, repo: str, manifest: dict | bytes, *, media_type: str = OCI_MANIFEST, tag: str = "") -> str:
+        body = manifest if isinstance(manifest, bytes) else json.dumps(manifest).encode("utf-8")
+        digest = digest_of(body)
+        repository = self.repository(repo)
+        repository.manifests[digest] = (media_type, body)
+        if tag:
+            repository.tags[tag] = digest
+        return digest
+
+    def add_image(
+        self,
+        repo: str,
+        tag: str,
+        *,
+        layers: list[bytes] | None = None,
+        labels: dict[str, str] | None = None,
+        diff_ids: list[str] | None = None,
+        architecture: str = "amd64",
+    ) -> str:
+        """Store one single-platform image and return its manifest digest."""
+
+        layers = layers or []
+        config = {
+            "architecture": architecture,
+            "os": "linux",
+            "created": "2026-01-01T00:00:00Z",
+            "config": {"Labels": labels or {}},
+            "rootfs": {"type": "layers", "diff_ids": diff_ids or [digest_of(layer) for layer in layers]},
+        }
+        config_bytes = json.dumps(config).encode("utf-8")
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": OCI_MANIFEST,
+            "config": {
+                "mediaType": OCI_CONFIG,
+                "digest": self.add_blob(repo, config_bytes),
+                "size": len(config_bytes),
+            },
+            "layers": [
+                {
+                    "mediaType": OCI_LAYER_GZIP,
+                    "digest": self.add_blob(repo, layer),
+                    "size": len(layer),
+                }
+                for layer in layers
+            ],
+        }
+        return self.add_manifest(repo, manifest, tag=tag)
+
+    def count(self, method: str, fragment: str = "") -> int:
+        with self._lock:
+            return sum(1 for seen_method, path in self.requests if seen_method == method and fragment in path)
+
+    # HTTP handling -------------------------------------------------------
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_args: object) -> None:
+                return
+
+            def _reply(
+                self,
+                status: int,
+                body: bytes = b"",
+                headers: dict[str, str] | None = None,
+                *,
+                send_body: bool = True,
+            ) -> None:
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if send_body and body:
+                    self.wfile.write(body)
+
+            def _error(self, status: int, code: str) -> None:
+                body = json.dumps({"errors": [{"code": code}]}).encode("utf-8")
+                self._reply(status, body, {"Content-Type": "application/json"}, send_body=self.command != "HEAD")
+
+            def _read_body(self) -> bytes:
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _authorized(self) -> bool:
+                if not registry.require_auth:
+                    return True
+                return (self.headers.get("Authorization") or "").startswith("Bearer tok-")
+
+            def _handle(self) -> None:
+                parts = urlsplit(self.path)
+                with registry._lock:
+                    registry.requests.append((self.command, parts.path))
+                    registry.connections.add(self.client_address)
+                    remaining_failures = registry.fail_paths.get(parts.path, 0)
+                    if remaining_failures:
+                        registry.fail_paths[parts.path] = remaining_failures - 1
+                if remaining_failures:
+                    self._read_body()
+                    self._error(503, "UNAVAILABLE")
+                    return
+                query = parse_qs(parts.query)
+
+                if parts.path == "/token":
+                    with registry._lock:
+                        registry.token_requests.append(" ".join(query.get("scope", [])))
+                        token = f"tok-{len(registry.token_requests)}"
+                    self._reply(200, json.dumps({"token": token, "expires_in": 300}).encode("utf-8"))
+                    return
+
+                if not parts.path.startswith("/v2/"):
+                    self._error(404, "NOT_FOUND")
+                    return
+                if not self._authorized():
+                    self._read_body()
+                    challenge = (
+                        f'Bearer realm="http://{registry.host}/token",service="fake-registry"'
+                    )
+                    self._reply(401, b"", {"WWW-Authenticate": challenge})
+                    return
+
+                upload_match = UPLOAD_RE.match(parts.path)
+                if upload_match:
+                    self._handle_upload(upload_match.group(1), upload_match.group(2), query)
+                    return
+
+                match = API_RE.match(parts.path)
+                if not match:
+                    self._error(404, "NOT_FOUND")
+                    return
+                repo_name, kind, reference = match.groups()
+                if kind == "tags":
+                    self._handle_tags(repo_name, query)
+                elif kind == "manifests":
+                    self._handle_manifest(repo_name, reference)
+                else:
+                    self._handle_blob(repo_name, reference)
+
+            def _handle_tags(self, repo_name: str, query: dict[str, list[str]]) -> None:
+                repository = registry.repositories.get(repo_name)
+                if repository is None:
+                    self._error(404, "NAME_UNKNOWN")
+                    return
+                tags = sorted(repository.tags)
+                last = query.get("last", [""])[0]
+                if last:
+                    tags = [tag for tag in tags if tag > last]
+                page_size = int(query.get("n", [str(registry.tag_page_size)])[0] or 0)
+                headers = {"Content-Type": "application/json"}
+                if page_size and len(tags) > page_size:
+                    tags = tags[:page_size]
+                    headers["Link"] = f'</v2/{repo_name}/tags/list?n={page_size}&last={tags[-1]}>; rel="next"'
+                body = json.dumps({"name": repo_name, "tags": tags}).encode("utf-8")
+                self._reply(200, body, headers)
+
+            def _handle_manifest(self, repo_name: str, reference: str) -> None:
+                repository = registry.repository(repo_name)
+                if self.command == "PUT":
+                    body = self._read_body()
+                    media_type = self.headers.get("Content-Type") or OCI_MANIFEST
+                    digest = digest_of(body)
+                    with registry._lock:
+                        repository.manifests[digest] = (media_type, body)
+                        if not reference.startswith("sha256:"):
+                            repository.tags[reference] = digest
+                    self._reply(201, b"", {"Docker-Content-Digest": digest})
+                    return
+                digest = reference if reference.startswith("sha256:") else repository.tags.get(reference, "")
+                if digest not in repository.manifests:
+                    self._error(404, "MANIFEST_UNKNOWN")
+                    return
+                media_type, body = repository.manifests[digest]
+                headers = {"Content-Type": media_type, "Docker-Content-Digest": digest}
+                if self.command == "HEAD":
+                    self.send_response(200)
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    return
+                self._reply(200, body, headers)
+
+            def _handle_blob(self, repo_name: str, digest: str) -> None:
+                repository = registry.repositories.get(repo_name)
+                data = repository.blobs.get(digest) if repository else None
+                if data is None:
+                    self._error(404, "BLOB_UNKNOWN")
+                    return
+                if self.command == "HEAD":
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.send_header("Docker-Content-Digest", digest)
+                    self.end_headers()
+                    return
+                self._reply(200, data, {"Content-Type": "application/octet-stream"})
+
+            def _handle_upload(self, repo_name: str, upload_id: str, query: dict[str, list[str]]) -> None:
+                repository = registry.repository(repo_name)
+                body = self._read_body()
+                if self.command == "POST":
+                    mount = query.get("mount", [""])[0]
+                    source = registry.repositories.get(query.get("from", [""])[0])
+                    if mount and source is not None and mount in source.blobs:
+                        repository.blobs[mount] = source.blobs[mount]
+                        self._reply(201, b"", {"Docker-Content-Digest": mount})
+                        return
+                    new_id = uuid.uuid4().hex
+                    with registry._lock:
+                        registry._uploads[new_id] = repo_name
+                    self._reply(202, b"", {"Location": f"/v2/{repo_name}/blobs/uploads/{new_id}"})
+                    return
+                if self.command == "PUT" and upload_id in registry._uploads:
+                    digest = query.get("digest", [""])[0]
+                    if digest_of(body) != digest:
+                        self._error(400, "DIGEST_INVALID")
+                        return
+                    repository.blobs[digest] = body
+                    self._reply(201, b"", {"Docker-Content-Digest": digest})
+                    return
+                self._error(404, "BLOB_UPLOAD_UNKNOWN")
+
+            def do_GET(self) -> None:  # noqa: N802 - http.server naming
+                self._handle()
+
+            def do_HEAD(self) -> None:  # noqa: N802
+                self._handle()
+
+            def do_PUT(self) -> None:  # noqa: N802
+                self._handle()
+
+            def do_POST(self) -> None:  # noqa: N802
+                self._handle()
+
+        return Handler
@@ -0,0 +1,137 @@
+"""
+Script: tests/fake_rpm.py
+What: Builds small synthetic RPM files for tests.
+Doing: Writes a real RPM lead, signature header, and main header (NAME, VERSION, RELEASE, ARCH, payload tags, and a compressed file list) followed by a caller-supplied payload, plus `newc` cpio archives for those payloads.
+Why: Header-reading code should be tested against the real on-disk layout, and `rpmbuild` is not available in unit tests.
+Goal: Let tests create kmod and userspace RPMs whose header contents differ from their file names.
+"""
+
+from __future__ import annotations
+
+import gzip
+import posixpath
+import stat
+import struct
+
+
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+HEADER_IMMUTABLE_TAG = 63
+BIN_TYPE = 7
+INT32_TYPE = 4
+STRING_TYPE = 6
+STRING_ARRAY_TYPE = 8
+
+
+def _header(entries: list[tuple[int, int, bytes, int]]) -> bytes:
+    """Serialize `(tag, type, data, count)` entries into one header structure."""
+
+    index = b""
+    store = b""
+    for tag, data_type, data, count in entries:
+        if data_type == INT32_TYPE:
+            store += b"\0" * (-len(store) % 4)
+        index += struct.pack(">iiii", tag, data_type, len(store), count)
+        store += data
+    return RPM_HEADER_MAGIC + b"\0" * 4 + struct.pack(">II", len(entries), len(store)) + index + store
+
+
+def build_cpio(entries: list[tuple[str, int, bytes]]) -> bytes:
+    """Return a `newc` cpio archive of `(name, mode, data)` entries."""
+
+    archive = b""
+    for inode, (name, mode, data) in enumerate([*entries, ("TRAILER!!!", 0, b"")], start=1):
+        encoded_name = name.encode("utf-8") + b"\0"
+        fields = [inode, mode, 0, 0, 1, 1_700_000_000, len(data), 0, 0, 0, 0, len(encoded_name), 0]
+        header = b"070701" + b"".join(b"%08X" % value for value in fields)
+        archive += header + encoded_name + b"\0" * (-(len(header) + len(encoded_name)) % 4)
+        archive += data + b"\0" * (-len(data) % 4)
+    return archive
+
+
+def cpio_file(name: str, data: bytes, permissions: int = 0o644) -> tuple[str, int, bytes]:
+    return name, stat.S_IFREG | permissions, data
+
+
+def cpio_dir(name: str) -> tuple[str, int, bytes]:
+    return name, stat.S_IFDIR | 0o755, b""
+
+
+def _strings(values: list[str]) -> bytes:
+    return b"".join(value.encode("utf-8") + b"\0" for value in values)
+
+
+def build_rpm(
+    name: str,
+    *,
+    version: str = "2.4.1",
+    release: str = "1.fc43",
+    arch: str = "x86_64",
+    files: list[str] | None = None,
+    payload: bytes = b"payload-not-read",
+    payload_compressor: str | None = None,
+) -> bytes:
+    """Return the bytes of one RPM with the given header fields and file list."""
+
+    dirnames: list[str] = []
+    dirindexes: list[int] = []
+    basenames: list[str] = []
+    for path in files or []:
+        dirname, basename = posixpath.split(path)
+        dirname += "/"
+        if dirname not in dirnames:
+            dirnames.append(dirname)
+        dirindexes.append(dirnames.index(dirname))
+        basenames.append(basename)
+
+    # The signature header carries an odd-sized store so readers must honor
+    # the 8-byte padding before the main header.
+    signature = _header([(HEADER_IMMUTABLE_TAG, BIN_TYPE, b"\0" * 5, 5)])
+    signature += b"\0" * (-len(signature) % 8)
+    entries = [
+        (HEADER_IMMUTABLE_TAG, BIN_TYPE, b"\0" * 16, 16),
+        (1000, STRING_TYPE, _strings([name]), 1),
+        (1001, STRING_TYPE, _strings([version]), 1),
+        (1002, STRING_TYPE, _strings([release]), 1),
+        (1022, STRING_TYPE, _strings([arch]), 1),
+    ]
+    if basenames:
+        entries.extend(
+            [
+                (1116, INT32_TYPE, struct.pack(f">{len(dirindexes)}i", *dirindexes), len(dirindexes)),
+                (1117, STRING_ARRAY_TYPE, _strings(basenames), len(basenames)),
+                (1118, STRING_ARRAY_TYPE, _strings(dirnames), len(dirnames)),
+            ]
+        )
+    if payload_compressor is not None:
+        entries.extend(
+            [
+                (1124, STRING_TYPE, _strings(["cpio"]), 1),
+                (1125, STRING_TYPE, _strings([payload_compressor]), 1),
+            ]
+        )
+    lead = RPM_LEAD_MAGIC + b"\x03\x00" + b"\0" * 90
+    return lead + signature + _header(entries) + payload
+
+
+def build_kmod_rpm(kernel_release: str, *, name: str = "kmod-zfs") -> bytes:
+    """
+    Return one `kmod-zfs` RPM whose payload targets `kernel_release`.
+
+    The payload is a real gzip-compressed cpio archive holding the two module
+    files plus one config file outside the module tree.
+    """
+
+    module_dir = f"/lib/modules/{kernel_release}/extra/zfs"
+    entries = [
+        cpio_dir(f".{module_dir}"),
+        cpio_file(f".{module_dir}/spl.ko", f"spl for {kernel_release}".encode()),
+        cpio_file(f".{module_dir}/zfs.ko", f"zfs for {kernel_release}".encode()),
+        cpio_file("./etc/depmod.d/zfs.conf", b"search extra\n"),
+    ]
+    return build_rpm(
+        name,
+        files=[f"{module_dir}/spl.ko", f"{module_dir}/zfs.ko", "/etc/depmod.d/zfs.conf"],
+        payload=gzip.compress(build_cpio(entries), mtime=0),
+        payload_compressor="gzip",
+    )
@@ -8,16 +8,30 @@ Goal: Keep akmods helper behavior stable over time.
 
 from __future__ import annotations
 
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
 from pathlib import Path
+import sys
+import tarfile
 import tempfile
+import threading
 import unittest
-from unittest.mock import call, patch
+from unittest.mock import MagicMock, call, patch
 
 from ci_tools import akmods_build_and_publish as script
 from ci_tools.common import (
     AKMODS_CACHE_KERNEL_RELEASES_LABEL,
     AKMODS_CACHE_METADATA_VERSION,
     AKMODS_CACHE_METADATA_VERSION_LABEL,
+    AKMODS_INSTALL_MANIFEST_VERSION,
+    AKMODS_KMOD_OVERLAY_DIR,
+    CiToolError,
+    ImageNotFoundError,
+    run_cmd_with_log_prefix,
 )
 from ci_tools.akmods_build_and_publish import (
     build_kernel_cache_document,
@@ -25,8 +39,11 @@ from ci_tools.akmods_build_and_publish import (
     kernel_name_for_flavor,
     manifest_tag_for_kernel_release,
     merged_cache_missing_kernel_releases,
-    render_shared_cache_containerfile,
 )
+from ci_tools.oci_assembly import OCI_LAYER_GZIP_MEDIA_TYPE, ImageLayer
+from ci_tools.registry_client import RegistryClient, parse_image_ref
+from fake_registry import FakeRegistry
+from fake_rpm import build_kmod_rpm, build_rpm
 
 
 class AkmodsBuildAndPublishTests(unittest.TestCase):
@@ -109,7 +126,13 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
             merged_root = Path(temp_dir)
             rpm_dir = merged_root / "rpms" / "kmods" / "zfs"
             rpm_dir.mkdir(parents=True, exist_ok=True)
-            (rpm_dir / "kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm").touch()
+            (rpm_dir / "kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm").write_bytes(
+                build_kmod_rpm("6.18.13-200.fc43.x86_64")
+            )
+            # Named like a 6.18.16 kmod, but the header says otherwise.
+            (rpm_dir / "kmod-zfs-6.18.16-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm").write_bytes(
+                build_rpm("zfs", files=["/usr/sbin/zpool"])
+            )
 
             missing = merged_cache_missing_kernel_releases(
                 merged_root=merged_root,
@@ -121,26 +144,78 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
 
         self.assertEqual(missing, ["6.18.16-200.fc43.x86_64"])
 
-    def test_render_shared_cache_containerfile_includes_kernel_metadata_labels(self) -> None:
-        containerfile = render_shared_cache_containerfile(
-            kernel_releases=[
+    def test_build_install_manifest_records_names_kernels_and_checksums(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            merged_root = Path(temp_dir)
+            rpm_dir = merged_root / "rpms" / "kmods" / "zfs"
+            rpm_dir.mkdir(parents=True)
+            kmod_bytes = build_kmod_rpm("6.18.16-200.fc43.x86_64")
+            (rpm_dir / "kmod-zfs.rpm").write_bytes(kmod_bytes)
+            (rpm_dir / "zfs.rpm").write_bytes(build_rpm("zfs", files=["/usr/sbin/zpool"]))
+
+            manifest = script.build_install_manifest(merged_root=merged_root)
+
+        self.assertEqual(manifest["schemaVersion"], AKMODS_INSTALL_MANIFEST_VERSION)
+        self.assertEqual(
+            manifest["rpms"][0],
+            {
+                "file": "kmod-zfs.rpm",
+                "name": "kmod-zfs",
+                "sha256": hashlib.sha256(kmod_bytes).hexdigest(),
+                "kernelRelease": "6.18.16-200.fc43.x86_64",
+            },
+        )
+        self.assertEqual(manifest["rpms"][1]["name"], "zfs")
+        self.assertNotIn("kernelRelease", manifest["rpms"][1])
+
+    def test_build_kmod_overlay_unpacks_only_fallback_kernel_module_trees(self) -> None:
+        kernel_releases = ["6.18.16-200.fc43.x86_64", "6.18.13-200.fc43.x86_64"]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            merged_root = Path(temp_dir)
+            rpm_dir = merged_root / "rpms" / "kmods" / "zfs"
+            rpm_dir.mkdir(parents=True)
+            for kernel_release in kernel_releases:
+                (rpm_dir / f"kmod-zfs-{kernel_release}.rpm").write_bytes(build_kmod_rpm(kernel_release))
+
+            overlay_kernels = script.build_kmod_overlay(
+                merged_root=merged_root,
+                install_manifest=script.build_install_manifest(merged_root=merged_root),
+                kernel_releases=kernel_releases,
+            )
+            overlay_root = merged_root / AKMODS_KMOD_OVERLAY_DIR
+            written = sorted(str(path.relative_to(overlay_root)) for path in overlay_root.rglob("*") if path.is_file())
+            zfs_module = (overlay_root / "6.18.13-200.fc43.x86_64" / "extra" / "zfs" / "zfs.ko").read_bytes()
+
+        self.assertEqual(overlay_kernels, ["6.18.13-200.fc43.x86_64"])
+        self.assertEqual(
+            written,
+            [
+                "6.18.13-200.fc43.x86_64/extra/zfs/spl.ko",
+                "6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko",
+            ],
+        )
+        self.assertEqual(zfs_module, b"zfs for 6.18.13-200.fc43.x86_64")
+        self.assertEqual(
+            script.shared_cache_layer_paths(include_kmod_overlay=True)[-1],
+            (AKMODS_KMOD_OVERLAY_DIR,),
+        )
+
+    def test_shared_cache_labels_include_kernel_metadata(self) -> None:
+        labels = script.shared_cache_labels(
+            [
                 "6.18.16-200.fc43.x86_64",
                 "6.18.13-200.fc43.x86_64",
             ]
         )
 
-        self.assertIn(
-            f'LABEL {AKMODS_CACHE_METADATA_VERSION_LABEL}="{AKMODS_CACHE_METADATA_VERSION}"',
-            containerfile,
-        )
-        self.assertIn(
-            (
-                f'LABEL {AKMODS_CACHE_KERNEL_RELEASES_LABEL}='
-                '"6.18.13-200.fc43.x86_64 6.18.16-200.fc43.x86_64"'
-            ),
-            containerfile,
+        self.assertEqual(
+            labels,
+            {
+                AKMODS_CACHE_METADATA_VERSION_LABEL: AKMODS_CACHE_METADATA_VERSION,
+                AKMODS_CACHE_KERNEL_RELEASES_LABEL: "6.18.13-200.fc43.x86_64 6.18.16-200.fc43.x86_64",
+            },
         )
-        self.assertTrue(containerfile.endswith("COPY rpms /rpms\n"))
+        self.assertEqual(script.shared_cache_layer_paths(), [("kernel-rpms",), ("rpms",)])
 
     def test_write_kernel_cache_file_exports_isolated_upstream_build_root(self) -> None:
         with tempfile.TemporaryDirectory() as tempdir:
@@ -153,17 +228,19 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
                     },
                     clear=True,
                 ):
-                    script.write_kernel_cache_file(
+                    build_env = script.write_kernel_cache_file(
                         kernel_release="6.18.16-200.fc43.x86_64",
                         shared_cache_path=False,
                     )
 
                     self.assertTrue(
-                        script.os.environ["AKMODS_BUILDDIR"].endswith(
+                        build_env["AKMODS_BUILDDIR"].endswith(
                             "/build/6.18.16-200.fc43.x86_64"
                         )
                     )
-                    self.assertFalse("KCPATH" in script.os.environ)
+                    self.assertFalse("KCPATH" in build_env)
+                    # Concurrent kernel builds rely on the process env staying untouched.
+                    self.assertFalse("AKMODS_BUILDDIR" in script.os.environ)
 
     def test_write_kernel_cache_file_rejects_fixed_kcpath_in_multi_kernel_mode(self) -> None:
         with tempfile.TemporaryDirectory() as tempdir:
@@ -207,9 +284,11 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
         build_release.assert_called_once_with(
             "6.18.16-200.fc43.x86_64",
             shared_cache_path=False,
+            prefix_logs=False,
         )
         merge_shared.assert_called_once_with(
-            kernel_releases=["6.18.16-200.fc43.x86_64"]
+            kernel_releases=["6.18.16-200.fc43.x86_64"],
+            reused_image_refs={},
         )
         self.assertEqual(
             run_cmd.call_args_list,
@@ -296,11 +375,14 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
             ],
         )
 
-    def test_merge_and_push_shared_cache_image_builds_shared_tags(self) -> None:
-        kernel_releases = [
-            "6.18.13-200.fc43.x86_64",
-            "6.18.16-200.fc43.x86_64",
-        ]
+    def run_rebuild_merge(
+        self,
+        kernel_releases: list[str],
+        *,
+        published_digest: str = "",
+        mtime: int = 1_700_000_000,
+    ) -> tuple[MagicMock, MagicMock, dict[str, bytes]]:
+        """Run the rebuild merge with fake per-kernel images; return its mocks and pushed layouts."""
 
         unpack_index = {"value": 0}
 
@@ -313,14 +395,31 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
             rpm_dir = destination / "rpms" / "kmods" / "zfs"
             rpm_dir.mkdir(parents=True, exist_ok=True)
             (destination / "kernel-rpms").mkdir(parents=True, exist_ok=True)
-            (
-                rpm_dir / f"kmod-zfs-{kernel_release}-2.4.1-1.fc43.x86_64.rpm"
-            ).touch()
-
-        def fake_run_cmd(args: list[str], **_kwargs: object) -> str:
-            if args == ["uname", "-m"]:
-                return "x86_64\n"
-            return ""
+            rpm_path = rpm_dir / f"kmod-zfs-{kernel_release}-2.4.1-1.fc43.x86_64.rpm"
+            rpm_path.write_bytes(build_kmod_rpm(kernel_release))
+            for path in (destination / "kernel-rpms", rpm_dir, rpm_path):
+                os.utime(path, (mtime, mtime))
+
+        pushed_layouts: dict[str, bytes] = {}
+        client = MagicMock()
+        client.blob_exists.return_value = False
+
+        def fake_skopeo_copy(source: str, destination: str, **_kwargs: object) -> None:
+            if destination.startswith("docker://"):
+                layout_dir = Path(source.removeprefix("dir:"))
+                pushed_layouts[destination] = (layout_dir / "manifest.json").read_bytes()
+
+        def fake_retag_image(image_ref: str, tags: list[str], **_kwargs: object) -> int:
+            for tag in tags:
+                pushed_layouts[image_ref.rsplit(":", 1)[0] + f":{tag}"] = pushed_layouts[image_ref]
+            return len(pushed_layouts[image_ref]) * len(tags)
+
+        def fake_inspect_digest(image_ref: str, **_kwargs: object) -> str:
+            if image_ref in pushed_layouts:
+                return "sha256:" + hashlib.sha256(pushed_layouts[image_ref]).hexdigest()
+            if published_digest:
+                return published_digest
+            raise ImageNotFoundError(f"{image_ref} not found")
 
         with patch.dict(
             script.os.environ,
@@ -329,53 +428,200 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
                 "AKMODS_VERSION": "43",
                 "AKMODS_REPO": "akmods-zfs",
                 "GITHUB_REPOSITORY_OWNER": "Danathar",
+                "REGISTRY_ACTOR": "actor",
+                "REGISTRY_TOKEN": "token",
             },
             clear=False,
         ):
-            with patch.object(script, "skopeo_copy") as skopeo_copy:
-                with patch.object(
+            with (
+                patch.object(script, "skopeo_copy", side_effect=fake_skopeo_copy) as skopeo_copy,
+                patch.object(
                     script,
                     "load_layer_files_from_oci_layout",
                     return_value=[Path("layer.tar")],
-                ):
-                    with patch.object(script, "unpack_layer_tarballs", side_effect=fake_unpack):
-                        with patch.object(script, "run_cmd", side_effect=fake_run_cmd) as run_cmd:
-                            script.merge_and_push_shared_cache_image(
-                                kernel_releases=kernel_releases
-                            )
+                ),
+                patch.object(script, "unpack_layer_tarballs", side_effect=fake_unpack),
+                patch.object(script, "run_cmd", return_value="x86_64\n") as run_cmd,
+                patch.object(script, "skopeo_inspect_digest", side_effect=fake_inspect_digest),
+                patch.object(script, "registry_client", return_value=client),
+                patch.object(script, "retag_image", side_effect=fake_retag_image) as retag_image,
+                patch.object(script, "PUBLISH_UPLOADS", script.PublishUploadStats()) as uploads,
+            ):
+                script.merge_and_push_shared_cache_image(
+                    kernel_releases=kernel_releases
+                )
+        self.retag_image = retag_image
+        self.uploads = uploads
+        return skopeo_copy, run_cmd, pushed_layouts
 
-        self.assertEqual(skopeo_copy.call_count, 2)
-        self.assertEqual(run_cmd.call_args_list[0], call(["uname", "-m"]))
+    def test_merge_and_push_shared_cache_image_builds_shared_tags(self) -> None:
+        kernel_releases = [
+            "6.18.13-200.fc43.x86_64",
+            "6.18.16-200.fc43.x86_64",
+        ]
+
+        skopeo_copy, run_cmd, pushed_layouts = self.run_rebuild_merge(kernel_releases)
+
+        # No podman build: the merged layout is written in-process.
+        run_cmd.assert_called_once_with(["uname", "-m"])
+
+        # Two per-kernel reads, then one push of the layout; the plain shared
+        # tag is a manifest-only retag of the same image.
+        self.assertEqual(skopeo_copy.call_count, 3)
+        self.assertEqual(skopeo_copy.call_args_list[2].args[1], "docker://ghcr.io/danathar/akmods-zfs:main-43-x86_64")
+        self.retag_image.assert_called_once_with(
+            "docker://ghcr.io/danathar/akmods-zfs:main-43-x86_64",
+            ["main-43"],
+            creds="actor:token",
+        )
+        manifest_bytes = pushed_layouts["docker://ghcr.io/danathar/akmods-zfs:main-43"]
+        layout_blob_bytes = sum(
+            descriptor["size"] for descriptor in json.loads(manifest_bytes)["layers"]
+        ) + json.loads(manifest_bytes)["config"]["size"]
+        self.assertEqual(self.uploads.blob_count, 4)
+        self.assertEqual(self.uploads.blob_bytes, layout_blob_bytes)
+        self.assertEqual((self.uploads.manifest_count, self.uploads.manifest_bytes), (2, 2 * len(manifest_bytes)))
+        # kernel-rpms, rpms, and the overlay for the older (fallback) kernel.
+        self.assertEqual(len(json.loads(manifest_bytes)["layers"]), 3)
+
+    def test_merge_and_push_skips_push_when_rebuilt_digest_is_already_published(self) -> None:
+        kernel_releases = ["6.18.13-200.fc43.x86_64"]
+        _copy, _run_cmd, first_layouts = self.run_rebuild_merge(kernel_releases, mtime=1_700_000_000)
+        first_digest = "sha256:" + hashlib.sha256(first_layouts["docker://ghcr.io/danathar/akmods-zfs:main-43"]).hexdigest()
+
+        # Same RPMs with different mtimes rebuild to the same digest.
+        skopeo_copy, _run_cmd, second_layouts = self.run_rebuild_merge(
+            kernel_releases,
+            published_digest=first_digest,
+            mtime=1_800_000_000,
+        )
 
-        build_command = run_cmd.call_args_list[1]
-        self.assertEqual(build_command.args[0][:5], ["podman", "build", "-f", build_command.args[0][3], "-t"])
-        self.assertIn("localhost/akmods-zfs:main-43", build_command.args[0])
-        self.assertIn("localhost/akmods-zfs:main-43-x86_64", build_command.args[0])
+        self.assertEqual(second_layouts, {})
+        self.assertEqual(skopeo_copy.call_count, 1)
+        self.retag_image.assert_not_called()
+        self.assertEqual(self.uploads.blob_bytes + self.uploads.manifest_bytes, 0)
 
+    def test_layer_merge_mode_reuses_kernel_layers_without_podman_build(self) -> None:
+        kernel_releases = [
+            "6.18.13-200.fc43.x86_64",
+            "6.18.16-200.fc43.x86_64",
+        ]
+        shared_layer = ImageLayer(
+            media_type=OCI_LAYER_GZIP_MEDIA_TYPE,
+            digest="sha256:common",
+            size=10,
+            diff_id="sha256:common-diff",
+            source=parse_image_ref("docker://ghcr.io/danathar/akmods-zfs:base"),
+        )
+        kernel_layers: dict[str, ImageLayer] = {}
+
+        def fake_read_image_layers(image_ref: str, **_kwargs: object) -> tuple[list[ImageLayer], dict]:
+            kernel_release = image_ref.rsplit("main-43-", 1)[1]
+            return [shared_layer, kernel_layers[kernel_release]], {"architecture": "amd64"}
+
+        def fake_stream_layer_rpms(
+            image_ref: str,
+            layer_digest: str,
+            destination_root: Path,
+            **_kwargs: object,
+        ) -> None:
+            if layer_digest == shared_layer.digest:
+                return
+            kernel_release = image_ref.rsplit("main-43-", 1)[1]
+            path = destination_root / f"rpms/kmods/zfs/kmod-zfs-{kernel_release}-2.4.1-1.fc43.x86_64.rpm"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(build_kmod_rpm(kernel_release))
+
+        pushed: dict = {}
+
+        def fake_push_assembled_image(image_ref: str, **kwargs: object) -> bytes:
+            pushed.update(kwargs, image_ref=image_ref)
+            return b'{"schemaVersion":2}'
+
+        with patch.dict(
+            script.os.environ,
+            {
+                "AKMODS_KERNEL": "main",
+                "AKMODS_VERSION": "43",
+                "AKMODS_REPO": "akmods-zfs",
+                "AKMODS_MERGE_MODE": "layers",
+                "GITHUB_REPOSITORY_OWNER": "Danathar",
+            },
+            clear=False,
+        ):
+            for index, kernel_release in enumerate(kernel_releases):
+                kernel_layers[kernel_release] = ImageLayer(
+                    media_type=OCI_LAYER_GZIP_MEDIA_TYPE,
+                    digest=f"sha256:layer-{index}",
+                    size=20,
+                    diff_id=f"sha256:diff-{index}",
+                    source=parse_image_ref(script.kernel_image_ref(kernel_release)),
+                )
+            client = MagicMock()
+            client.blob_exists.return_value = False
+            with (
+                patch.object(script, "run_cmd", return_value="x86_64\n") as run_cmd,
+                patch.object(script, "skopeo_copy") as skopeo_copy,
+                patch.object(script, "read_image_layers", side_effect=fake_read_image_layers),
+                patch.object(script, "stream_layer_rpms", side_effect=fake_stream_layer_rpms),
+                patch.object(script, "registry_client", return_value=client),
+                patch.object(script, "skopeo_inspect_digest", side_effect=ImageNotFoundError("not found")),
+                patch.object(script, "push_assembled_image", side_effect=fake_push_assembled_image),
+            ):
+                script.merge_and_push_shared_cache_image(kernel_releases=kernel_releases)
+
+        run_cmd.assert_called_once_with(["uname", "-m"])
+        skopeo_copy.assert_not_called()
+        self.assertEqual(pushed["image_ref"], "docker://ghcr.io/danathar/akmods-zfs:main-43")
+        self.assertEqual(pushed["tags"], ["main-43-x86_64", "main-43"])
+        # The shared bottom layer is listed once; the metadata layer goes on top.
+        layers = pushed["layers"]
         self.assertEqual(
-            run_cmd.call_args_list[2],
-            call(
-                [
-                    "podman",
-                    "push",
-                    "localhost/akmods-zfs:main-43-x86_64",
-                    "docker://ghcr.io/danathar/akmods-zfs:main-43-x86_64",
-                ],
-                capture_output=False,
-            ),
+            [layer.digest for layer in layers[:-1]],
+            ["sha256:common", "sha256:layer-0", "sha256:layer-1"],
         )
+        # Only the metadata layer and the config are uploaded.
+        self.assertEqual(client.push_blob.call_count, 2)
+        self.assertEqual(client.push_blob.call_args_list[1].args[1], pushed["config"])
+        self.assertEqual(client.push_blob.call_args_list[0].args[1][:2], b"\x1f\x8b")
+        config = json.loads(pushed["config"])
         self.assertEqual(
-            run_cmd.call_args_list[3],
-            call(
-                [
-                    "podman",
-                    "push",
-                    "localhost/akmods-zfs:main-43",
-                    "docker://ghcr.io/danathar/akmods-zfs:main-43",
-                ],
-                capture_output=False,
-            ),
+            config["config"]["Labels"][AKMODS_CACHE_KERNEL_RELEASES_LABEL],
+            " ".join(kernel_releases),
         )
+        self.assertEqual(config["rootfs"]["diff_ids"], [layer.diff_id for layer in layers])
+        self.assertEqual(config["architecture"], "amd64")
+
+    def test_stream_layer_rpms_writes_only_zfs_rpms(self) -> None:
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as layer_tar:
+            for path, data in [
+                ("kernel-rpms/kernel-core-6.18.13-200.fc43.x86_64.rpm", b"kernel" * 1000),
+                ("rpms/kmods/zfs/kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm", b"kmod"),
+                ("rpms/kmods/zfs/other/nested.rpm", b"nested"),
+                ("rpms/ucore/unrelated.rpm", b"unrelated"),
+            ]:
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                layer_tar.addfile(info, io.BytesIO(data))
+        layer = gzip.compress(buffer.getvalue(), mtime=0)
+
+        with FakeRegistry() as registry, tempfile.TemporaryDirectory() as temp_dir:
+            registry.add_image("danathar/akmods-zfs", "main-43-6.18.13-200.fc43.x86_64", layers=[layer])
+            client = RegistryClient(timeout=5)
+            try:
+                with patch.object(script, "registry_client", return_value=client):
+                    script.stream_layer_rpms(
+                        f"docker://{registry.host}/danathar/akmods-zfs:main-43-6.18.13-200.fc43.x86_64",
+                        "sha256:" + hashlib.sha256(layer).hexdigest(),
+                        Path(temp_dir),
+                    )
+            finally:
+                client.close()
+
+            written = sorted(str(path.relative_to(temp_dir)) for path in Path(temp_dir).rglob("*") if path.is_file())
+
+        self.assertEqual(written, ["rpms/kmods/zfs/kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm"])
 
     def test_main_builds_each_kernel_then_merges_shared_cache(self) -> None:
         with tempfile.TemporaryDirectory() as tempdir:
@@ -408,21 +654,174 @@ class AkmodsBuildAndPublishTests(unittest.TestCase):
                 ),
             ],
         )
+        build_env = write_cache.return_value
         self.assertEqual(
             run_cmd.call_args_list,
             [
                 call(["just", "login"], cwd=str(Path(tempdir)), capture_output=False),
-                call(["just", "build"], cwd=str(Path(tempdir)), capture_output=False),
-                call(["just", "push"], cwd=str(Path(tempdir)), capture_output=False),
-                call(["just", "build"], cwd=str(Path(tempdir)), capture_output=False),
-                call(["just", "push"], cwd=str(Path(tempdir)), capture_output=False),
+                call(["just", "build"], cwd=str(Path(tempdir)), capture_output=False, env=build_env),
+                call(["just", "push"], cwd=str(Path(tempdir)), capture_output=False, env=build_env),
+                call(["just", "build"], cwd=str(Path(tempdir)), capture_output=False, env=build_env),
+                call(["just", "push"], cwd=str(Path(tempdir)), capture_output=False, env=build_env),
             ],
         )
         merge_shared.assert_called_once_with(
             kernel_releases=[
                 "6.18.13-200.fc43.x86_64",
                 "6.18.16-200.fc43.x86_64",
-            ]
+            ],
+            reused_image_refs={},
+        )
+
+    def test_main_builds_kernels_concurrently_with_isolated_envs(self) -> None:
+        kernel_releases = ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"]
+        both_started = threading.Barrier(2, timeout=5)
+        prefixed_calls: list[tuple[list[str], str, dict[str, str]]] = []
+
+        def fake_prefixed(args: list[str], *, prefix: str, cwd: str, env: dict[str, str]) -> None:
+            if args == ["just", "build"]:
+                # Both kernels must be inside `just build` at the same time.
+                both_started.wait()
+            prefixed_calls.append((args, prefix, env))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with (
+                patch.object(script, "AKMODS_WORKTREE", Path(tempdir)),
+                patch.object(script, "kernel_releases_from_env", return_value=kernel_releases),
+                patch.object(script, "merge_and_push_shared_cache_image") as merge_shared,
+                patch.object(script, "run_cmd") as run_cmd,
+                patch.object(script, "run_cmd_with_log_prefix", side_effect=fake_prefixed),
+                patch.dict(
+                    script.os.environ,
+                    {"AKMODS_KERNEL": "main", "AKMODS_VERSION": "43", "AKMODS_BUILD_CONCURRENCY": "2"},
+                    clear=False,
+                ),
+                contextlib.redirect_stdout(io.StringIO()),
+            ):
+                script.main()
+
+        self.assertEqual(run_cmd.call_args_list, [call(["just", "login"], cwd=tempdir, capture_output=False)])
+        builddirs = {
+            prefix: env["AKMODS_BUILDDIR"] for _args, prefix, env in prefixed_calls
+        }
+        self.assertEqual(sorted(builddirs), kernel_releases)
+        for kernel_release, builddir in builddirs.items():
+            self.assertTrue(builddir.endswith(f"/build/{kernel_release}"))
+        self.assertEqual(len(prefixed_calls), 4)
+        merge_shared.assert_called_once_with(kernel_releases=kernel_releases, reused_image_refs={})
+
+    def _incremental_env(self) -> dict[str, str]:
+        return {
+            "AKMODS_KERNEL": "main",
+            "AKMODS_VERSION": "43",
+            "AKMODS_REPO": "akmods-zfs",
+            "GITHUB_REPOSITORY_OWNER": "Danathar",
+            "AKMODS_INCREMENTAL": "true",
+            "ZFS_MINOR_VERSION": "2.4",
+        }
+
+    def test_inputs_fingerprint_follows_checkout_and_zfs_inputs(self) -> None:
+        def fake_run_cmd(args: list[str], **_kwargs: object) -> str:
+            return "abc123\n" if "rev-parse" in args else "diff --git a/images.yaml\n"
+
+        with (
+            patch.object(script, "run_cmd", side_effect=fake_run_cmd),
+            patch.dict(script.os.environ, self._incremental_env(), clear=True),
+        ):
+            first = script.akmods_inputs_fingerprint("6.18.13-200.fc43.x86_64")
+            same = script.akmods_inputs_fingerprint("6.18.13-200.fc43.x86_64")
+            other_kernel = script.akmods_inputs_fingerprint("6.18.16-200.fc43.x86_64")
+            script.os.environ["ZFS_MINOR_VERSION"] = "2.5"
+            other_zfs = script.akmods_inputs_fingerprint("6.18.13-200.fc43.x86_64")
+
+        self.assertEqual(first, same)
+        self.assertEqual(len({first, other_kernel, other_zfs}), 3)
+
+    def test_incremental_rebuild_builds_only_kernels_without_matching_inputs(self) -> None:
+        kernel_releases = ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"]
+        reused_ref = "docker://ghcr.io/danathar/akmods-zfs:main-43-6.18.13-200.fc43.x86_64-inputs-fp-6.18.13"
+
+        with (
+            patch.dict(script.os.environ, self._incremental_env(), clear=True),
+            patch.object(script, "akmods_inputs_fingerprint", side_effect=lambda release: f"fp-{release[:7]}"),
+            patch.object(script, "skopeo_exists", side_effect=lambda ref, **_kwargs: ref == reused_ref),
+            patch.object(script, "build_and_push_kernel_release") as build_release,
+            patch.object(script, "skopeo_copy") as skopeo_copy,
+            patch.object(script, "merge_and_push_shared_cache_image") as merge_shared,
+            contextlib.redirect_stdout(io.StringIO()),
+        ):
+            script.build_missing_kernels_and_merge(kernel_releases)
+
+        build_release.assert_called_once_with("6.18.16-200.fc43.x86_64", shared_cache_path=False, prefix_logs=False)
+        # The fresh image is tagged with its inputs so a retry can skip it.
+        skopeo_copy.assert_called_once_with(
+            "docker://ghcr.io/danathar/akmods-zfs:main-43-6.18.16-200.fc43.x86_64",
+            "docker://ghcr.io/danathar/akmods-zfs:main-43-6.18.16-200.fc43.x86_64-inputs-fp-6.18.16",
+            creds=None,
+        )
+        merge_shared.assert_called_once_with(
+            kernel_releases=kernel_releases,
+            reused_image_refs={"6.18.13-200.fc43.x86_64": reused_ref},
+        )
+
+    def test_incremental_rebuild_rebuilds_reused_kernels_on_mixed_zfs_versions(self) -> None:
+        kernel_releases = ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"]
+
+        with (
+            patch.dict(script.os.environ, self._incremental_env(), clear=True),
+            patch.object(script, "akmods_inputs_fingerprint", return_value="fp"),
+            patch.object(
+                script,
+                "skopeo_exists",
+                side_effect=lambda ref, **_kwargs: "6.18.13" in ref,
+            ),
+            patch.object(script, "build_and_push_kernel_release") as build_release,
+            patch.object(script, "skopeo_copy"),
+            patch.object(
+                script,
+                "merge_and_push_shared_cache_image",
+                side_effect=[script.MixedZfsVersionsError("mixes ZFS versions: 2.4.0, 2.4.1"), None],
+            ) as merge_shared,
+            contextlib.redirect_stdout(io.StringIO()),
+        ):
+            script.build_missing_kernels_and_merge(kernel_releases)
+
+        self.assertEqual(
+            [build.args[0] for build in build_release.call_args_list],
+            ["6.18.16-200.fc43.x86_64", "6.18.13-200.fc43.x86_64"],
+        )
+        self.assertEqual(merge_shared.call_args_list[-1].kwargs["reused_image_refs"], {})
+
+    def test_merged_cache_zfs_versions_reports_each_distinct_version(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            merged_root = Path(temp_dir)
+            rpm_dir = merged_root / "rpms" / "kmods" / "zfs"
+            rpm_dir.mkdir(parents=True)
+            (rpm_dir / "zfs-old.rpm").write_bytes(build_rpm("zfs", version="2.4.0"))
+            (rpm_dir / "kmod-new.rpm").write_bytes(build_rpm("kmod-zfs", version="2.4.1"))
+            (rpm_dir / "other.rpm").write_bytes(build_rpm("libzfs6", version="9.9"))
+
+            versions = script.merged_cache_zfs_versions(merged_root=merged_root)
+
+        self.assertEqual(versions, ["2.4.0", "2.4.1"])
+
+    def test_run_cmd_with_log_prefix_prefixes_lines_and_reports_failures(self) -> None:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_cmd_with_log_prefix(
+                [sys.executable, "-c", "import os; print('one'); print(os.environ['MARK'])"],
+                prefix="6.18.13",
+                env={"MARK": "two"},
+            )
+            with self.assertRaisesRegex(CiToolError, "boom"):
+                run_cmd_with_log_prefix(
+                    [sys.executable, "-c", "import sys; print('boom'); sys.exit(3)"],
+                    prefix="6.18.16",
+                )
+
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            ["[6.18.13] one", "[6.18.13] two", "[6.18.16] boom"],
         )
 
 
@@ -0,0 +1,204 @@
+"""
+Script: tests/test_blob_store.py
+What: Tests for the runner-wide content-addressed blob store.
+Doing: Verifies digest checking, hardlink reuse, LRU budget eviction, locked lifetime hit counters, and `dir:` layout writes against the in-process registry.
+Why: Jobs trust blobs from the store without re-downloading, so a corrupt or half-written blob must never land there.
+Goal: Keep repeated layout copies cheap without changing what consumers read.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from ci_tools import blob_store as blob_store_module
+from ci_tools.blob_store import (
+    STATS_LOCK_FILE_NAME,
+    BlobStore,
+    copy_image_to_dir,
+    copy_image_to_dir_layout,
+    set_runner_blob_store,
+)
+from ci_tools.common import CiToolError
+from ci_tools.registry_client import RegistryClient
+from fake_registry import FakeRegistry
+
+
+def _digest(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+class BlobStoreTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        self.store = BlobStore(self.root / "store", max_bytes=1024)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_insert_rejects_digest_mismatch(self) -> None:
+        with self.assertRaises(CiToolError):
+            self.store.insert_stream(_digest(b"expected"), io.BytesIO(b"tampered"))
+
+        self.assertEqual(self.store.usage().blob_count, 0)
+        self.assertEqual(list((self.root / "store" / "sha256").iterdir()), [])
+
+    def test_link_into_counts_hits_and_misses(self) -> None:
+        digest = _digest(b"layer")
+        target = self.root / "layout" / digest.removeprefix("sha256:")
+
+        self.assertFalse(self.store.link_into(digest, target))
+        self.store.insert_stream(digest, io.BytesIO(b"layer"))
+        self.assertTrue(self.store.link_into(digest, target))
+
+        self.assertEqual(target.read_bytes(), b"layer")
+        self.assertEqual((self.store.stats.hits, self.store.stats.misses), (1, 1))
+        self.assertEqual(self.store.stats.bytes_reused, len(b"layer"))
+
+    def test_evict_to_budget_removes_least_recently_used_blobs_first(self) -> None:
+        now = 2_000_000.0
+        old = self.store.insert_stream(_digest(b"a" * 600), io.BytesIO(b"a" * 600))
+        recent = self.store.insert_stream(_digest(b"b" * 600), io.BytesIO(b"b" * 600))
+        stale_incoming = self.store.blob_path(_digest(b"a" * 600)).parent / ".incoming-abandoned"
+        stale_incoming.write_bytes(b"partial")
+        os.utime(old, (now - 600, now - 600))
+        os.utime(recent, (now - 60, now - 60))
+        os.utime(stale_incoming, (now - 7200, now - 7200))
+
+        summary = self.store.evict_to_budget(now_timestamp=now)
+
+        self.assertEqual(summary.removed_blobs, 1)
+        self.assertEqual(summary.reclaimed_bytes, 600 + len(b"partial"))
+        self.assertFalse(old.exists())
+        self.assertTrue(recent.exists())
+        self.assertFalse(stale_incoming.exists())
+
+    def test_flush_stats_accumulates_lifetime_hit_rate(self) -> None:
+        digest = _digest(b"layer")
+        self.store.insert_stream(digest, io.BytesIO(b"layer"))
+        self.store.link_into(digest, self.root / "one")
+        self.store.flush_stats()
+
+        second = BlobStore(self.root / "store")
+        second.link_into(digest, self.root / "two")
+        second.link_into(digest, self.root / "three")
+        second.link_into(_digest(b"missing"), self.root / "four")
+        second.flush_stats()
+
+        usage = second.usage()
+        self.assertEqual((usage.hits, usage.misses), (3, 1))
+        self.assertEqual(usage.hit_rate, 0.75)
+        self.assertEqual(usage.blob_count, 1)
+
+    def test_flush_stats_waits_for_another_job_holding_the_stats_lock(self) -> None:
+        store_root = self.root / "store"
+        store_root.mkdir(parents=True, exist_ok=True)
+        self.store.stats.hits = 2
+        with (store_root / STATS_LOCK_FILE_NAME).open("a") as other_job:
+            fcntl.flock(other_job, fcntl.LOCK_EX)
+            flusher = threading.Thread(target=self.store.flush_stats)
+            flusher.start()
+            flusher.join(timeout=0.2)
+            self.assertTrue(flusher.is_alive())
+            # The other job's update lands while this one is still waiting.
+            (store_root / "stats.json").write_text('{"hits": 5, "misses": 1}', encoding="utf-8")
+        flusher.join(timeout=5)
+
+        usage = self.store.usage()
+        self.assertEqual((usage.hits, usage.misses), (7, 1))
+
+
+class CopyImageToDirTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        self.registry = FakeRegistry().__enter__()
+        self.client = RegistryClient(timeout=5)
+        self.store = BlobStore(self.root / "store")
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.registry.__exit__(None, None, None)
+        self.temp_dir.cleanup()
+
+    def test_second_copy_reuses_stored_blobs(self) -> None:
+        layers = [b"first-layer", b"second-layer"]
+        self.registry.add_image("danathar/kinoite-zfs", "candidate", layers=layers)
+        image_ref = f"docker://{self.registry.host}/danathar/kinoite-zfs:candidate"
+
+        first = self.root / "first"
+        copy_image_to_dir(image_ref, first, store=self.store, client=self.client)
+        blob_gets = self.registry.count("GET", "/blobs/")
+        second = self.root / "second"
+        copy_image_to_dir(image_ref, second, store=self.store, client=self.client)
+
+        # Config plus two layers were fetched once, then served from the store.
+        self.assertEqual(blob_gets, 3)
+        self.assertEqual(self.registry.count("GET", "/blobs/"), blob_gets)
+        manifest = json.loads((second / "manifest.json").read_text(encoding="utf-8"))
+        for layer, descriptor in zip(layers, manifest["layers"]):
+            self.assertEqual((second / descriptor["digest"].removeprefix("sha256:")).read_bytes(), layer)
+        self.assertTrue((second / manifest["config"]["digest"].removeprefix("sha256:")).is_file())
+        self.assertTrue((second / "version").is_file())
+
+    def test_layout_copy_falls_back_to_skopeo_when_store_is_disabled(self) -> None:
+        set_runner_blob_store(BlobStore(None))
+        self.addCleanup(set_runner_blob_store, None)
+
+        with (
+            patch.dict(os.environ, {"REGISTRY_CLIENT": "native"}),
+            patch.object(blob_store_module, "skopeo_copy") as skopeo_copy,
+        ):
+            copy_image_to_dir_layout("docker://ghcr.io/danathar/kinoite-zfs:candidate", "dir:/tmp/layout")
+
+        skopeo_copy.assert_called_once_with(
+            "docker://ghcr.io/danathar/kinoite-zfs:candidate",
+            "dir:/tmp/layout",
+            creds=None,
+        )
+
+    def test_layout_copy_uses_skopeo_unless_the_native_client_is_enabled(self) -> None:
+        set_runner_blob_store(self.store)
+        self.addCleanup(set_runner_blob_store, None)
+
+        with (
+            patch.dict(os.environ, {"REGISTRY_CLIENT": ""}),
+            patch.object(blob_store_module, "skopeo_copy") as skopeo_copy,
+            patch.object(blob_store_module, "copy_image_to_dir") as store_copy,
+        ):
+            copy_image_to_dir_layout("docker://ghcr.io/danathar/kinoite-zfs:candidate", "dir:/tmp/layout")
+
+        skopeo_copy.assert_called_once()
+        store_copy.assert_not_called()
+
+    def test_layout_copy_goes_through_the_store_with_the_native_client(self) -> None:
+        self.registry.add_image("danathar/kinoite-zfs", "candidate", layers=[b"layer"])
+        set_runner_blob_store(self.store)
+        self.addCleanup(set_runner_blob_store, None)
+        layout = self.root / "layout"
+
+        with (
+            patch.dict(os.environ, {"REGISTRY_CLIENT": "native"}),
+            patch.object(blob_store_module, "registry_client", return_value=self.client),
+            patch.object(blob_store_module, "skopeo_copy") as skopeo_copy,
+        ):
+            copy_image_to_dir_layout(
+                f"docker://{self.registry.host}/danathar/kinoite-zfs:candidate",
+                f"dir:{layout}",
+            )
+
+        skopeo_copy.assert_not_called()
+        self.assertTrue((layout / "manifest.json").is_file())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,15 +10,19 @@ from __future__ import annotations
 
 import io
 import os
+from contextlib import redirect_stdout
 from pathlib import Path
 import tempfile
 import tarfile
+import threading
 import unittest
 from unittest.mock import patch
 
 from ci_tools.common import (
     CiToolError,
     optional_registry_creds,
+    run_concurrently,
+    surviving_layer_members,
     unpack_layer_tarballs,
     write_github_outputs,
 )
@@ -122,6 +126,143 @@ class CommonTests(unittest.TestCase):
             self.assertFalse((destination / "repo-object").exists())
             self.assertEqual((destination / "usr" / "sbin" / "zfs").read_bytes(), b"binary")
 
+    @staticmethod
+    def _write_layer(path: Path, entries: list[tuple[str, bytes | None]]) -> Path:
+        """Write one layer; `None` data means a directory entry."""
+
+        with tarfile.open(path, "w") as layer_tar:
+            for name, data in entries:
+                info = tarfile.TarInfo(name)
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    layer_tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    layer_tar.addfile(info, io.BytesIO(data))
+        return path
+
+    def test_unpack_layer_tarballs_applies_whiteouts_and_writes_each_path_once(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            lower = self._write_layer(
+                root / "lower.tar",
+                [
+                    ("rpms", None),
+                    ("rpms/kmods", None),
+                    ("rpms/kmods/old-kernel.rpm", b"old"),
+                    ("rpms/kmods/kept.rpm", b"v1"),
+                    ("rpms/stale", None),
+                    ("rpms/stale/leftover.rpm", b"x"),
+                    ("etc/config", b"lower"),
+                ],
+            )
+            upper = self._write_layer(
+                root / "upper.tar",
+                [
+                    ("rpms/kmods/.wh.old-kernel.rpm", b""),
+                    ("rpms/kmods/kept.rpm", b"v2"),
+                    ("rpms/stale/.wh..wh..opq", b""),
+                    ("rpms/stale/fresh.rpm", b"y"),
+                    ("./etc/.wh.config", b""),
+                ],
+            )
+            destination = root / "extract"
+            destination.mkdir()
+
+            surviving = surviving_layer_members([lower, upper])
+            with patch.object(
+                tarfile.TarFile,
+                "_extract_member",
+                autospec=True,
+                side_effect=tarfile.TarFile._extract_member,
+            ) as extract_member:
+                unpack_layer_tarballs([lower, upper], destination)
+
+            written = [call.args[1].name for call in extract_member.call_args_list]
+            self.assertEqual(len(written), len(set(written)))
+            self.assertEqual(surviving["rpms/kmods/kept.rpm"][0], 1)
+            self.assertEqual((destination / "rpms/kmods/kept.rpm").read_bytes(), b"v2")
+            self.assertFalse((destination / "rpms/kmods/old-kernel.rpm").exists())
+            self.assertFalse((destination / "rpms/stale/leftover.rpm").exists())
+            self.assertTrue((destination / "rpms/stale/fresh.rpm").exists())
+            self.assertFalse((destination / "etc/config").exists())
+            # Whiteout markers are instructions, not files.
+            self.assertEqual(list(destination.rglob(".wh.*")), [])
+
+    def test_surviving_layer_members_lets_a_file_replace_a_lower_directory(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            lower = self._write_layer(root / "lower.tar", [("opt", None), ("opt/a", b"a"), ("opt/b", b"b")])
+            upper = self._write_layer(root / "upper.tar", [("opt", b"now a file")])
+
+            surviving = surviving_layer_members([lower, upper])
+
+        self.assertEqual(sorted(surviving), ["opt"])
+        self.assertEqual(surviving["opt"][0], 1)
+
+    def test_surviving_layer_members_whiteout_drops_an_implicit_directory(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            # No `etc/foo` entry: the directory only exists through its file.
+            lower = self._write_layer(root / "lower.tar", [("etc/foo/bar.conf", b"a"), ("etc/foo-kept", b"b")])
+            upper = self._write_layer(root / "upper.tar", [("etc/.wh.foo", b"")])
+
+            surviving = surviving_layer_members([lower, upper])
+
+        self.assertEqual(sorted(surviving), ["etc/foo-kept"])
+
+    def test_surviving_layer_members_lets_a_file_replace_an_implicit_directory(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            lower = self._write_layer(root / "lower.tar", [("etc/foo/bar.conf", b"a"), ("etc/foo-kept", b"b")])
+            upper = self._write_layer(root / "upper.tar", [("etc/foo", b"now a file")])
+
+            surviving = surviving_layer_members([lower, upper])
+
+        self.assertEqual(sorted(surviving), ["etc/foo", "etc/foo-kept"])
+        self.assertEqual(surviving["etc/foo"][0], 1)
+
+
+class RunConcurrentlyTests(unittest.TestCase):
+    def test_returns_results_by_name_and_prints_timings(self) -> None:
+        barrier = threading.Barrier(2, timeout=5)
+
+        def first() -> str:
+            # Both tasks must be running at the same time to pass the barrier.
+            barrier.wait()
+            return "one"
+
+        def second() -> str:
+            barrier.wait()
+            return "two"
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            results = run_concurrently({"first": first, "second": second}, max_workers=2)
+
+        self.assertEqual(results, {"first": "one", "second": "two"})
+        self.assertIn("Lookup timings: first=", output.getvalue())
+        self.assertIn("second=", output.getvalue())
+
+    def test_first_error_cancels_pending_work(self) -> None:
+        started: list[str] = []
+
+        def failing() -> str:
+            started.append("failing")
+            raise CiToolError("registry unavailable")
+
+        def never() -> str:
+            started.append("never")
+            return "unexpected"
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            with self.assertRaisesRegex(CiToolError, "registry unavailable"):
+                run_concurrently({"failing": failing, "never": never}, max_workers=1)
+
+        self.assertEqual(started, ["failing"])
+        self.assertIn("never=cancelled", output.getvalue())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -29,6 +29,7 @@ class GeneratedBuildContextTests(unittest.TestCase):
             canonical_files_dir = root / "files" / "scripts"
             canonical_modules_dir = root / "modules"
             canonical_cosign_pub = root / "cosign.pub"
+            canonical_rpm_header = root / "ci_tools" / "rpm_header.py"
             generated_root = root / ".generated" / "bluebuild"
 
             canonical_recipe.parent.mkdir(parents=True, exist_ok=True)
@@ -68,6 +69,8 @@ class GeneratedBuildContextTests(unittest.TestCase):
             )
             (canonical_modules_dir / ".gitkeep").write_text("", encoding="utf-8")
             canonical_cosign_pub.write_text("public-key\n", encoding="utf-8")
+            canonical_rpm_header.parent.mkdir(parents=True, exist_ok=True)
+            canonical_rpm_header.write_text("# rpm header reader\n", encoding="utf-8")
 
             with (
                 mock.patch.object(generated_build_context, "CANONICAL_RECIPE_FILE", canonical_recipe),
@@ -91,6 +94,11 @@ class GeneratedBuildContextTests(unittest.TestCase):
                     "CANONICAL_COSIGN_PUB",
                     canonical_cosign_pub,
                 ),
+                mock.patch.object(
+                    generated_build_context,
+                    "CANONICAL_RPM_HEADER_MODULE",
+                    canonical_rpm_header,
+                ),
                 mock.patch.object(
                     generated_build_context,
                     "GENERATED_WORKSPACE_DIR",
@@ -187,6 +195,10 @@ class GeneratedBuildContextTests(unittest.TestCase):
                     / "install_zfs_from_akmods_cache.py"
                 ).exists()
             )
+            # The helper's RPM header reader ships next to it in the build context.
+            self.assertTrue(
+                (generated_root / "containerfiles" / "zfs-akmods" / "rpm_header.py").exists()
+            )
 
 
 if __name__ == "__main__":
@@ -9,12 +9,23 @@ Goal: Keep fallback-kernel support intact while making the decision logic explic
 from __future__ import annotations
 
 import importlib.util
+import contextlib
+import io
 import json
+import lzma
 from pathlib import Path
+import shutil
+import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import unittest
+from unittest.mock import patch
+
+from ci_tools import common
+from ci_tools.akmods_build_and_publish import build_install_manifest
+from fake_rpm import build_cpio, build_kmod_rpm, build_rpm, cpio_file
 
 
 def _load_helper_module():
@@ -69,6 +80,41 @@ class InstallZfsFromAkmodsCacheTests(unittest.TestCase):
             "ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-43",
         )
 
+    def test_cache_label_check_fails_before_download_when_kernels_are_missing(self) -> None:
+        calls: list[list[str]] = []
+
+        def fake_run_cmd(args: list[str]) -> str:
+            calls.append(args)
+            return json.dumps(
+                {
+                    "Labels": {
+                        common.AKMODS_CACHE_METADATA_VERSION_LABEL: common.AKMODS_CACHE_METADATA_VERSION,
+                        common.AKMODS_CACHE_KERNEL_RELEASES_LABEL: "6.18.13-200.fc43.x86_64",
+                    }
+                }
+            )
+
+        with self.assertRaisesRegex(RuntimeError, "6.18.16-200.fc43.x86_64 \\(it covers 6.18.13"):
+            helper.check_cache_labels_cover_kernels(
+                "ghcr.io/example/akmods-zfs:main-43",
+                ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+                run_cmd=fake_run_cmd,
+            )
+        self.assertEqual(calls[0][:2], ["skopeo", "inspect"])
+
+    def test_cache_label_check_defers_to_the_plan_without_labels(self) -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            helper.check_cache_labels_cover_kernels(
+                "ghcr.io/example/akmods-zfs:main-43",
+                ["6.18.16-200.fc43.x86_64"],
+                run_cmd=lambda _args: json.dumps({"Labels": {}}),
+            )
+
+    def test_cache_label_names_match_the_publisher(self) -> None:
+        self.assertEqual(helper.AKMODS_CACHE_METADATA_VERSION, common.AKMODS_CACHE_METADATA_VERSION)
+        self.assertEqual(helper.AKMODS_CACHE_METADATA_VERSION_LABEL, common.AKMODS_CACHE_METADATA_VERSION_LABEL)
+        self.assertEqual(helper.AKMODS_CACHE_KERNEL_RELEASES_LABEL, common.AKMODS_CACHE_KERNEL_RELEASES_LABEL)
+
     def test_load_layer_files_from_oci_layout_reads_manifest_layers(self) -> None:
         with tempfile.TemporaryDirectory() as temp_dir:
             layout_dir = Path(temp_dir)
@@ -110,6 +156,47 @@ class InstallZfsFromAkmodsCacheTests(unittest.TestCase):
             with self.assertRaisesRegex(RuntimeError, "Unsafe tar path"):
                 helper.unpack_layer_tarballs([bad_layer], destination)
 
+    def test_unpack_layer_tarballs_extracts_only_cached_zfs_rpms(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            layer = root / "layer.tar.gz"
+            destination = root / "extract"
+            destination.mkdir()
+
+            with tarfile.open(layer, "w:gz") as tar_handle:
+                for name in (
+                    "kernel-rpms/kernel-core-6.18.16.rpm",
+                    "rpms/kmods/zfs/kmod-zfs-6.18.16.rpm",
+                    "./rpms/kmods/zfs/zfs-2.4.1.rpm",
+                    "rpms/kmods/zfs/debug/zfs-debuginfo.rpm",
+                    "rpms/kmods/zfs/README",
+                    "rpms/kmods/zfs/install-manifest.json",
+                    "kmod-overlay/6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko",
+                ):
+                    data = name.encode("utf-8")
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar_handle.addfile(info, io.BytesIO(data))
+
+            with (
+                patch.object(tarfile.TarFile, "getmembers", side_effect=AssertionError("getmembers")),
+                contextlib.redirect_stdout(io.StringIO()),
+            ):
+                extracted = helper.unpack_layer_tarballs([layer], destination)
+
+            written = sorted(str(path.relative_to(destination)) for path in destination.rglob("*") if path.is_file())
+
+        self.assertEqual(extracted, 2)
+        self.assertEqual(
+            written,
+            [
+                "kmod-overlay/6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko",
+                "rpms/kmods/zfs/install-manifest.json",
+                "rpms/kmods/zfs/kmod-zfs-6.18.16.rpm",
+                "rpms/kmods/zfs/zfs-2.4.1.rpm",
+            ],
+        )
+
     def test_discover_zfs_rpms_filters_non_installable_entries(self) -> None:
         with tempfile.TemporaryDirectory() as temp_dir:
             rpm_root = Path(temp_dir)
@@ -155,6 +242,334 @@ class InstallZfsFromAkmodsCacheTests(unittest.TestCase):
         self.assertEqual(plan.primary_kmod_rpm, second_kmod)
         self.assertEqual(plan.kmod_rpm_by_kernel["6.18.13-200.fc43.x86_64"], first_kmod)
 
+    def test_build_install_plan_reads_rpm_headers_without_subprocesses(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rpm_root = Path(temp_dir)
+            shared_rpm = rpm_root / "zfs-2.4.1-1.fc43.x86_64.rpm"
+            # File names are deliberately misleading: only header contents count.
+            first_kmod = rpm_root / "kmod-zfs-6.18.16-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm"
+            second_kmod = rpm_root / "kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm"
+            shared_rpm.write_bytes(build_rpm("zfs", files=["/usr/sbin/zpool"]))
+            first_kmod.write_bytes(build_kmod_rpm("6.18.13-200.fc43.x86_64"))
+            second_kmod.write_bytes(build_kmod_rpm("6.18.16-200.fc43.x86_64"))
+
+            with patch.object(helper, "_run_cmd", side_effect=AssertionError("rpm spawned")):
+                plan = helper.build_install_plan(
+                    ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+                    helper.discover_zfs_rpms(rpm_root),
+                )
+
+        self.assertEqual(plan.managed_rpms, [shared_rpm])
+        self.assertEqual(plan.primary_kmod_rpm, second_kmod)
+        self.assertEqual(plan.kmod_rpm_by_kernel["6.18.13-200.fc43.x86_64"], first_kmod)
+
+    def test_install_manifest_from_publish_step_drives_the_plan(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            merged_root = Path(temp_dir)
+            rpm_root = merged_root / "rpms" / "kmods" / "zfs"
+            rpm_root.mkdir(parents=True)
+            shared_rpm = rpm_root / "zfs-2.4.1-1.fc43.x86_64.rpm"
+            first_kmod = rpm_root / "kmod-zfs-a.rpm"
+            second_kmod = rpm_root / "kmod-zfs-b.rpm"
+            shared_rpm.write_bytes(build_rpm("zfs", files=["/usr/sbin/zpool"]))
+            first_kmod.write_bytes(build_kmod_rpm("6.18.13-200.fc43.x86_64"))
+            second_kmod.write_bytes(build_kmod_rpm("6.18.16-200.fc43.x86_64"))
+            manifest_path = merged_root / common.AKMODS_INSTALL_MANIFEST_PATH
+            manifest_path.write_text(json.dumps(build_install_manifest(merged_root=merged_root)))
+            zfs_rpms = helper.discover_zfs_rpms(rpm_root)
+
+            with (
+                patch.object(helper, "rpm_header", None),
+                patch.object(helper, "_run_cmd", side_effect=AssertionError("rpm spawned")),
+            ):
+                install_manifest = helper.InstallManifest.load(zfs_rpms, manifest_path)
+            assert install_manifest is not None
+            plan = helper.build_install_plan(
+                ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+                zfs_rpms,
+                rpm_name_lookup=install_manifest.rpm_name,
+                kernel_release_lookup=install_manifest.kmod_kernel_release,
+            )
+
+            # A rebuilt RPM with the same file name no longer matches the document.
+            first_kmod.write_bytes(build_kmod_rpm("6.18.14-200.fc43.x86_64"))
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                stale_manifest = helper.InstallManifest.load(zfs_rpms, manifest_path)
+
+        self.assertEqual(plan.managed_rpms, [shared_rpm])
+        self.assertEqual(plan.primary_kmod_rpm, second_kmod)
+        self.assertEqual(plan.kmod_rpm_by_kernel["6.18.13-200.fc43.x86_64"], first_kmod)
+        self.assertIsNone(stale_manifest)
+        self.assertIn("checksum mismatch for kmod-zfs-a.rpm", output.getvalue())
+
+    def test_install_manifest_is_ignored_when_missing_or_from_another_schema(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest_path = Path(temp_dir) / "install-manifest.json"
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertIsNone(helper.InstallManifest.load([], manifest_path))
+                manifest_path.write_text(json.dumps({"schemaVersion": 99, "rpms": []}))
+                self.assertIsNone(helper.InstallManifest.load([], manifest_path))
+
+    def test_install_manifest_constants_match_the_publisher(self) -> None:
+        self.assertEqual(helper.AKMODS_INSTALL_MANIFEST_PATH, common.AKMODS_INSTALL_MANIFEST_PATH)
+        self.assertEqual(helper.AKMODS_INSTALL_MANIFEST_VERSION, common.AKMODS_INSTALL_MANIFEST_VERSION)
+        self.assertEqual(helper.AKMODS_KMOD_OVERLAY_DIR, common.AKMODS_KMOD_OVERLAY_DIR)
+
+    def test_batched_rpm_query_answers_plan_lookups_from_one_rpm_call(self) -> None:
+        shared_rpm = Path("/tmp/rpms/zfs-2.4.1.rpm")
+        first_kmod = Path("/tmp/rpms/kmod-zfs-a.rpm")
+        second_kmod = Path("/tmp/rpms/kmod-zfs-b.rpm")
+        calls: list[list[str]] = []
+
+        def fake_run_cmd(args: list[str]) -> str:
+            calls.append(args)
+            return (
+                "@@ zfs\n"
+                "/usr/sbin/zpool\n"
+                "@@ kmod-zfs\n"
+                "/lib/modules/6.18.13-200.fc43.x86_64/extra/zfs/spl.ko\n"
+                "/lib/modules/6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko\n"
+                "@@ kmod-zfs\n"
+                "/lib/modules/6.18.16-200.fc43.x86_64/extra/zfs/zfs.ko\n"
+            )
+
+        rpm_query = helper.BatchedRpmQuery.query(
+            [shared_rpm, first_kmod, second_kmod],
+            run_cmd=fake_run_cmd,
+        )
+        plan = helper.build_install_plan(
+            ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+            [shared_rpm, first_kmod, second_kmod],
+            rpm_name_lookup=rpm_query.rpm_name,
+            kernel_release_lookup=rpm_query.kmod_kernel_release,
+        )
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][-3:], [str(shared_rpm), str(first_kmod), str(second_kmod)])
+        self.assertEqual(plan.managed_rpms, [shared_rpm])
+        self.assertEqual(plan.primary_kmod_rpm, second_kmod)
+        self.assertEqual(plan.kmod_rpm_by_kernel["6.18.13-200.fc43.x86_64"], first_kmod)
+
+    def test_batched_rpm_query_rejects_short_rpm_output(self) -> None:
+        with self.assertRaisesRegex(RuntimeError, "returned 1 packages for 2"):
+            helper.BatchedRpmQuery.query(
+                [Path("/tmp/a.rpm"), Path("/tmp/b.rpm")],
+                run_cmd=lambda _args: "@@ zfs\n",
+            )
+
+    def test_extract_kmod_payload_writes_only_the_kernel_module_tree(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            rpm_path = root / "kmod.rpm"
+            rpm_path.write_bytes(build_kmod_rpm("6.18.13-200.fc43.x86_64"))
+            image_root = root / "image"
+
+            files_written = helper.extract_kmod_payload(rpm_path, "6.18.13-200.fc43.x86_64", image_root)
+
+            module_dir = image_root / "lib" / "modules" / "6.18.13-200.fc43.x86_64" / "extra" / "zfs"
+            self.assertEqual(files_written, 2)
+            self.assertEqual((module_dir / "zfs.ko").read_bytes(), b"zfs for 6.18.13-200.fc43.x86_64")
+            self.assertEqual((module_dir / "zfs.ko").stat().st_mtime, 1_700_000_000)
+            self.assertFalse((image_root / "etc").exists())
+
+    def test_extract_kmod_payload_reads_xz_payloads_and_rejects_unsafe_paths(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            rpm_path = root / "kmod.rpm"
+            rpm_path.write_bytes(
+                build_rpm(
+                    "kmod-zfs",
+                    payload=lzma.compress(build_cpio([cpio_file("./lib/modules/../../escape", b"x")])),
+                    payload_compressor="xz",
+                )
+            )
+
+            with self.assertRaisesRegex(RuntimeError, "Unsafe cpio path"):
+                helper.extract_kmod_payload(rpm_path, "6.18.13-200.fc43.x86_64", root / "image")
+
+    @unittest.skipUnless(shutil.which("zstd"), "needs the zstd command")
+    def test_extract_kmod_payload_decodes_zstd_with_the_zstd_command(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            cpio = build_cpio([cpio_file("./lib/modules/6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko", b"zfs")])
+            payload = subprocess.run(["zstd", "--stdout", "--quiet"], input=cpio, capture_output=True, check=True).stdout
+            rpm_path = root / "kmod.rpm"
+            # Enough header bytes that buffered reads overshoot the payload start.
+            rpm_path.write_bytes(
+                build_rpm("kmod-zfs", files=["/etc/x"] * 2000, payload=payload, payload_compressor="zstd")
+            )
+
+            # Force the command path even on Pythons with a zstd module.
+            with (
+                patch.object(helper.rpm_header, "zstd", None),
+                patch.object(helper.rpm_header, "zstandard", None),
+            ):
+                files_written = helper.extract_kmod_payload(rpm_path, "6.18.13-200.fc43.x86_64", root / "image")
+
+            self.assertEqual(files_written, 1)
+            module = root / "image/lib/modules/6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko"
+            self.assertEqual(module.read_bytes(), b"zfs")
+
+            rpm_path.write_bytes(build_rpm("kmod-zfs", payload=payload[:-8] + b"corrupt!", payload_compressor="zstd"))
+            with (
+                patch.object(helper.rpm_header, "zstd", None),
+                patch.object(helper.rpm_header, "zstandard", None),
+                self.assertRaisesRegex(helper.rpm_header.RpmHeaderError, "zstd failed"),
+            ):
+                helper.extract_kmod_payload(rpm_path, "6.18.13-200.fc43.x86_64", root / "image")
+
+    def test_apply_extra_kmod_payloads_falls_back_to_rpm2cpio_for_unknown_compressors(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            primary = root / "primary.rpm"
+            fallback = root / "fallback.rpm"
+            fallback.write_bytes(build_rpm("kmod-zfs", payload_compressor="unknown"))
+            plan = helper.InstallPlan(
+                image_kernels=["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+                managed_rpms=[],
+                kmod_rpm_by_kernel={
+                    "6.18.13-200.fc43.x86_64": fallback,
+                    "6.18.16-200.fc43.x86_64": primary,
+                },
+                primary_kernel_release="6.18.16-200.fc43.x86_64",
+                primary_kmod_rpm=primary,
+            )
+
+            output = io.StringIO()
+            with (
+                patch.object(helper, "_require_command"),
+                patch.object(helper, "unpack_rpm_payload") as unpack_rpm_payload,
+                contextlib.redirect_stdout(output),
+            ):
+                helper.apply_extra_kmod_payloads(plan)
+
+        unpack_rpm_payload.assert_called_once_with(fallback)
+        self.assertIn("Warning: cannot decode the payload of fallback.rpm", output.getvalue())
+
+    def test_apply_kmod_overlay_copies_trees_only_for_the_fallback_kernel_set(self) -> None:
+        primary = Path("/tmp/primary.rpm")
+        plan = helper.InstallPlan(
+            image_kernels=["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+            managed_rpms=[],
+            kmod_rpm_by_kernel={
+                "6.18.13-200.fc43.x86_64": Path("/tmp/fallback.rpm"),
+                "6.18.16-200.fc43.x86_64": primary,
+            },
+            primary_kernel_release="6.18.16-200.fc43.x86_64",
+            primary_kmod_rpm=primary,
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            overlay_root = root / "kmod-overlay"
+            modules_root = root / "lib" / "modules"
+            overlay_module = overlay_root / "6.18.13-200.fc43.x86_64" / "extra" / "zfs" / "zfs.ko"
+            overlay_module.parent.mkdir(parents=True)
+            overlay_module.write_bytes(b"zfs")
+            (modules_root / "6.18.13-200.fc43.x86_64" / "kernel").mkdir(parents=True)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                applied = helper.apply_kmod_overlay(plan, overlay_root=overlay_root, modules_root=modules_root)
+            copied = (modules_root / "6.18.13-200.fc43.x86_64" / "extra" / "zfs" / "zfs.ko").read_bytes()
+
+            # An overlay built for a different kernel set is not used.
+            (overlay_root / "6.18.10-200.fc43.x86_64").mkdir()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                mismatched = helper.apply_kmod_overlay(plan, overlay_root=overlay_root, modules_root=modules_root)
+
+        self.assertTrue(applied)
+        self.assertEqual(copied, b"zfs")
+        self.assertFalse(mismatched)
+        self.assertIn("unpacking RPM payloads instead", output.getvalue())
+
+    def test_remove_scratch_root_reports_size_and_deletes_everything(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            scratch_root = Path(temp_dir) / "akmods-zfs"
+            blob = scratch_root / "layout" / "blob"
+            blob.parent.mkdir(parents=True)
+            blob.write_bytes(b"x" * (3 << 20))
+            (scratch_root / "extract").mkdir()
+
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                helper.remove_scratch_root(scratch_root)
+
+            self.assertFalse(scratch_root.exists())
+        self.assertIn("(3.0 MiB)", output.getvalue())
+
+    def test_main_removes_scratch_data_when_the_install_fails(self) -> None:
+        with (
+            patch.object(helper, "install_from_akmods_cache", side_effect=RuntimeError("boom")),
+            patch.object(helper, "remove_scratch_root") as remove_scratch_root,
+        ):
+            with self.assertRaisesRegex(RuntimeError, "boom"):
+                helper.main()
+
+        remove_scratch_root.assert_called_once_with()
+
+    def test_scratch_paths_stay_under_the_scratch_root(self) -> None:
+        for path in (helper.LAYOUT_DIR, helper.EXTRACT_ROOT, helper.RPM_SEARCH_ROOT, helper.KMOD_OVERLAY_ROOT):
+            self.assertTrue(path.is_relative_to(helper.SCRATCH_ROOT), path)
+
+    def test_run_per_kernel_logs_in_kernel_order(self) -> None:
+        second_done = threading.Event()
+
+        def task(kernel_release: str) -> list[str]:
+            if kernel_release == "a":
+                # Finish last so completion order differs from log order.
+                second_done.wait(timeout=5)
+                return ["first"]
+            second_done.set()
+            return ["second"]
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            helper.run_per_kernel(["a", "b"], task, max_workers=2, title="Testing")
+
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            ["Testing (2 kernels, 2 workers):", "  a: first", "  b: second"],
+        )
+
+    def test_run_per_kernel_raises_first_failure_and_skips_queued_kernels(self) -> None:
+        def task(kernel_release: str) -> list[str]:
+            if kernel_release == "b":
+                raise RuntimeError("depmod failed for b")
+            return ["ok"]
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), self.assertRaisesRegex(RuntimeError, "depmod failed for b"):
+            helper.run_per_kernel(["a", "b", "c"], task, max_workers=1, title="Testing")
+
+        self.assertEqual(
+            output.getvalue().splitlines()[1:],
+            ["  a: ok", "  b: failed: depmod failed for b", "  c: skipped after an earlier failure"],
+        )
+
+    def test_validate_installed_modules_runs_depmod_for_every_kernel(self) -> None:
+        kernels = ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            modules_root = Path(temp_dir)
+            for kernel_release in kernels:
+                module_dir = modules_root / kernel_release / "extra" / "zfs"
+                module_dir.mkdir(parents=True)
+                (module_dir / "zfs.ko").write_bytes(b"zfs")
+
+            with (
+                patch.object(helper, "_run_cmd", return_value="") as run_cmd,
+                contextlib.redirect_stdout(io.StringIO()),
+            ):
+                helper.validate_installed_modules(kernels, modules_root=modules_root, max_workers=2)
+
+        self.assertCountEqual(
+            [call.args[0] for call in run_cmd.call_args_list],
+            [["depmod", "-a", kernel_release] for kernel_release in kernels],
+        )
+
+    def test_kernel_worker_count_reads_env(self) -> None:
+        self.assertEqual(helper.kernel_worker_count({}), 4)
+        self.assertEqual(helper.kernel_worker_count({"ZFS_KERNEL_WORKERS": "2"}), 2)
+        with self.assertRaisesRegex(RuntimeError, "ZFS_KERNEL_WORKERS"):
+            helper.kernel_worker_count({"ZFS_KERNEL_WORKERS": "many"})
+
     def test_build_install_plan_rejects_missing_kernel_payload(self) -> None:
         first_kmod = Path("/tmp/kmod-zfs-6.18.13.rpm")
 
@@ -1,14 +1,18 @@
 """
 Script: tests/test_main_check_candidate_akmods_cache.py
 What: Tests for main akmods cache validation helpers.
-Doing: Creates temporary RPM trees and checks missing-kernel detection.
+Doing: Streams fake cache layers holding synthetic RPMs and checks missing-kernel detection.
 Why: Protects the multi-kernel cache check added for base images with fallback kernels.
 Goal: Keep rebuild decisions fail-closed when any required kernel RPM is absent.
 """
 
 from __future__ import annotations
 
+import gzip
+import io
+import json
 import os
+import tarfile
 import tempfile
 from pathlib import Path
 import unittest
@@ -18,34 +22,70 @@ from ci_tools.common import (
     AKMODS_CACHE_KERNEL_RELEASES_LABEL,
     AKMODS_CACHE_METADATA_VERSION,
     AKMODS_CACHE_METADATA_VERSION_LABEL,
+    CiToolError,
+    ImageNotFoundError,
 )
 from ci_tools.main_check_candidate_akmods_cache import (
-    _missing_kernel_releases,
     AkmodsCacheStatus,
+    _scan_cache_layers_for_kernel_rpms,
     inspect_candidate_akmods_cache,
+    kernel_releases_in_layer_entries,
     write_cache_status_outputs,
 )
+from ci_tools.registry_client import RegistryClient, parse_image_ref
+from fake_registry import FakeRegistry
+from fake_rpm import build_kmod_rpm, build_rpm
+
+
+KMOD_13 = "kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm"
+KMOD_16 = "kmod-zfs-6.18.16-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm"
+
+
+def _layer_tarball(files: dict[str, bytes]) -> bytes:
+    """Build one gzip layer holding `files` (path -> content)."""
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as layer_tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            layer_tar.addfile(info, io.BytesIO(data))
+    return gzip.compress(buffer.getvalue(), mtime=0)
 
 
 class MainCheckCandidateAkmodsCacheTests(unittest.TestCase):
     def test_reports_missing_kernel_releases(self) -> None:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            root = Path(temp_dir)
-            rpm_dir = root / "rpms" / "kmods" / "zfs"
-            rpm_dir.mkdir(parents=True, exist_ok=True)
-
-            # This file name follows the cache-check glob pattern used by the workflow.
-            (rpm_dir / "kmod-zfs-6.18.13-200.fc43.x86_64-2.4.1-1.fc43.x86_64.rpm").touch()
-
-            missing = _missing_kernel_releases(
-                root,
-                [
-                    "6.18.13-200.fc43.x86_64",
-                    "6.18.16-200.fc43.x86_64",
-                ],
-            )
+        found, layers_scanned = kernel_releases_in_layer_entries(
+            [["6.18.13-200.fc43.x86_64"]],
+            [
+                "6.18.13-200.fc43.x86_64",
+                "6.18.16-200.fc43.x86_64",
+            ],
+        )
+
+        self.assertEqual(found, {"6.18.13-200.fc43.x86_64"})
+        self.assertEqual(layers_scanned, 1)
 
-            self.assertEqual(missing, ["6.18.16-200.fc43.x86_64"])
+    def test_layer_scan_stops_once_every_kernel_is_found(self) -> None:
+        read_after_match: list[str] = []
+
+        def second_layer():
+            yield "6.18.16-200.fc43.x86_64"
+            read_after_match.append("rest")
+            yield "6.18.20-200.fc43.x86_64"
+
+        found, layers_scanned = kernel_releases_in_layer_entries(
+            [
+                ["6.18.13-200.fc43.x86_64"],
+                second_layer(),
+                ["never-read"],
+            ],
+            ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+        )
+
+        self.assertEqual(len(found), 2)
+        self.assertEqual(layers_scanned, 2)
+        self.assertEqual(read_after_match, [])
 
     def test_inspect_candidate_akmods_cache_uses_registry_creds_when_available(self) -> None:
         with patch.dict(
@@ -53,110 +93,241 @@ class MainCheckCandidateAkmodsCacheTests(unittest.TestCase):
             {
                 "REGISTRY_ACTOR": "actor",
                 "REGISTRY_TOKEN": "token",
+                "REGISTRY_CLIENT": "native",
             },
             clear=False,
         ):
             with patch(
-                "ci_tools.main_check_candidate_akmods_cache.skopeo_exists",
-                return_value=True,
-            ) as skopeo_exists:
+                "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+                return_value={"Digest": "sha256:cache"},
+            ) as inspect_json:
                 with patch(
-                    "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
-                    return_value={},
-                ) as inspect_json:
-                    with patch("ci_tools.main_check_candidate_akmods_cache.skopeo_copy") as skopeo_copy:
-                        with patch(
-                            "ci_tools.main_check_candidate_akmods_cache.load_layer_files_from_oci_layout",
-                            return_value=[],
-                        ):
-                            with patch(
-                                "ci_tools.main_check_candidate_akmods_cache.unpack_layer_tarballs",
-                            ):
-                                status = inspect_candidate_akmods_cache(
-                                    image_org="danathar",
-                                    source_repo="kinoite-zfs-bluebuild-akmods",
-                                    fedora_version="43",
-                                    kernel_releases=["6.18.16-200.fc43.x86_64"],
-                                )
+                    "ci_tools.main_check_candidate_akmods_cache._scan_cache_layers_for_kernel_rpms",
+                    return_value=("6.18.16-200.fc43.x86_64",),
+                ) as scan_layers:
+                    status = inspect_candidate_akmods_cache(
+                        image_org="danathar",
+                        source_repo="kinoite-zfs-bluebuild-akmods",
+                        fedora_version="43",
+                        kernel_releases=["6.18.16-200.fc43.x86_64"],
+                    )
 
         self.assertFalse(status.reusable)
-        skopeo_exists.assert_called_once_with(
-            "docker://ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-43",
-            creds="actor:token",
-        )
         inspect_json.assert_called_once_with(
             "docker://ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-43",
             creds="actor:token",
         )
-        copy_args, copy_kwargs = skopeo_copy.call_args
+        self.assertEqual(scan_layers.call_args.kwargs["creds"], "actor:token")
+
+    def test_inspect_candidate_akmods_cache_streams_layers_by_digest(self) -> None:
+        with FakeRegistry() as registry:
+            digest = registry.add_image(
+                "danathar/kinoite-zfs-bluebuild-akmods",
+                "main-43",
+                layers=[
+                    _layer_tarball({f"rpms/kmods/zfs/{KMOD_13}": build_kmod_rpm("6.18.13-200.fc43.x86_64")}),
+                    _layer_tarball({f"rpms/kmods/zfs/{KMOD_16}": build_kmod_rpm("6.18.16-200.fc43.x86_64")}),
+                ],
+            )
+            client = RegistryClient(timeout=5)
+            try:
+                with (
+                    patch.dict(os.environ, {"REGISTRY_CLIENT": "native"}),
+                    patch(
+                        "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+                        return_value={"Digest": digest},
+                    ),
+                    patch(
+                        "ci_tools.main_check_candidate_akmods_cache.registry_client",
+                        return_value=client,
+                    ),
+                    patch(
+                        "ci_tools.main_check_candidate_akmods_cache.parse_image_ref",
+                        # Point the hard-coded GHCR name at the local stand-in.
+                        side_effect=lambda ref: parse_image_ref(ref.replace("ghcr.io", registry.host)),
+                    ) as scanned_ref,
+                ):
+                    status = inspect_candidate_akmods_cache(
+                        image_org="danathar",
+                        source_repo="kinoite-zfs-bluebuild-akmods",
+                        fedora_version="43",
+                        kernel_releases=["6.18.16-200.fc43.x86_64"],
+                        creds="actor:token",
+                    )
+            finally:
+                client.close()
+
+        self.assertTrue(status.reusable)
+        self.assertEqual(status.digest, digest)
         self.assertEqual(
-            copy_args[0],
-            "docker://ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-43",
+            scanned_ref.call_args.args[0],
+            f"docker://ghcr.io/danathar/kinoite-zfs-bluebuild-akmods@{digest}",
         )
-        self.assertTrue(copy_args[1].startswith("dir:"))
-        self.assertEqual(copy_kwargs["creds"], "actor:token")
 
-    def test_inspect_candidate_akmods_cache_uses_metadata_fast_path_when_present(self) -> None:
+    def test_inspect_candidate_akmods_cache_copies_layers_to_a_dir_layout_by_default(self) -> None:
+        layers = [
+            _layer_tarball({f"rpms/kmods/zfs/{KMOD_13}": build_kmod_rpm("6.18.13-200.fc43.x86_64")}),
+            _layer_tarball({f"rpms/kmods/zfs/{KMOD_16}": build_kmod_rpm("6.18.20-200.fc43.x86_64")}),
+        ]
+
+        def fake_copy(source: str, destination: str, *, creds: str | None = None) -> None:
+            image_dir = Path(destination.removeprefix("dir:"))
+            image_dir.mkdir(parents=True)
+            manifest_layers = []
+            for index, layer in enumerate(layers):
+                digest = f"sha256:{index:064x}"
+                (image_dir / digest.removeprefix("sha256:")).write_bytes(layer)
+                manifest_layers.append({"digest": digest})
+            (image_dir / "manifest.json").write_text(json.dumps({"layers": manifest_layers}), encoding="utf-8")
+
+        with (
+            patch.dict(os.environ, {"REGISTRY_CLIENT": ""}),
+            patch(
+                "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+                return_value={"Digest": "sha256:cache"},
+            ),
+            patch(
+                "ci_tools.main_check_candidate_akmods_cache.copy_image_to_dir_layout",
+                side_effect=fake_copy,
+            ) as copy,
+            patch("ci_tools.main_check_candidate_akmods_cache.registry_client") as layer_client,
+        ):
+            status = inspect_candidate_akmods_cache(
+                image_org="danathar",
+                source_repo="kinoite-zfs-bluebuild-akmods",
+                fedora_version="43",
+                kernel_releases=["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+                creds="actor:token",
+            )
+
+        # The second RPM is named for 6.18.16 but its header says otherwise.
+        self.assertEqual(status.missing_releases, ("6.18.16-200.fc43.x86_64",))
+        self.assertEqual(
+            copy.call_args.args[0],
+            "docker://ghcr.io/danathar/kinoite-zfs-bluebuild-akmods@sha256:cache",
+        )
+        self.assertEqual(copy.call_args.kwargs["creds"], "actor:token")
+        layer_client.assert_not_called()
+
+    def test_layer_scan_trusts_rpm_headers_over_file_names(self) -> None:
+        with FakeRegistry() as registry:
+            registry.add_image(
+                "danathar/akmods",
+                "main-43",
+                layers=[
+                    _layer_tarball(
+                        {
+                            # Right header, wrong directory.
+                            f"rpms/kmods/{KMOD_13}": build_kmod_rpm("6.18.13-200.fc43.x86_64"),
+                            # Right name, but the header is for another kernel.
+                            f"rpms/kmods/zfs/{KMOD_16}": build_kmod_rpm("6.18.20-200.fc43.x86_64"),
+                            "rpms/kmods/zfs/broken.rpm": b"not an rpm",
+                            "rpms/kmods/zfs/zfs-2.4.1-1.fc43.x86_64.rpm": build_rpm("zfs"),
+                        }
+                    ),
+                ],
+            )
+            client = RegistryClient(timeout=5)
+            try:
+                missing = _scan_cache_layers_for_kernel_rpms(
+                    f"docker://{registry.host}/danathar/akmods:main-43",
+                    ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+                    client=client,
+                )
+            finally:
+                client.close()
+
+        self.assertEqual(missing, ("6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"))
+
+    def test_inspect_candidate_akmods_cache_reports_missing_image_from_one_lookup(self) -> None:
+        with patch(
+            "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+            side_effect=ImageNotFoundError("Image not found"),
+        ) as inspect_json:
+            status = inspect_candidate_akmods_cache(
+                image_org="danathar",
+                source_repo="kinoite-zfs-bluebuild-akmods",
+                fedora_version="43",
+                kernel_releases=["6.18.16-200.fc43.x86_64"],
+                creds="actor:token",
+            )
+
+        self.assertFalse(status.image_exists)
+        self.assertEqual(status.digest, "")
+        self.assertEqual(status.missing_releases, ("6.18.16-200.fc43.x86_64",))
+        inspect_json.assert_called_once()
+
+    def test_inspect_candidate_akmods_cache_raises_registry_errors(self) -> None:
         with patch(
-            "ci_tools.main_check_candidate_akmods_cache.skopeo_exists",
-            return_value=True,
+            "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+            side_effect=CiToolError("unauthorized: authentication required"),
         ):
-            with patch(
-                "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
-                return_value={
-                    "Labels": {
-                        AKMODS_CACHE_METADATA_VERSION_LABEL: AKMODS_CACHE_METADATA_VERSION,
-                        AKMODS_CACHE_KERNEL_RELEASES_LABEL: (
-                            "6.18.13-200.fc43.x86_64 6.18.16-200.fc43.x86_64"
-                        ),
-                    }
+            with self.assertRaises(CiToolError):
+                inspect_candidate_akmods_cache(
+                    image_org="danathar",
+                    source_repo="kinoite-zfs-bluebuild-akmods",
+                    fedora_version="43",
+                    kernel_releases=["6.18.16-200.fc43.x86_64"],
+                    creds="actor:token",
+                )
+
+    def test_inspect_candidate_akmods_cache_uses_metadata_fast_path_when_present(self) -> None:
+        with patch(
+            "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+            return_value={
+                "Digest": "sha256:cache",
+                "Labels": {
+                    AKMODS_CACHE_METADATA_VERSION_LABEL: AKMODS_CACHE_METADATA_VERSION,
+                    AKMODS_CACHE_KERNEL_RELEASES_LABEL: (
+                        "6.18.13-200.fc43.x86_64 6.18.16-200.fc43.x86_64"
+                    ),
                 },
-            ):
-                with patch("ci_tools.main_check_candidate_akmods_cache.skopeo_copy") as skopeo_copy:
-                    with patch(
-                        "ci_tools.main_check_candidate_akmods_cache.load_layer_files_from_oci_layout"
-                    ) as layer_loader:
-                        status = inspect_candidate_akmods_cache(
-                            image_org="danathar",
-                            source_repo="kinoite-zfs-bluebuild-akmods",
-                            fedora_version="43",
-                            kernel_releases=["6.18.16-200.fc43.x86_64"],
-                            creds="actor:token",
-                        )
+            },
+        ) as inspect_json:
+            with patch("ci_tools.main_check_candidate_akmods_cache.registry_client") as layer_client:
+                status = inspect_candidate_akmods_cache(
+                    image_org="danathar",
+                    source_repo="kinoite-zfs-bluebuild-akmods",
+                    fedora_version="43",
+                    kernel_releases=["6.18.16-200.fc43.x86_64"],
+                    creds="actor:token",
+                )
 
         self.assertTrue(status.reusable)
-        skopeo_copy.assert_not_called()
-        layer_loader.assert_not_called()
+        self.assertEqual(
+            status.pinned_image,
+            "ghcr.io/danathar/kinoite-zfs-bluebuild-akmods@sha256:cache",
+        )
+        inspect_json.assert_called_once()
+        layer_client.assert_not_called()
 
     def test_inspect_candidate_akmods_cache_reports_stale_metadata_without_copy(self) -> None:
         with patch(
-            "ci_tools.main_check_candidate_akmods_cache.skopeo_exists",
-            return_value=True,
-        ):
-            with patch(
-                "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
-                return_value={
-                    "Labels": {
-                        AKMODS_CACHE_METADATA_VERSION_LABEL: AKMODS_CACHE_METADATA_VERSION,
-                        AKMODS_CACHE_KERNEL_RELEASES_LABEL: "6.18.13-200.fc43.x86_64",
-                    }
+            "ci_tools.main_check_candidate_akmods_cache.skopeo_inspect_json",
+            return_value={
+                "Digest": "sha256:cache",
+                "Labels": {
+                    AKMODS_CACHE_METADATA_VERSION_LABEL: AKMODS_CACHE_METADATA_VERSION,
+                    AKMODS_CACHE_KERNEL_RELEASES_LABEL: "6.18.13-200.fc43.x86_64",
                 },
-            ):
-                with patch("ci_tools.main_check_candidate_akmods_cache.skopeo_copy") as skopeo_copy:
-                    status = inspect_candidate_akmods_cache(
-                        image_org="danathar",
-                        source_repo="kinoite-zfs-bluebuild-akmods",
-                        fedora_version="43",
-                        kernel_releases=[
-                            "6.18.13-200.fc43.x86_64",
-                            "6.18.16-200.fc43.x86_64",
-                        ],
-                        creds="actor:token",
-                    )
+            },
+        ):
+            with patch("ci_tools.main_check_candidate_akmods_cache.registry_client") as layer_client:
+                status = inspect_candidate_akmods_cache(
+                    image_org="danathar",
+                    source_repo="kinoite-zfs-bluebuild-akmods",
+                    fedora_version="43",
+                    kernel_releases=[
+                        "6.18.13-200.fc43.x86_64",
+                        "6.18.16-200.fc43.x86_64",
+                    ],
+                    creds="actor:token",
+                )
 
         self.assertFalse(status.reusable)
         self.assertEqual(status.missing_releases, ("6.18.16-200.fc43.x86_64",))
-        skopeo_copy.assert_not_called()
+        self.assertEqual(status.digest, "sha256:cache")
+        layer_client.assert_not_called()
 
     def test_write_cache_status_outputs_writes_structured_values(self) -> None:
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -173,6 +344,7 @@ class MainCheckCandidateAkmodsCacheTests(unittest.TestCase):
                         source_image="ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-43",
                         image_exists=True,
                         missing_releases=("6.18.16-200.fc43.x86_64",),
+                        digest="sha256:cache",
                     )
                 )
 
@@ -180,6 +352,7 @@ class MainCheckCandidateAkmodsCacheTests(unittest.TestCase):
             self.assertIn("exists=false\n", outputs)
             self.assertIn("status=stale\n", outputs)
             self.assertIn("missing_releases=6.18.16-200.fc43.x86_64\n", outputs)
+            self.assertIn("source_digest=sha256:cache\n", outputs)
             self.assertIn(
                 "source_image=ghcr.io/danathar/kinoite-zfs-bluebuild-akmods:main-43\n",
                 outputs,
@@ -1,16 +1,33 @@
 """
 Script: tests/test_main_publish_candidate_akmods_alias.py
 What: Tests for candidate akmods alias tag selection.
-Doing: Checks full-kernel preference and architecture-trimmed fallback behavior.
+Doing: Checks full-kernel preference, architecture-trimmed fallback behavior, and probe-before-copy.
 Why: Prevents wrong tag-choice behavior in candidate alias publication.
 Goal: Keep candidate alias selection stable and compatible with expected tag formats.
 """
 
 from __future__ import annotations
 
+from contextlib import redirect_stdout
+import io
+import os
 import unittest
+from unittest.mock import MagicMock, patch
 
-from ci_tools.main_publish_candidate_akmods_alias import kernel_source_tag_candidates
+from ci_tools.common import CiToolError
+from ci_tools.main_publish_candidate_akmods_alias import kernel_source_tag_candidates, main
+
+
+MODULE = "ci_tools.main_publish_candidate_akmods_alias"
+MAIN_ENV = {
+    "FEDORA_VERSION": "43",
+    "KERNEL_RELEASE": "6.18.13-200.fc43.x86_64",
+    "SOURCE_AKMODS_REPO": "akmods-src",
+    "DEST_AKMODS_REPO": "akmods-dest",
+    "REGISTRY_ACTOR": "actor",
+    "REGISTRY_TOKEN": "token",
+    "GITHUB_REPOSITORY_OWNER": "Owner",
+}
 
 
 class MainPublishCandidateAkmodsAliasTests(unittest.TestCase):
@@ -35,6 +52,77 @@ class MainPublishCandidateAkmodsAliasTests(unittest.TestCase):
         )
         self.assertEqual(candidates, ["main-43-6.18.13-200.fc43.custom"])
 
+    def test_filters_candidates_by_tag_list(self) -> None:
+        candidates = kernel_source_tag_candidates(
+            fedora_version="43",
+            kernel_release="6.18.13-200.fc43.x86_64",
+            available_tags=["main-43", "main-43-6.18.13-200.fc43"],
+        )
+        self.assertEqual(candidates, ["main-43-6.18.13-200.fc43"])
+
+
+class MainPublishCandidateAkmodsAliasMainTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.skopeo_list_tags = MagicMock()
+        self.skopeo_exists = MagicMock(return_value=True)
+        self.skopeo_copy = MagicMock()
+
+    def run_main(self, **env: str) -> None:
+        with (
+            patch.dict(os.environ, {**MAIN_ENV, **env}, clear=True),
+            patch(f"{MODULE}.skopeo_list_tags", self.skopeo_list_tags),
+            patch(f"{MODULE}.skopeo_exists", self.skopeo_exists),
+            patch(f"{MODULE}.skopeo_copy", self.skopeo_copy),
+            redirect_stdout(io.StringIO()),
+        ):
+            main()
+
+    def test_main_probes_kernel_tags_before_copying(self) -> None:
+        self.skopeo_exists.side_effect = [False, True]
+
+        self.run_main()
+
+        self.assertEqual(self.skopeo_exists.call_count, 2)
+        # One copy for the Fedora-wide tag, one for the no-arch kernel tag only.
+        self.assertEqual(self.skopeo_copy.call_count, 2)
+        self.assertEqual(
+            self.skopeo_copy.call_args_list[1].args,
+            (
+                "docker://ghcr.io/owner/akmods-src:main-43-6.18.13-200.fc43",
+                "docker://ghcr.io/owner/akmods-dest:main-43-6.18.13-200.fc43.x86_64",
+            ),
+        )
+
+    def test_main_uses_tag_list_instead_of_probes(self) -> None:
+        self.skopeo_list_tags.return_value = ["main-43", "main-43-6.18.13-200.fc43.x86_64"]
+
+        self.run_main(TAG_LOOKUP_MODE="list")
+
+        self.skopeo_list_tags.assert_called_once_with("docker://ghcr.io/owner/akmods-src", creds="actor:token")
+        self.skopeo_exists.assert_not_called()
+        self.assertEqual(
+            self.skopeo_copy.call_args_list[1].args[0],
+            "docker://ghcr.io/owner/akmods-src:main-43-6.18.13-200.fc43.x86_64",
+        )
+
+    def test_main_treats_unlisted_kernel_tags_as_absent(self) -> None:
+        self.skopeo_list_tags.return_value = ["main-43"]
+
+        with self.assertRaises(CiToolError):
+            self.run_main(TAG_LOOKUP_MODE="list")
+
+        self.skopeo_exists.assert_not_called()
+
+    def test_main_probes_when_the_tag_list_cannot_be_fetched(self) -> None:
+        self.skopeo_list_tags.side_effect = CiToolError("denied")
+
+        self.run_main(TAG_LOOKUP_MODE="list")
+
+        self.skopeo_exists.assert_called_once_with(
+            "docker://ghcr.io/owner/akmods-src:main-43-6.18.13-200.fc43.x86_64",
+            creds="actor:token",
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,17 +1,48 @@
 """
 Script: tests/test_main_resolve_build_inputs.py
 What: Tests for main input-resolution tag selection.
-Doing: Checks immutable-tag reuse, candidate-tag derivation, and failure paths.
+Doing: Checks immutable-tag reuse, candidate-tag derivation, layer-based kernel detection, and failure paths.
 Why: Protects the logic that pins run inputs and avoids moving-tag drift.
 Goal: Keep main input resolution predictable and explainable.
 """
 
 from __future__ import annotations
 
+import gzip
+import io
+import os
+import tarfile
+from contextlib import redirect_stdout
 import unittest
+from unittest.mock import patch
 
-from ci_tools.common import CiToolError, sort_kernel_releases
-from ci_tools.main_resolve_build_inputs import choose_base_image_tag
+from ci_tools.common import CiToolError, ImageNotFoundError, sort_kernel_releases
+from ci_tools.main_resolve_build_inputs import (
+    choose_base_image_tag,
+    resolve_build_inputs,
+    detect_base_image_kernel_releases,
+    detect_kernel_releases_from_layers,
+    kernel_releases_from_layer_entries,
+)
+from ci_tools.registry_client import RegistryClient
+from fake_registry import FakeRegistry
+
+
+def _layer_tarball(entries: list[tuple[str, bool]]) -> bytes:
+    """Build one gzip layer from `(path, is_dir)` entries with tiny file bodies."""
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as layer_tar:
+        for path, is_dir in entries:
+            info = tarfile.TarInfo(path)
+            if is_dir:
+                info.type = tarfile.DIRTYPE
+                layer_tar.addfile(info)
+            else:
+                data = b"x" * 8
+                info.size = len(data)
+                layer_tar.addfile(info, io.BytesIO(data))
+    return gzip.compress(buffer.getvalue(), mtime=0)
 
 
 class ChooseBaseImageTagTests(unittest.TestCase):
@@ -46,6 +77,45 @@ class ChooseBaseImageTagTests(unittest.TestCase):
             ["latest-20260227.1", "43-20260227.1"],
         )
 
+    def test_tag_list_mode_only_resolves_listed_candidates(self) -> None:
+        looked_up: list[str] = []
+
+        def digest_lookup(tag: str) -> str:
+            looked_up.append(tag)
+            return "sha256:match" if tag == "stable-20260227.1" else "sha256:other"
+
+        tag, checked = choose_base_image_tag(
+            source_tag="latest",
+            version_label="43.20260227.1",
+            fedora_version="43",
+            expected_digest="sha256:match",
+            digest_lookup=digest_lookup,
+            available_tags=["latest", "latest-20260226", "stable-20260227.1", "43-20260227.1"],
+        )
+
+        self.assertEqual(tag, "stable-20260227.1")
+        # `latest-20260227.1` is not listed, so it is never probed.
+        self.assertEqual(looked_up, ["43-20260227.1", "stable-20260227.1"])
+        self.assertEqual(checked, ["43-20260227.1", "stable-20260227.1"])
+
+    def test_tag_list_mode_treats_unlisted_candidates_as_absent(self) -> None:
+        looked_up: list[str] = []
+
+        def digest_lookup(tag: str) -> str:
+            looked_up.append(tag)
+            return "sha256:match"
+
+        with self.assertRaises(CiToolError):
+            choose_base_image_tag(
+                source_tag="latest",
+                version_label="43.20260227.1",
+                fedora_version="43",
+                expected_digest="sha256:match",
+                digest_lookup=digest_lookup,
+                available_tags=[],
+            )
+        self.assertEqual(looked_up, [])
+
     def test_rejects_unexpected_version_label(self) -> None:
         with self.assertRaises(CiToolError):
             choose_base_image_tag(
@@ -57,6 +127,225 @@ class ChooseBaseImageTagTests(unittest.TestCase):
             )
 
 
+class KernelReleasesFromLayerEntriesTests(unittest.TestCase):
+    def test_merges_kernels_from_several_layers(self) -> None:
+        releases, scanned = kernel_releases_from_layer_entries(
+            [
+                [("usr/lib/modules/6.18.16-200.fc43.x86_64/vmlinuz", False)],
+                [("./usr/lib/modules/6.18.13-200.fc43.x86_64/", True)],
+                [("usr/bin/bash", False)],
+            ]
+        )
+        self.assertEqual(releases, ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"])
+        self.assertEqual(scanned, 3)
+
+    def test_whiteout_in_upper_layer_removes_lower_kernel(self) -> None:
+        releases, _scanned = kernel_releases_from_layer_entries(
+            [
+                [("usr/lib/modules/.wh.6.18.13-200.fc43.x86_64", False)],
+                [
+                    ("usr/lib/modules/6.18.13-200.fc43.x86_64", True),
+                    ("usr/lib/modules/6.18.16-200.fc43.x86_64", True),
+                ],
+            ]
+        )
+        self.assertEqual(releases, ["6.18.16-200.fc43.x86_64"])
+
+    def test_entries_in_the_same_layer_survive_its_own_whiteout(self) -> None:
+        releases, _scanned = kernel_releases_from_layer_entries(
+            [
+                [
+                    ("usr/lib/modules/.wh.6.18.13-200.fc43.x86_64", False),
+                    ("usr/lib/modules/6.18.13-200.fc43.x86_64/modules.dep", False),
+                ],
+            ]
+        )
+        self.assertEqual(releases, ["6.18.13-200.fc43.x86_64"])
+
+    def test_opaque_modules_dir_stops_the_scan(self) -> None:
+        def layers():
+            yield [
+                ("usr/lib/modules/.wh..wh..opq", False),
+                ("usr/lib/modules/6.18.16-200.fc43.x86_64", True),
+            ]
+            raise AssertionError("lower layers must not be read")
+
+        releases, scanned = kernel_releases_from_layer_entries(layers())
+        self.assertEqual(releases, ["6.18.16-200.fc43.x86_64"])
+        self.assertEqual(scanned, 1)
+
+    def test_plain_files_are_not_kernel_directories(self) -> None:
+        releases, _scanned = kernel_releases_from_layer_entries(
+            [[("usr/lib/modules/README", False), ("lib/modules/6.18.16-200.fc43.x86_64/x", False)]]
+        )
+        self.assertEqual(releases, ["6.18.16-200.fc43.x86_64"])
+
+
+class DetectBaseImageKernelReleasesTests(unittest.TestCase):
+    def test_podman_remains_the_default_mode(self) -> None:
+        with (
+            patch.dict(os.environ, {}, clear=True),
+            patch(
+                "ci_tools.main_resolve_build_inputs.run_cmd",
+                return_value="6.18.16-200.fc43.x86_64\n6.18.13-200.fc43.x86_64\n",
+            ) as run_cmd,
+        ):
+            releases = detect_base_image_kernel_releases("ghcr.io/example/base@sha256:abc")
+
+        self.assertEqual(releases, ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"])
+        self.assertEqual(run_cmd.call_args.args[0][:2], ["podman", "run"])
+
+    def test_layers_mode_streams_registry_layers(self) -> None:
+        with FakeRegistry() as registry:
+            digest = registry.add_image(
+                "example/base",
+                "latest",
+                layers=[
+                    _layer_tarball([("usr/lib/modules/6.18.13-200.fc43.x86_64", True)]),
+                    _layer_tarball([("usr/lib/modules/6.18.16-200.fc43.x86_64/vmlinuz", False)]),
+                    _layer_tarball([("usr/lib/modules/.wh.6.18.13-200.fc43.x86_64", False)]),
+                ],
+            )
+            client = RegistryClient(timeout=5)
+            try:
+                with patch.dict(os.environ, {"BASE_KERNEL_DETECTION": "layers"}):
+                    with patch(
+                        "ci_tools.main_resolve_build_inputs.registry_client",
+                        return_value=client,
+                    ):
+                        with patch("ci_tools.main_resolve_build_inputs.run_cmd") as run_cmd:
+                            releases = detect_base_image_kernel_releases(
+                                f"{registry.host}/example/base@{digest}"
+                            )
+            finally:
+                client.close()
+
+        self.assertEqual(releases, ["6.18.16-200.fc43.x86_64"])
+        run_cmd.assert_not_called()
+        # Every streamed layer reused the pooled connection.
+        self.assertEqual(client.connections_opened, 1)
+
+    def test_layers_mode_falls_back_to_podman_when_the_registry_refuses(self) -> None:
+        with FakeRegistry() as registry:
+            registry.add_image("example/base", "latest", layers=[])
+            registry.fail_paths["/v2/example/base/manifests/latest"] = 100
+            client = RegistryClient(timeout=5)
+            try:
+                with (
+                    patch.dict(os.environ, {"BASE_KERNEL_DETECTION": "layers"}),
+                    patch("ci_tools.main_resolve_build_inputs.registry_client", return_value=client),
+                    patch(
+                        "ci_tools.main_resolve_build_inputs.run_cmd",
+                        return_value="6.18.16-200.fc43.x86_64\n",
+                    ) as run_cmd,
+                    redirect_stdout(io.StringIO()),
+                ):
+                    releases = detect_base_image_kernel_releases(f"{registry.host}/example/base:latest")
+            finally:
+                client.close()
+
+        self.assertEqual(releases, ["6.18.16-200.fc43.x86_64"])
+        self.assertEqual(run_cmd.call_args.args[0][:2], ["podman", "run"])
+
+    def test_layers_mode_stops_below_an_opaque_modules_dir(self) -> None:
+        with FakeRegistry() as registry:
+            registry.add_image(
+                "example/base",
+                "latest",
+                layers=[
+                    _layer_tarball([("usr/lib/modules/6.17.1-200.fc43.x86_64", True)]),
+                    _layer_tarball(
+                        [
+                            ("usr/lib/modules/.wh..wh..opq", False),
+                            ("usr/lib/modules/6.18.16-200.fc43.x86_64", True),
+                        ]
+                    ),
+                ],
+            )
+            client = RegistryClient(timeout=5)
+            try:
+                releases = detect_kernel_releases_from_layers(
+                    f"docker://{registry.host}/example/base:latest",
+                    client=client,
+                )
+            finally:
+                client.close()
+            layer_requests = registry.count("GET", "/blobs/")
+
+        self.assertEqual(releases, ["6.18.16-200.fc43.x86_64"])
+        self.assertEqual(layer_requests, 1)
+
+
+class ResolveBuildInputsTests(unittest.TestCase):
+    ENV = {
+        "LOCK_FILE": "ci/inputs.lock.json",
+        "BUILD_CONTAINER_REF": "ghcr.io/example/builder:latest",
+        "DEFAULT_BASE_IMAGE": "ghcr.io/example/kinoite:latest",
+        "DEFAULT_ZFS_MINOR_VERSION": "2.4",
+        "DEFAULT_AKMODS_REF": "abc123",
+    }
+
+    def _inspect(self, image_ref: str, **_kwargs: object) -> dict:
+        if "builder" in image_ref:
+            return {"Name": "ghcr.io/example/builder", "Digest": "sha256:builder"}
+        return {
+            "Name": "ghcr.io/example/kinoite",
+            "Digest": "sha256:base",
+            "Labels": {
+                "ostree.linux": self.label_kernel,
+                "org.opencontainers.image.version": "43.20260227.1",
+            },
+        }
+
+    def _resolve(self, detected_kernels: list[str], digests: dict[str, str]):
+        probed: list[str] = []
+
+        def digest_lookup(image_ref: str, **_kwargs: object) -> str:
+            tag = image_ref.rsplit(":", 1)[1]
+            probed.append(tag)
+            if tag not in digests:
+                raise ImageNotFoundError(image_ref)
+            return digests[tag]
+
+        with (
+            patch.dict(os.environ, self.ENV, clear=True),
+            patch("ci_tools.main_resolve_build_inputs.skopeo_inspect_json", side_effect=self._inspect),
+            patch("ci_tools.main_resolve_build_inputs.skopeo_inspect_digest", side_effect=digest_lookup),
+            patch(
+                "ci_tools.main_resolve_build_inputs.detect_base_image_kernel_releases",
+                return_value=detected_kernels,
+            ),
+            redirect_stdout(io.StringIO()) as output,
+        ):
+            resolution = resolve_build_inputs()
+        return resolution, probed, output.getvalue()
+
+    def test_runs_independent_lookups_together(self) -> None:
+        self.label_kernel = "6.18.16-200.fc43.x86_64"
+        resolution, probed, output = self._resolve(
+            ["6.18.13-200.fc43.x86_64", "6.18.16-200.fc43.x86_64"],
+            {"latest-20260227.1": "sha256:base"},
+        )
+
+        inputs = resolution.inputs
+        self.assertEqual(inputs.version, "43")
+        self.assertEqual(inputs.base_image_tag, "latest-20260227.1")
+        self.assertEqual(inputs.build_container_pinned, "ghcr.io/example/builder@sha256:builder")
+        self.assertEqual(probed, ["latest-20260227.1", "latest-20260227.1"])
+        self.assertIn("Lookup timings: base-kernels=", output)
+
+    def test_redoes_tag_selection_when_label_fedora_version_disagrees(self) -> None:
+        self.label_kernel = "6.18.16-200.fc42.x86_64"
+        resolution, probed, _output = self._resolve(
+            ["6.18.16-200.fc43.x86_64"],
+            {"43-20260227.1": "sha256:base"},
+        )
+
+        self.assertEqual(resolution.inputs.base_image_tag, "43-20260227.1")
+        self.assertIn("42-20260227.1", probed)
+        self.assertEqual(probed[-1], "43-20260227.1")
+
+
 class SortKernelReleasesTests(unittest.TestCase):
     def test_sorts_kernel_releases_naturally(self) -> None:
         releases = sort_kernel_releases(
@@ -0,0 +1,175 @@
+"""
+Script: tests/test_oci_assembly.py
+What: Tests for `ci_tools/oci_assembly.py`.
+Doing: Writes reproducible layers and image layouts twice and compares digests, then assembles an image in the in-process registry stand-in from another repository's layers.
+Why: A merged image must list exactly the source layers and their diff IDs, and must not re-upload layer bytes.
+Goal: Keep layer reuse and reproducible layer output stable.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+import unittest
+
+from ci_tools.common import load_layer_files_from_oci_layout
+from ci_tools.oci_assembly import (
+    OCI_LAYER_GZIP_MEDIA_TYPE,
+    image_config,
+    push_assembled_image,
+    read_image_layers,
+    retag_image,
+    write_reproducible_image_layout,
+    write_reproducible_layer,
+)
+from ci_tools.registry_client import RegistryClient, RegistryError
+from fake_registry import FakeRegistry, digest_of
+
+
+class ReproducibleLayerTests(unittest.TestCase):
+    def write_tree(self, root: Path, mtime: int) -> None:
+        (root / "rpms" / "kmods").mkdir(parents=True)
+        (root / "rpms" / "kmods" / "b.json").write_text("{}\n", encoding="utf-8")
+        (root / "rpms" / "kmods" / "a.rpm").write_bytes(b"rpm")
+        for path in root.rglob("*"):
+            os.utime(path, (mtime, mtime))
+
+    def test_same_files_give_same_digests_regardless_of_mtime(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            base = Path(tempdir)
+            self.write_tree(base / "one", 1_700_000_000)
+            self.write_tree(base / "two", 1_800_000_000)
+
+            first = write_reproducible_layer(base / "one", base / "one.tar.gz")
+            second = write_reproducible_layer(base / "two", base / "two.tar.gz")
+
+            self.assertEqual(first, second)
+            layer_bytes = (base / "one.tar.gz").read_bytes()
+            self.assertEqual(first[0], digest_of(layer_bytes))
+            self.assertEqual(first[1], "sha256:" + hashlib.sha256(gzip.decompress(layer_bytes)).hexdigest())
+            with tarfile.open(base / "one.tar.gz") as layer_tar:
+                members = layer_tar.getmembers()
+            self.assertEqual(
+                [member.name for member in members],
+                ["rpms", "rpms/kmods", "rpms/kmods/a.rpm", "rpms/kmods/b.json"],
+            )
+            self.assertEqual({(member.mtime, member.uid, member.gid) for member in members}, {(0, 0, 0)})
+
+    def test_layout_digest_is_stable_and_layers_follow_include_paths(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            base = Path(tempdir)
+            self.write_tree(base / "one", 1_700_000_000)
+            (base / "one" / "kernel-rpms").mkdir()
+            self.write_tree(base / "two", 1_800_000_000)
+            (base / "two" / "kernel-rpms").mkdir()
+
+            manifests = [
+                write_reproducible_image_layout(
+                    base / f"{name}-layout",
+                    source_root=base / name,
+                    layer_paths=[("kernel-rpms",), ("rpms",)],
+                    labels={"label": "value"},
+                    architecture="amd64",
+                )
+                for name in ("one", "two")
+            ]
+
+            self.assertEqual(manifests[0], manifests[1])
+            layout = base / "one-layout"
+            self.assertEqual((layout / "manifest.json").read_bytes(), manifests[0])
+            layer_files = load_layer_files_from_oci_layout(layout)
+            with tarfile.open(layer_files[0]) as layer_tar:
+                self.assertEqual(layer_tar.getnames(), ["kernel-rpms"])
+            with tarfile.open(layer_files[1]) as layer_tar:
+                self.assertEqual(layer_tar.getnames()[0], "rpms")
+            config_digest = json.loads(manifests[0])["config"]["digest"]
+            config = json.loads((layout / config_digest.removeprefix("sha256:")).read_bytes())
+            self.assertEqual(config["config"]["Labels"], {"label": "value"})
+
+    def test_config_has_no_creation_time(self) -> None:
+        config = json.loads(image_config(labels={"b": "2", "a": "1"}, diff_ids=["sha256:x"], architecture="amd64"))
+
+        self.assertNotIn("created", config)
+        self.assertEqual(config["config"]["Labels"], {"a": "1", "b": "2"})
+        self.assertEqual(config["rootfs"], {"type": "layers", "diff_ids": ["sha256:x"]})
+
+
+class AssembleImageTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = FakeRegistry(require_auth=True).__enter__()
+        self.client = RegistryClient(timeout=5)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.registry.__exit__(None, None, None)
+
+    def ref(self, repository: str, tag: str) -> str:
+        return f"docker://{self.registry.host}/{repository}:{tag}"
+
+    def test_read_image_layers_pairs_descriptors_with_diff_ids(self) -> None:
+        self.registry.add_image("example/kernel", "k1", layers=[b"one", b"two"], diff_ids=["sha256:d1", "sha256:d2"])
+
+        layers, config = read_image_layers(self.ref("example/kernel", "k1"), client=self.client)
+
+        self.assertEqual([layer.digest for layer in layers], [digest_of(b"one"), digest_of(b"two")])
+        self.assertEqual([layer.diff_id for layer in layers], ["sha256:d1", "sha256:d2"])
+        self.assertEqual({layer.media_type for layer in layers}, {OCI_LAYER_GZIP_MEDIA_TYPE})
+        self.assertEqual(config["architecture"], "amd64")
+
+    def test_push_mounts_foreign_layers_and_uploads_only_config_and_manifest(self) -> None:
+        self.registry.add_image("example/kernel", "k1", layers=[b"kernel-layer"])
+        layers, _config = read_image_layers(self.ref("example/kernel", "k1"), client=self.client)
+        config = image_config(labels={"label": "value"}, diff_ids=[layer.diff_id for layer in layers])
+
+        manifest = push_assembled_image(
+            self.ref("example/shared", "main"),
+            tags=["main-x86_64", "main"],
+            layers=layers,
+            config=config,
+            client=self.client,
+        )
+
+        shared = self.registry.repository("example/shared")
+        self.assertEqual(shared.tags["main"], digest_of(manifest))
+        self.assertEqual(shared.tags["main-x86_64"], digest_of(manifest))
+        self.assertEqual(shared.blobs[digest_of(b"kernel-layer")], b"kernel-layer")
+        self.assertEqual(json.loads(manifest)["layers"], [layers[0].descriptor()])
+        # One upload PUT (the config); the layer arrived through a mount.
+        self.assertEqual(self.registry.count("PUT", "/blobs/uploads/"), 1)
+
+    def test_push_fails_when_a_layer_cannot_be_mounted(self) -> None:
+        self.registry.add_image("example/kernel", "k1", layers=[b"kernel-layer"])
+        layers, _config = read_image_layers(self.ref("example/kernel", "k1"), client=self.client)
+        del self.registry.repository("example/kernel").blobs[layers[0].digest]
+
+        with self.assertRaises(RegistryError):
+            push_assembled_image(
+                self.ref("example/shared", "main"),
+                tags=["main"],
+                layers=layers,
+                config=image_config(labels={}, diff_ids=[layers[0].diff_id]),
+                client=self.client,
+            )
+        self.assertNotIn("main", self.registry.repository("example/shared").tags)
+
+    def test_retag_image_uploads_only_manifests(self) -> None:
+        digest = self.registry.add_image("example/shared", "main-x86_64", layers=[b"cache-layer"])
+
+        sent = retag_image(self.ref("example/shared", "main-x86_64"), ["main", "main-copy"], client=self.client)
+
+        shared = self.registry.repository("example/shared")
+        self.assertEqual(shared.tags["main"], digest)
+        self.assertEqual(shared.tags["main-copy"], digest)
+        self.assertEqual(self.registry.count("POST", "/blobs/uploads/"), 0)
+        self.assertEqual(self.registry.count("PUT", "/blobs/uploads/"), 0)
+        self.assertEqual(self.registry.count("GET", "/blobs/"), 0)
+        self.assertGreater(sent, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
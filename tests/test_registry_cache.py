@@ -0,0 +1,257 @@
+"""
+Script: tests/test_registry_cache.py
+What: Tests for the shared registry metadata cache.
+Doing: Exercises TTL rules, digest-pinned permanence, invalidation, and the `skopeo_*` integration with a fake clock.
+Why: A stale tag answer would pin the wrong image, so the expiry rules must stay strict.
+Goal: Keep cached registry lookups fast without ever hiding a moved tag.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+from pathlib import Path
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from ci_tools import common
+from ci_tools.registry_cache import (
+    RegistryMetadataCache,
+    registry_metadata_cache,
+    report_registry_cache_stats,
+    set_registry_metadata_cache,
+)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class RegistryMetadataCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self._temp_dir.name)
+        self.clock = FakeClock()
+        self.cache = RegistryMetadataCache(self.root, tag_ttl_seconds=60, clock=self.clock)
+
+    def tearDown(self) -> None:
+        set_registry_metadata_cache(None)
+        self._temp_dir.cleanup()
+
+    def test_tag_entries_expire_after_ttl(self) -> None:
+        self.cache.put("inspect", "docker://ghcr.io/example/image:latest", {"Digest": "sha256:a"})
+
+        self.clock.now += 59
+        self.assertEqual(
+            self.cache.get("inspect", "ghcr.io/example/image:latest"),
+            {"Digest": "sha256:a"},
+        )
+        self.clock.now += 2
+        self.assertIsNone(self.cache.get("inspect", "docker://ghcr.io/example/image:latest"))
+
+    def test_digest_pinned_entries_never_expire(self) -> None:
+        ref = "docker://ghcr.io/example/image@sha256:abc"
+        self.cache.put("inspect", ref, {"Digest": "sha256:abc"})
+
+        self.clock.now += 10**9
+        self.assertEqual(self.cache.get("inspect", ref), {"Digest": "sha256:abc"})
+
+    def test_zero_ttl_disables_tag_caching_but_keeps_digest_refs(self) -> None:
+        cache = RegistryMetadataCache(self.root, tag_ttl_seconds=0, clock=self.clock)
+        cache.put("inspect", "docker://ghcr.io/example/image:latest", {"Digest": "sha256:a"})
+        cache.put("inspect", "docker://ghcr.io/example/image@sha256:a", {"Digest": "sha256:a"})
+
+        self.assertIsNone(cache.get("inspect", "docker://ghcr.io/example/image:latest"))
+        self.assertIsNotNone(cache.get("inspect", "docker://ghcr.io/example/image@sha256:a"))
+
+    def test_lookup_counts_hits_and_misses(self) -> None:
+        calls: list[str] = []
+
+        def loader() -> dict:
+            calls.append("called")
+            return {"Digest": "sha256:a"}
+
+        ref = "docker://ghcr.io/example/image:latest"
+        self.cache.lookup("inspect", ref, loader)
+        self.cache.lookup("inspect", ref, loader)
+
+        self.assertEqual(calls, ["called"])
+        self.assertEqual((self.cache.stats.hits, self.cache.stats.misses), (1, 1))
+
+    def test_invalidate_drops_every_kind_for_one_ref(self) -> None:
+        ref = "docker://ghcr.io/example/image:latest"
+        self.cache.put("inspect", ref, {"Digest": "sha256:a"})
+        self.cache.put("digest", ref, "sha256:a")
+
+        self.cache.invalidate(ref)
+
+        self.assertIsNone(self.cache.get("inspect", ref))
+        self.assertIsNone(self.cache.get("digest", ref))
+
+    def test_corrupt_entry_is_treated_as_miss(self) -> None:
+        ref = "docker://ghcr.io/example/image:latest"
+        self.cache.put("inspect", ref, {"Digest": "sha256:a"})
+        for entry in self.root.glob("*.json"):
+            entry.write_text("{not json", encoding="utf-8")
+
+        self.assertIsNone(self.cache.get("inspect", ref))
+
+    def test_env_can_disable_cache(self) -> None:
+        set_registry_metadata_cache(None)
+        with patch.dict(os.environ, {"REGISTRY_CACHE_ENABLED": "false"}, clear=False):
+            self.assertFalse(registry_metadata_cache().enabled)
+
+    def test_tags_are_not_cached_by_default(self) -> None:
+        set_registry_metadata_cache(None)
+        env = {key: value for key, value in os.environ.items() if key != "REGISTRY_CACHE_TAG_TTL_SECONDS"}
+        env["REGISTRY_CACHE_DIR"] = str(self.root / "default")
+        with patch.dict(os.environ, env, clear=True):
+            cache = registry_metadata_cache()
+
+        self.assertEqual(cache.tag_ttl_seconds, 0)
+        tag_ref = "docker://ghcr.io/example/image:latest"
+        pinned_ref = "docker://ghcr.io/example/image@sha256:" + "a" * 64
+        cache.put("digest", tag_ref, "sha256:a")
+        cache.put("digest", pinned_ref, "sha256:a")
+        self.assertIsNone(cache.get("digest", tag_ref))
+        self.assertEqual(cache.get("digest", pinned_ref), "sha256:a")
+
+    def test_env_configures_dir_and_ttl(self) -> None:
+        set_registry_metadata_cache(None)
+        with patch.dict(
+            os.environ,
+            {
+                "REGISTRY_CACHE_DIR": str(self.root / "configured"),
+                "REGISTRY_CACHE_TAG_TTL_SECONDS": "15",
+            },
+            clear=False,
+        ):
+            cache = registry_metadata_cache()
+
+        self.assertEqual(cache.root, self.root / "configured")
+        self.assertEqual(cache.tag_ttl_seconds, 15)
+
+    def test_report_prints_counters_only_after_use(self) -> None:
+        set_registry_metadata_cache(self.cache)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            report_registry_cache_stats()
+        self.assertEqual(output.getvalue(), "")
+
+        self.cache.lookup("inspect", "docker://ghcr.io/example/image:latest", lambda: {"Digest": "x"})
+        with redirect_stdout(output):
+            report_registry_cache_stats()
+        self.assertIn("Registry metadata cache: 0 hits, 1 misses", output.getvalue())
+
+
+class SkopeoCacheIntegrationTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        set_registry_metadata_cache(
+            RegistryMetadataCache(Path(self._temp_dir.name), tag_ttl_seconds=60)
+        )
+
+    def tearDown(self) -> None:
+        set_registry_metadata_cache(None)
+        self._temp_dir.cleanup()
+
+    def test_repeated_inspect_and_digest_calls_share_one_registry_lookup(self) -> None:
+        with patch.object(
+            common,
+            "run_json_cmd",
+            return_value={"Name": "ghcr.io/example/image", "Digest": "sha256:abc"},
+        ) as run_json_cmd:
+            ref = "docker://ghcr.io/example/image:latest"
+            common.skopeo_inspect_json(ref)
+            self.assertEqual(common.skopeo_inspect_digest(ref), "sha256:abc")
+            self.assertTrue(common.skopeo_exists(ref))
+
+        run_json_cmd.assert_called_once()
+
+    def test_skopeo_copy_invalidates_destination_entry(self) -> None:
+        ref = "docker://ghcr.io/example/image:latest"
+        registry_metadata_cache().put("inspect", ref, {"Digest": "sha256:old"})
+
+        with patch.object(common, "run_cmd", return_value=""):
+            common.skopeo_copy("docker://ghcr.io/example/image@sha256:new", ref)
+
+        self.assertIsNone(registry_metadata_cache().get("inspect", ref))
+
+    def test_tag_lists_are_cached_and_dropped_after_a_copy(self) -> None:
+        repo = "docker://ghcr.io/example/image"
+        with patch.object(common, "run_json_cmd", return_value={"Tags": ["a", "b"]}) as run_json_cmd:
+            self.assertEqual(common.skopeo_list_tags(repo), ["a", "b"])
+            self.assertEqual(common.skopeo_list_tags(repo), ["a", "b"])
+        run_json_cmd.assert_called_once_with(["skopeo", "list-tags", repo])
+
+        with patch.object(common, "run_cmd", return_value=""):
+            common.skopeo_copy("docker://ghcr.io/example/other:x", f"{repo}:c")
+        self.assertIsNone(registry_metadata_cache().get("tags", repo))
+
+    def test_failed_lookups_are_not_cached(self) -> None:
+        ref = "docker://ghcr.io/example/image:missing"
+        with patch.object(
+            common,
+            "run_cmd_bytes",
+            side_effect=common.CiToolError(f"Command failed: skopeo inspect --raw {ref}\nmanifest unknown"),
+        ) as run_cmd:
+            self.assertFalse(common.skopeo_exists(ref))
+            self.assertFalse(common.skopeo_exists(ref))
+
+        self.assertEqual(run_cmd.call_count, 2)
+
+    def test_digest_reads_raw_manifest_only(self) -> None:
+        # CRLF line endings must be hashed as served, not as decoded text.
+        raw_manifest = b'{\r\n"schemaVersion":2,"layers":[]}\r\n'
+        expected = "sha256:" + hashlib.sha256(raw_manifest).hexdigest()
+        ref = "docker://ghcr.io/example/image:latest"
+
+        with (
+            patch.object(common, "run_cmd_bytes", return_value=raw_manifest) as run_cmd,
+            patch.object(common, "run_json_cmd") as run_json_cmd,
+        ):
+            self.assertEqual(common.skopeo_inspect_digest(ref, creds="u:p"), expected)
+            self.assertEqual(common.skopeo_inspect_digest(ref, creds="u:p"), expected)
+
+        run_cmd.assert_called_once_with(["skopeo", "inspect", "--raw", "--creds", "u:p", ref])
+        run_json_cmd.assert_not_called()
+
+    def test_auth_and_network_errors_are_not_reported_as_missing(self) -> None:
+        ref = "docker://ghcr.io/example/image:latest"
+        for details in (
+            "unauthorized: authentication required",
+            "dial tcp: lookup ghcr.io: no such host",
+            "received unexpected HTTP status: 503 Service Unavailable",
+            'exec: "skopeo": executable file not found in $PATH',
+            "credentials file not found: /run/containers/0/auth.json",
+        ):
+            with (
+                self.subTest(details=details),
+                patch.object(
+                    common,
+                    "run_cmd_bytes",
+                    side_effect=common.CiToolError(f"Command failed: skopeo inspect --raw {ref}\n{details}"),
+                ),
+            ):
+                with self.assertRaises(common.CiToolError) as raised:
+                    common.skopeo_exists(ref)
+                self.assertNotIsInstance(raised.exception, common.ImageNotFoundError)
+
+    def test_digest_in_command_line_is_not_read_as_404(self) -> None:
+        ref = "docker://ghcr.io/example/image@sha256:" + "404".ljust(64, "0")
+        error = common.CiToolError(f"Command failed: skopeo inspect --raw {ref}\nconnection reset by peer")
+        with patch.object(common, "run_cmd_bytes", side_effect=error):
+            with self.assertRaises(common.CiToolError) as raised:
+                common.skopeo_inspect_digest(ref)
+        self.assertNotIsInstance(raised.exception, common.ImageNotFoundError)
+
+
+if __name__ == "__main__":
+    unittest.main()
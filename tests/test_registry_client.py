@@ -0,0 +1,267 @@
+"""
+Script: tests/test_registry_client.py
+What: Tests for the native registry v2 client.
+Doing: Runs the client against the in-process registry stand-in and checks inspect output, token reuse, connection reuse, pagination, and the `skopeo_*` wiring.
+Why: The client replaces skopeo subprocesses, so its answers must match what callers already read from skopeo.
+Goal: Prove that one pooled client serves many lookups with one token and one connection.
+"""
+
+from __future__ import annotations
+
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+from ci_tools import common
+from ci_tools.registry_cache import RegistryMetadataCache, set_registry_metadata_cache
+from ci_tools.registry_client import (
+    RegistryClient,
+    RegistryError,
+    RegistryNotFoundError,
+    _Response,
+    parse_image_ref,
+    set_registry_client,
+)
+from fake_registry import OCI_INDEX, FakeRegistry, digest_of
+
+
+class ParseImageRefTests(unittest.TestCase):
+    def test_parses_registry_repository_and_tag(self) -> None:
+        image = parse_image_ref("docker://ghcr.io/example/kinoite:latest")
+        self.assertEqual(image.registry, "ghcr.io")
+        self.assertEqual(image.repository, "example/kinoite")
+        self.assertEqual(image.tag, "latest")
+        self.assertEqual(image.reference, "latest")
+
+    def test_parses_digest_and_port(self) -> None:
+        image = parse_image_ref("localhost:5000/team/image@sha256:abc")
+        self.assertEqual(image.registry, "localhost:5000")
+        self.assertEqual(image.repository, "team/image")
+        self.assertEqual(image.reference, "sha256:abc")
+
+    def test_docker_hub_shorthand(self) -> None:
+        image = parse_image_ref("fedora")
+        self.assertEqual(image.name, "docker.io/library/fedora")
+        self.assertEqual(image.api_host, "registry-1.docker.io")
+        self.assertEqual(image.tag, "latest")
+
+    def test_rejects_local_transports(self) -> None:
+        with self.assertRaises(common.CiToolError):
+            parse_image_ref("containers-storage:localhost/image:tag")
+        with self.assertRaises(common.CiToolError):
+            parse_image_ref("oci://tmp/layout")
+
+
+class RegistryClientTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = FakeRegistry(require_auth=True).__enter__()
+        self.client = RegistryClient(timeout=5)
+        self.digest = self.registry.add_image(
+            "example/kinoite",
+            "latest",
+            layers=[b"layer-one", b"layer-two"],
+            labels={"ostree.linux": "6.14.4-200.fc42.x86_64"},
+        )
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.registry.__exit__(None, None, None)
+
+    def ref(self, suffix: str = ":latest") -> str:
+        return f"docker://{self.registry.host}/example/kinoite{suffix}"
+
+    def test_inspect_matches_skopeo_shape(self) -> None:
+        inspect_json = self.client.inspect(self.ref())
+
+        self.assertEqual(inspect_json["Name"], f"{self.registry.host}/example/kinoite")
+        self.assertEqual(inspect_json["Digest"], self.digest)
+        self.assertEqual(inspect_json["Labels"]["ostree.linux"], "6.14.4-200.fc42.x86_64")
+        self.assertEqual(inspect_json["Architecture"], "amd64")
+        self.assertEqual(len(inspect_json["Layers"]), 2)
+        self.assertEqual(inspect_json["LayersData"][0]["Size"], len(b"layer-one"))
+
+    def test_inspect_resolves_index_to_host_platform(self) -> None:
+        child_digest = self.registry.add_image("example/multi", "", layers=[b"x"])
+        index_digest = self.registry.add_manifest(
+            "example/multi",
+            {
+                "schemaVersion": 2,
+                "mediaType": OCI_INDEX,
+                "manifests": [
+                    {
+                        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                        "digest": child_digest,
+                        "size": 1,
+                        "platform": {"os": "linux", "architecture": "amd64"},
+                    }
+                ],
+            },
+            media_type=OCI_INDEX,
+            tag="latest",
+        )
+
+        with patch("ci_tools.registry_client.current_platform", return_value=("linux", "amd64")):
+            inspect_json = self.client.inspect(f"docker://{self.registry.host}/example/multi:latest")
+
+        # skopeo reports the index digest, not the per-arch child digest.
+        self.assertEqual(inspect_json["Digest"], index_digest)
+        self.assertEqual(inspect_json["Layers"], [digest_of(b"x")])
+
+    def test_token_and_connection_are_reused_across_lookups(self) -> None:
+        for _ in range(5):
+            self.assertEqual(self.client.digest(self.ref()), self.digest)
+        self.client.inspect(self.ref())
+
+        self.assertEqual(len(self.registry.token_requests), 1)
+        self.assertEqual(self.registry.token_requests[0], "repository:example/kinoite:pull")
+        self.assertEqual(self.client.connections_opened, 1)
+        self.assertEqual(len(self.registry.connections), 1)
+
+    def test_tokens_are_scoped_per_repository(self) -> None:
+        self.registry.add_image("example/other", "latest")
+
+        self.client.digest(self.ref())
+        self.client.digest(f"docker://{self.registry.host}/example/other:latest")
+        self.client.digest(self.ref())
+
+        self.assertEqual(
+            self.registry.token_requests,
+            ["repository:example/kinoite:pull", "repository:example/other:pull"],
+        )
+
+    def test_mount_blob_reuses_blobs_from_another_repository(self) -> None:
+        target = parse_image_ref(f"docker://{self.registry.host}/example/shared:latest")
+        layer_digest = digest_of(b"layer-one")
+
+        mounted = self.client.mount_blob(target, layer_digest, from_repository="example/kinoite")
+        missing = self.client.mount_blob(target, digest_of(b"absent"), from_repository="example/kinoite")
+
+        self.assertTrue(mounted)
+        self.assertFalse(missing)
+        self.assertEqual(self.registry.repository("example/shared").blobs[layer_digest], b"layer-one")
+        self.assertIn(
+            "repository:example/shared:pull,push repository:example/kinoite:pull",
+            self.registry.token_requests,
+        )
+        self.assertEqual(self.registry.count("PUT", "/blobs/uploads/"), 0)
+
+    def test_digest_uses_head_without_fetching_bodies(self) -> None:
+        self.assertEqual(self.client.digest(self.ref()), self.digest)
+
+        # One unauthenticated HEAD draws the token challenge, one HEAD succeeds.
+        self.assertEqual(self.registry.count("HEAD", "/manifests/"), 2)
+        self.assertEqual(self.registry.count("GET", "/manifests/"), 0)
+        self.assertEqual(self.registry.count("GET", "/blobs/"), 0)
+
+    def test_exists_is_false_only_for_missing_tags(self) -> None:
+        self.assertTrue(self.client.exists(self.ref()))
+        self.assertFalse(self.client.exists(self.ref(":missing")))
+        with self.assertRaises(RegistryNotFoundError):
+            self.client.get_manifest(self.ref(":missing"))
+        # Missing images are also the generic "not found" type common.py callers catch.
+        with self.assertRaises(common.ImageNotFoundError):
+            self.client.digest(self.ref(":missing"))
+
+    def test_server_errors_are_not_reported_as_missing(self) -> None:
+        self.registry.fail_paths["/v2/example/kinoite/manifests/latest"] = 2
+        with self.assertRaises(RegistryError) as raised:
+            self.client.exists(self.ref())
+        self.assertEqual(raised.exception.status, 503)
+
+    def test_pinned_digest_is_verified(self) -> None:
+        manifest = self.client.get_manifest(self.ref(f"@{self.digest}"))
+        self.assertEqual(manifest.digest, self.digest)
+
+    def test_list_tags_follows_pagination(self) -> None:
+        for index in range(7):
+            self.registry.add_image("example/kinoite", f"tag-{index}")
+        self.registry.tag_page_size = 3
+
+        tags = self.client.list_tags(self.ref())
+
+        self.assertEqual(len(tags), 8)
+        self.assertIn("latest", tags)
+        self.assertEqual(self.registry.count("GET", "/tags/list"), 3 + 1)
+
+
+class RegistryClientRequestTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = RegistryClient(timeout=5)
+        self.image = parse_image_ref("registry.example/example/kinoite:latest")
+
+    def tearDown(self) -> None:
+        self.client.close()
+
+    def redirect_then_ok(self, status: int) -> list[_Response]:
+        return [
+            _Response(status=status, headers={"location": "https://cdn.example/upload"}, body=b""),
+            _Response(status=201, headers={}, body=b""),
+        ]
+
+    def test_307_and_308_keep_method_and_body(self) -> None:
+        for status in (307, 308):
+            with self.subTest(status=status):
+                with patch.object(self.client, "_send", side_effect=self.redirect_then_ok(status)) as send:
+                    self.client.request("PUT", self.image, "/v2/example/kinoite/manifests/latest", body=b"{}")
+                self.assertEqual(send.call_args.args[0], "PUT")
+                self.assertEqual(send.call_args.args[3], b"{}")
+
+    def test_other_redirects_continue_as_get(self) -> None:
+        for status in (301, 302, 303):
+            with self.subTest(status=status):
+                with patch.object(self.client, "_send", side_effect=self.redirect_then_ok(status)) as send:
+                    self.client.request("POST", self.image, "/v2/example/kinoite/blobs/uploads/", body=b"data")
+                self.assertEqual(send.call_args.args[0], "GET")
+                self.assertIsNone(send.call_args.args[3])
+
+    def test_dropped_connections_are_retried_only_for_reads(self) -> None:
+        for method, attempts in (("GET", 2), ("HEAD", 2), ("PUT", 1), ("POST", 1)):
+            with self.subTest(method=method):
+                connection = MagicMock()
+                connection.request.side_effect = ConnectionResetError("reset")
+                with patch.object(self.client, "_checkout", return_value=connection):
+                    with self.assertRaises(RegistryError):
+                        self.client._send(method, "https://registry.example/v2/", {})
+                self.assertEqual(connection.request.call_count, attempts)
+
+
+class SkopeoHelpersNativeModeTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = FakeRegistry().__enter__()
+        self.client = RegistryClient(timeout=5)
+        self.digest = self.registry.add_image("example/akmods", "main-42", labels={"a": "b"})
+        set_registry_client(self.client)
+        set_registry_metadata_cache(RegistryMetadataCache(None))
+
+    def tearDown(self) -> None:
+        set_registry_client(None)
+        set_registry_metadata_cache(None)
+        self.client.close()
+        self.registry.__exit__(None, None, None)
+
+    def test_native_mode_skips_skopeo(self) -> None:
+        ref = f"docker://{self.registry.host}/example/akmods:main-42"
+        with (
+            patch.dict(os.environ, {"REGISTRY_CLIENT": "native"}),
+            patch.object(common, "run_json_cmd") as run_json_cmd,
+        ):
+            self.assertEqual(common.skopeo_inspect_digest(ref), self.digest)
+            self.assertTrue(common.skopeo_exists(ref))
+            self.assertFalse(common.skopeo_exists(ref.replace("main-42", "main-43")))
+
+        run_json_cmd.assert_not_called()
+
+    def test_skopeo_remains_default(self) -> None:
+        ref = f"docker://{self.registry.host}/example/akmods:main-42"
+        with (
+            patch.dict(os.environ, {"REGISTRY_CLIENT": ""}),
+            patch.object(common, "run_json_cmd", return_value={"Digest": "sha256:from-skopeo"}) as run_json_cmd,
+        ):
+            self.assertEqual(common.skopeo_inspect_json(ref)["Digest"], "sha256:from-skopeo")
+
+        run_json_cmd.assert_called_once_with(["skopeo", "inspect", ref])
+        self.assertEqual(self.registry.requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
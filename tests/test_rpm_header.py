@@ -0,0 +1,85 @@
+"""
+Script: tests/test_rpm_header.py
+What: Tests for the in-process RPM header reader.
+Doing: Parses synthetic RPMs from disk and from forward-only streams and checks field decoding and error handling.
+Why: kmod planning trusts these fields instead of `rpm -qp`, so decoding mistakes would pick the wrong kernel payloads.
+Goal: Keep header parsing exact and fail loudly on files that are not RPMs.
+"""
+
+from __future__ import annotations
+
+import io
+from pathlib import Path
+import tempfile
+import unittest
+
+from ci_tools.rpm_header import RpmHeaderError, read_rpm_header, read_rpm_header_stream
+from fake_rpm import build_kmod_rpm, build_rpm
+
+
+class ForwardOnlyStream(io.RawIOBase):
+    """Stream that refuses seeks, like a tar member in `r|*` mode."""
+
+    def __init__(self, data: bytes) -> None:
+        self._data = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._data.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+class RpmHeaderTests(unittest.TestCase):
+    def test_reads_identity_and_file_list_from_disk(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "zfs.rpm"
+            path.write_bytes(
+                build_rpm(
+                    "zfs",
+                    version="2.4.1",
+                    release="1.fc43",
+                    arch="x86_64",
+                    files=["/usr/sbin/zpool", "/usr/sbin/zfs", "/etc/zfs/zed.d/zed.rc"],
+                )
+            )
+
+            header = read_rpm_header(path)
+
+        self.assertEqual((header.name, header.version, header.release, header.arch), ("zfs", "2.4.1", "1.fc43", "x86_64"))
+        self.assertEqual(header.filenames, ("/usr/sbin/zpool", "/usr/sbin/zfs", "/etc/zfs/zed.d/zed.rc"))
+        self.assertIsNone(header.kernel_release_for_module())
+
+    def test_stream_read_stops_before_the_payload(self) -> None:
+        payload = b"P" * 4096
+        data = build_rpm("kmod-zfs", payload=payload)
+        stream = ForwardOnlyStream(data)
+
+        header = read_rpm_header_stream(stream)
+
+        self.assertEqual(header.name, "kmod-zfs")
+        self.assertEqual(stream.bytes_read, len(data) - len(payload))
+
+    def test_kernel_release_comes_from_the_module_path(self) -> None:
+        header = read_rpm_header_stream(io.BytesIO(build_kmod_rpm("6.18.16-200.fc43.x86_64")))
+        self.assertEqual(header.kernel_release_for_module(), "6.18.16-200.fc43.x86_64")
+
+        usr_lib = read_rpm_header_stream(
+            io.BytesIO(build_rpm("kmod-zfs", files=["/usr/lib/modules/6.18.13-200.fc43.x86_64/extra/zfs/zfs.ko"]))
+        )
+        self.assertEqual(usr_lib.kernel_release_for_module(), "6.18.13-200.fc43.x86_64")
+
+    def test_rejects_non_rpm_and_truncated_files(self) -> None:
+        with self.assertRaisesRegex(RpmHeaderError, "lead magic"):
+            read_rpm_header_stream(io.BytesIO(b"x" * 200))
+
+        truncated = build_kmod_rpm("6.18.16-200.fc43.x86_64")[:150]
+        with self.assertRaisesRegex(RpmHeaderError, "Truncated"):
+            read_rpm_header_stream(io.BytesIO(truncated))
+
+
+if __name__ == "__main__":
+    unittest.main()
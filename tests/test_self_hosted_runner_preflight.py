@@ -1,7 +1,7 @@
 """
 Script: tests/test_self_hosted_runner_preflight.py
 What: Tests for the self-hosted runner hygiene/preflight helper.
-Doing: Verifies stale temp cleanup rules and the free-space failure threshold.
+Doing: Verifies stale temp cleanup rules, blob store budget enforcement, and the free-space failure threshold.
 Why: Preflight should stay predictable because multiple trusted workflows depend on it.
 Goal: Keep runner cleanup targeted and fail early on real disk pressure.
 """
@@ -16,6 +16,7 @@ import tempfile
 import unittest
 from unittest.mock import patch
 
+from ci_tools.blob_store import BlobStore
 from ci_tools.self_hosted_runner_preflight import (
     BYTES_PER_GIB,
     cleanup_stale_temp_dirs,
@@ -74,6 +75,31 @@ class SelfHostedRunnerPreflightTests(unittest.TestCase):
 
             self.assertLess(summary.free_bytes, summary.required_free_bytes)
 
+    def test_run_preflight_trims_blob_store_to_budget(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            workspace = Path(temp_dir)
+            blob_dir = workspace / "blobs" / "sha256"
+            blob_dir.mkdir(parents=True)
+            for index, name in enumerate(("a" * 64, "b" * 64)):
+                blob = blob_dir / name
+                blob.write_bytes(b"x" * 600)
+                os.utime(blob, (1_000_000.0 + index, 1_000_000.0 + index))
+
+            summary = run_preflight(
+                workspace=workspace,
+                host_root=workspace,
+                min_free_gib=0,
+                retention_hours=24,
+                prune_podman_images=False,
+                blob_store=BlobStore(workspace / "blobs", max_bytes=1000),
+                now_timestamp=2_000_000.0,
+            )
+
+            assert summary.blob_store is not None
+            self.assertEqual(summary.blob_store.eviction.removed_blobs, 1)
+            self.assertEqual(summary.blob_store.usage.blob_count, 1)
+            self.assertFalse((blob_dir / ("a" * 64)).exists())
+
     def test_run_preflight_prunes_old_unused_podman_images(self) -> None:
         with tempfile.TemporaryDirectory() as temp_dir:
             workspace = Path(temp_dir)